@@ -0,0 +1,154 @@
+"""Sauvegarde et restauration en flux (/export, /import).
+
+Pour chaque moteur (--backends), remplit un catalogue de --files fichiers et
+des masquages, exporte en gzip JSON lines dans un thread pendant que la
+boucle asyncio mesure son propre retard (le bot doit continuer à répondre),
+puis restaure dans un répertoire vierge et compare les deux états. Une
+sauvegarde tronquée doit être refusée sans rien modifier. Chaque phase tourne
+dans un processus neuf pour que le pic de RSS lui soit propre.
+
+    python -m benchmarks.bench_backup --files 1000000 --backends json sqlite
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import ROOT, percentile, synthetic_file
+
+USERS = 200
+HIDDEN_PER_USER = 50
+
+
+def backend_env(directory, backend):
+    return {
+        **os.environ,
+        "ADMIN_ID": "1",
+        "RENDER_STORAGE_PATH": str(directory),
+        "STORAGE_BACKEND": backend,
+        "METRICS_ENABLED": "0",
+        "PYTHONPATH": str(ROOT),
+    }
+
+
+def state_digest(bot):
+    # Empreinte du catalogue et des masquages, indépendante du moteur
+    digest = hashlib.sha256()
+    for cat in bot.MAIN_CATEGORIES:
+        for sub in bot.SUB_CATEGORIES:
+            for file_data in bot.storage.get_files(cat, sub):
+                digest.update(json.dumps(dict(file_data), sort_keys=True).encode())
+            for user in range(USERS):
+                digest.update(repr(sorted(bot.hidden_files.hidden_keys(str(user), cat, sub))).encode())
+    return digest.hexdigest()
+
+
+async def loop_lag(work):
+    # Retard de la boucle pendant que work tourne dans un thread
+    lags, task = [], asyncio.ensure_future(asyncio.to_thread(work))
+    while not task.done():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - started - 0.01)
+    return task.result(), lags
+
+
+def phase(args):
+    from benchmarks.common import load_bot
+    bot = load_bot(args.dir)
+    report = {}
+    if args.phase == "export":
+        cells = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES]
+        per_cell = args.files // len(cells)
+        for n, (cat, sub) in enumerate(cells):
+            bot.storage.add_files(cat, sub, [synthetic_file(n * per_cell + i) for i in range(per_cell)])
+        rng = random.Random(1)
+        for user in range(USERS):
+            for _ in range(HIDDEN_PER_USER):
+                bot.hidden_files.hide_file(str(user), *rng.choice(cells), rng.randrange(per_cell))
+        bot.persistence.flush()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        (files, hidden), lags = asyncio.run(loop_lag(lambda: bot.write_backup(Path(args.backup), [0, 0])))
+        report["seconds"] = time.perf_counter() - started
+        report["rss_delta_mb"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+    else:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        (files, hidden), lags = asyncio.run(loop_lag(lambda: bot.restore_backup(Path(args.backup), [0, 0])))
+        report["seconds"] = time.perf_counter() - started
+        report["rss_delta_mb"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+        bot.persistence.flush()
+        truncated = Path(args.dir) / "truncated.jsonl.gz"
+        with gzip.open(args.backup, 'rb') as f:
+            head = f.read(os.path.getsize(args.backup))
+        with gzip.open(truncated, 'wb') as f:
+            f.write(head[:len(head) // 2])
+        before = state_digest(bot)
+        try:
+            bot.restore_backup(truncated, [0, 0])
+            report["truncated_rejected"] = False
+        except ValueError:
+            report["truncated_rejected"] = state_digest(bot) == before
+    report.update({
+        "files": files, "hidden": hidden,
+        "lag_p99_ms": percentile(lags, 99) * 1000 if lags else 0.0,
+        "lag_max_ms": max(lags, default=0.0) * 1000,
+        "digest": state_digest(bot),
+    })
+    bot.shutdown_storage()
+    print(json.dumps(report))
+
+
+def run_phase(name, directory, backend, backup, files):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_backup", "--phase", name, "--dir", str(directory),
+         "--backup", str(backup), "--files", str(files)],
+        env=backend_env(directory, backend), cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200000)
+    parser.add_argument("--backends", nargs="+", default=["json", "sqlite"])
+    parser.add_argument("--phase", choices=["export", "restore"], help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    parser.add_argument("--backup", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.phase:
+        phase(args)
+        return
+
+    ok = True
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            backup = Path(tmp) / "konntek.jsonl.gz"
+            (Path(tmp) / "source").mkdir()
+            (Path(tmp) / "target").mkdir()
+            exported = run_phase("export", Path(tmp) / "source", backend, backup, args.files)
+            size = backup.stat().st_size
+            restored = run_phase("restore", Path(tmp) / "target", backend, backup, args.files)
+        identical = exported["digest"] == restored["digest"]
+        ok = ok and identical and restored["truncated_rejected"]
+        print(f"{backend}: {exported['files']} files, {exported['hidden']} hidden, backup {size / 1e6:.1f} MB")
+        for name, report in (("export", exported), ("restore", restored)):
+            print(f"  {name:<7}: {report['seconds']:6.2f}s ({report['files'] / report['seconds']:,.0f} files/s), "
+                  f"RSS +{report['rss_delta_mb']:.0f} MB, loop lag p99 {report['lag_p99_ms']:.1f} ms "
+                  f"max {report['lag_max_ms']:.1f} ms")
+        print(f"  round trip identical: {identical}, truncated backup rejected: {restored['truncated_rejected']}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
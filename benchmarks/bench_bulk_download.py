@@ -0,0 +1,101 @@
+"""Récupération d'une sous-catégorie : un clic par fichier vs « Tout télécharger ».
+
+Le bot réel (Application, limiteur de débit compris) parle au serveur factice
+de l'API Bot ; on compte les appels API et le temps jusqu'au dernier fichier
+reçu, ainsi que l'arrivée du premier album.
+
+    python -m benchmarks.bench_bulk_download --files 60 --delay 0.03
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:bench")
+
+from telegram import Update
+
+from benchmarks.common import load_bot, synthetic_file
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.loadtest_webhook import callback_update
+
+bot = load_bot()
+USER_ID = 4242
+FILE_TYPES = ("document", "document", "photo", "video", "audio")
+MEDIA_METHODS = ("sendDocument", "sendPhoto", "sendVideo", "sendAudio", "sendVoice")
+
+
+def delivered(api):
+    # Fichiers reçus : un par envoi unitaire, dix au plus par album
+    return sum(api.calls[m] for m in MEDIA_METHODS) + api.media_items
+
+
+class CountingAPI(FakeBotAPI):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.media_items = 0
+        self.first_file = None
+
+    def record(self, method, params):
+        super().record(method, params)
+        if method == "sendMediaGroup":
+            self.media_items += len(self.result(method, params))
+        if method in MEDIA_METHODS + ("sendMediaGroup",) and self.first_file is None:
+            self.first_file = time.perf_counter()
+
+
+async def run(mode, args, code):
+    api = CountingAPI(args.delay, args.limit_global, args.limit_chat)
+    server = api.make_app().listen(args.api_port)
+    bot.TELEGRAM_BASE_URL = f"http://127.0.0.1:{args.api_port}/bot"
+    # Marge de 10 % sous les limites du serveur pour absorber la gigue réseau
+    bot.API_RATE_GLOBAL, bot.API_RATE_PER_CHAT = args.limit_global * 0.9, args.limit_chat * 0.9
+    bot.API_CHAT_BURST = 1
+    app = bot.build_application()
+    app.post_shutdown = None
+    await app.initialize()
+    await app.start()
+
+    async def click(update_id, data):
+        update = callback_update(update_id, USER_ID)
+        update["callback_query"]["data"] = data
+        await app.process_update(Update.de_json(update, app.bot))
+
+    started = time.perf_counter()
+    if mode == "per-file":
+        for key in bot.visible_views.get(USER_ID, "KF", "Documents"):
+            await click(key + 1, f"file_{code}_{key}")
+    else:
+        await click(1, f"dl_{code}")
+    while delivered(api) < args.files:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    first = api.first_file - started
+
+    await app.stop()
+    await app.shutdown()
+    server.stop()
+    return {"elapsed_s": elapsed, "first_s": first, "api_calls": sum(api.calls.values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=60)
+    parser.add_argument("--delay", type=float, default=0.03)
+    parser.add_argument("--limit-global", type=int, default=30)
+    parser.add_argument("--limit-chat", type=int, default=1)
+    parser.add_argument("--api-port", type=int, default=18083)
+    args = parser.parse_args()
+
+    for i in range(args.files):
+        bot.storage.add_file("KF", "Documents", {**synthetic_file(i), "file_type": FILE_TYPES[i % len(FILE_TYPES)]})
+    code = bot.cell_code("KF", "Documents")
+
+    for mode in ("per-file", "bulk"):
+        r = asyncio.run(run(mode, args, code))
+        print(f"{mode:>9}: {r['api_calls']:>4} API calls, first file {r['first_s'] * 1e3:>7.0f} ms, "
+              f"all {args.files} files {r['elapsed_s']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Démarrage à froid : délai entre le lancement de bot.py et le premier getUpdates.
+
+Le même catalogue est servi depuis un snapshot JSON puis depuis le snapshot
+binaire ; le bot tourne en polling contre le serveur factice de l'API Bot.
+
+    python -m benchmarks.bench_cold_start --files 200000 --runs 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import ROOT, load_bot, synthetic_file
+from benchmarks.fake_bot_api import FakeBotAPI
+
+bot = load_bot()
+
+
+class StartupAPI(FakeBotAPI):
+    def __init__(self):
+        super().__init__()
+        self.first_poll = None
+
+    def record(self, method, params):
+        super().record(method, params)
+        if method == "getUpdates" and self.first_poll is not None and not self.first_poll.done():
+            self.first_poll.set_result(time.perf_counter())
+
+
+def write_json_snapshot(directory, files):
+    cells = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES]
+    catalog = {cat: {sub: [] for sub in bot.SUB_CATEGORIES} for cat in bot.MAIN_CATEGORIES}
+    for i in range(files):
+        cat, sub = cells[i % len(cells)]
+        catalog[cat][sub].append({"id": i // len(cells), **synthetic_file(i)})
+    payload = {"version": bot.SNAPSHOT_VERSION, "seq": 0, "next_ids": {}, "catalog": catalog}
+    with open(directory / "file_storage.json", 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def prepare(directory, files, snapshot_format):
+    directory.mkdir()
+    write_json_snapshot(directory, files)
+    if snapshot_format == "binary":
+        # Conversion faite par le bot lui-même à l'ouverture d'un snapshot JSON
+        storage = bot.FileStorage(directory / "file_storage.json", snapshot_format="binary")
+        storage.close()
+        (directory / "file_storage.json").unlink()
+    return sum(f.stat().st_size for f in directory.iterdir())
+
+
+async def cold_start(directory, snapshot_format, api_port):
+    api = StartupAPI()
+    server = api.make_app().listen(api_port)
+    api.first_poll = asyncio.get_running_loop().create_future()
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": "123:coldstart",
+        "ADMIN_ID": "1",
+        "RENDER_STORAGE_PATH": str(directory),
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{api_port}/bot",
+        "SNAPSHOT_FORMAT": snapshot_format,
+        "BOT_MODE": "polling",
+        "METRICS_ENABLED": "0",
+    }
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, str(ROOT / "bot.py")], env=env, cwd=directory,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_poll = await asyncio.wait_for(api.first_poll, timeout=300)
+    finally:
+        process.terminate()
+        try:
+            await asyncio.to_thread(process.wait, 30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        server.stop()
+    return first_poll - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--api-port", type=int, default=18121)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{args.files} files")
+        for snapshot_format in ("json", "binary"):
+            directory = Path(tmp) / snapshot_format
+            size = prepare(directory, args.files, snapshot_format)
+            samples = [asyncio.run(cold_start(directory, snapshot_format, args.api_port)) for _ in range(args.runs)]
+            print(f"{snapshot_format:>7}: {size / 1e6:6.1f} MB on disk, first getUpdates after "
+                  f"{statistics.median(samples):.2f}s (min {min(samples):.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
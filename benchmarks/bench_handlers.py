@@ -0,0 +1,274 @@
+"""Suite de benchmarks des handlers : start, handle_callback et handle_file.
+
+Les handlers tournent dans le processus, sur un catalogue synthétique
+(--cells sous-catégories x --files fichiers, --hidden fichiers masqués par
+utilisateur), avec un vrai Bot dont la couche réseau est remplacée par une
+requête factice qui enregistre les appels au lieu de les envoyer.
+Pour chaque scénario : débit, latences p50/p99, mémoire allouée (tracemalloc)
+et pic de RSS. Le résultat est écrit en JSON pour comparer deux exécutions.
+
+    python -m benchmarks.bench_handlers --cells 20 --files 2000 --output avant.json
+    python -m benchmarks.bench_handlers --cells 20 --files 2000 --compare avant.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+from telegram.request import BaseRequest
+
+from benchmarks.common import ROOT, load_bot, summarize, synthetic_file
+from benchmarks.fake_bot_api import FakeBotAPI
+
+bot = load_bot()
+USERS_BASE = 1000
+HANDLERS = {"start": bot.start, "callback": bot.handle_callback, "upload": bot.handle_file}
+
+
+class RecordingRequest(BaseRequest):
+    # Remplace HTTPXRequest : sérialisation PTB complète, sans réseau
+    def __init__(self, api):
+        self.api = api
+        self.calls = defaultdict(int)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.json_parameters if request_data else {}
+        self.calls[endpoint] += 1
+        return 200, json.dumps({"ok": True, "result": self.api.result(endpoint, params)}).encode()
+
+
+def user_payload(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+
+
+def message_payload(update_id, user_id, **fields):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_payload(user_id),
+            **fields,
+        },
+    }
+
+
+def callback_payload(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Konntek"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def populate(cells, files, users, hidden):
+    # Catalogue synthétique réparti sur les premières sous-catégories
+    grid = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES][:cells]
+    for n, (cat, sub) in enumerate(grid):
+        bot.storage.add_files(cat, sub, [synthetic_file(n * files + i) for i in range(files)])
+    rng = random.Random(1)
+    for user in range(users):
+        for cat, sub in grid:
+            for file_key in rng.sample(range(files), min(hidden, files)):
+                bot.hidden_files._add(str(USERS_BASE + user), cat, sub, file_key)
+    return grid
+
+
+def callback_mix(grid, files, users, count):
+    # Navigation type : catégorie, sous-catégorie, page, téléchargement, retour
+    rng = random.Random(2)
+    pages = max(1, -(-files // bot.FILE_PAGE_SIZE))
+    for i in range(count):
+        cat, sub = rng.choice(grid)
+        code = bot.cell_code(cat, sub)
+        data = rng.choice((
+            f"cat_{bot.category_code(cat)}", f"sub_{code}", f"pg_{code}_{rng.randrange(pages)}",
+            f"file_{code}_{rng.randrange(files)}", "back_to_main",
+        ))
+        yield None, callback_payload(i + 1, USERS_BASE + rng.randrange(users), data)
+
+
+def start_mix(users, count):
+    for i in range(count):
+        yield None, message_payload(i + 1, USERS_BASE + i % users, text="/start")
+
+
+def upload_mix(grid, count):
+    # Le clic « Upload » prépare l'état sans être chronométré, puis l'envoi du document
+    for i in range(count):
+        cat, sub = grid[i % len(grid)]
+        click = callback_payload(2 * i + 1, bot.ADMIN_ID, f"upload_{bot.cell_code(cat, sub)}")
+        document = message_payload(2 * i + 2, bot.ADMIN_ID, document={
+            "file_id": f"BQACAgQAAxkBAAIupload{i:08d}",
+            "file_unique_id": f"AgADupload{i:08d}",
+            "file_name": f"upload_{i}.pdf",
+        })
+        yield click, document
+
+
+async def drive(app, handler, workload):
+    samples = []
+    for setup, payload in workload:
+        if setup is not None:
+            update = Update.de_json(setup, app.bot)
+            await bot.handle_callback(update, CallbackContext.from_update(update, app))
+        update = Update.de_json(payload, app.bot)
+        context = CallbackContext.from_update(update, app)
+        started = time.perf_counter()
+        await handler(update, context)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def peak_rss_mb():
+    # ru_maxrss est en Ko sous Linux, en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+async def run_scenario(app, request, name, workload_of, count):
+    handler = HANDLERS[name]
+    # Passe chronométrée sans tracemalloc, qui ralentit fortement l'interpréteur
+    request.calls.clear()
+    started = time.perf_counter()
+    samples = await drive(app, handler, workload_of(count))
+    elapsed = time.perf_counter() - started
+    calls = dict(request.calls)
+
+    traced = max(1, count // 10)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    await drive(app, handler, workload_of(traced))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "ops": count,
+        "ops_per_s": count / elapsed,
+        **summarize(samples),
+        "max_us": max(samples) * 1e6,
+        "alloc_peak_kb": (peak - before) / 1024,
+        "alloc_retained_b_per_op": (current - before) / traced,
+        "api_calls_per_op": sum(calls.values()) / count,
+        "api_calls": calls,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench(args):
+    request = RecordingRequest(FakeBotAPI())
+    app = Application.builder().token("123:bench").request(request).get_updates_request(request).build()
+    await app.initialize()
+
+    started = time.perf_counter()
+    grid = populate(args.cells, args.files, args.users, args.hidden)
+    build_s = time.perf_counter() - started
+
+    workloads = {
+        "start": lambda n: start_mix(args.users, n),
+        "callback": lambda n: callback_mix(grid, args.files, args.users, n),
+        "upload": lambda n: upload_mix(grid, n),
+    }
+    results = {}
+    for name in args.scenarios:
+        # Une passe de chauffe remplit les caches comme en production
+        await drive(app, HANDLERS[name], workloads[name](min(args.ops, 200)))
+        results[name] = await run_scenario(app, request, name, workloads[name], args.ops)
+    await app.shutdown()
+    bot.persistence.flush()
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "storage_backend": bot.STORAGE_BACKEND,
+            "cells": len(grid), "files_per_cell": args.files,
+            "users": args.users, "hidden_per_cell": args.hidden,
+            "catalog_build_s": build_s,
+        },
+        "scenarios": results,
+    }
+
+
+def compare(report, baseline):
+    print(f"\nvs {baseline['meta'].get('revision') or 'baseline'}", file=sys.stderr)
+    for name, stats in report["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if not old:
+            continue
+        deltas = "  ".join(
+            f"{key} {(stats[key] / old[key] - 1):+.1%}" if old[key] else f"{key} n/a"
+            for key in ("ops_per_s", "p50_us", "p99_us", "alloc_peak_kb")
+        )
+        print(f"{name:>9}: {deltas}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cells", type=int, default=20, help="sous-catégories remplies")
+    parser.add_argument("--files", type=int, default=1000, help="fichiers par sous-catégorie")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--hidden", type=int, default=100, help="fichiers masqués par utilisateur et sous-catégorie")
+    parser.add_argument("--ops", type=int, default=2000, help="mises à jour par scénario")
+    parser.add_argument("--scenarios", nargs="+", choices=HANDLERS, default=list(HANDLERS))
+    parser.add_argument("--output", help="fichier JSON de résultats (défaut : sortie standard)")
+    parser.add_argument("--compare", help="résultats JSON d'une exécution précédente")
+    args = parser.parse_args()
+    args.cells = min(args.cells, len(bot.MAIN_CATEGORIES) * len(bot.SUB_CATEGORIES))
+
+    report = asyncio.run(bench(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    for name, stats in report["scenarios"].items():
+        print(f"{name:>9}: {stats['ops_per_s']:>8.0f} ops/s  p50 {stats['p50_us']:>8.1f} µs  "
+              f"p99 {stats['p99_us']:>8.1f} µs  alloc peak {stats['alloc_peak_kb']:>8.1f} KB  "
+              f"rss {stats['peak_rss_mb']:.0f} MB", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
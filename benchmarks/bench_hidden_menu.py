@@ -0,0 +1,83 @@
+"""Rendu du menu de fichiers avec masquages : liste (ancien) vs index d'ensembles.
+
+    python -m benchmarks.bench_hidden_menu --files 5000 --hidden 2000
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import load_bot, summarize, synthetic_file
+
+bot = load_bot()
+USER_ID = 42
+
+
+def legacy_render(files, hidden_list):
+    # Ancien chemin : is_hidden = quatre accès dict puis `in` sur une liste,
+    # et le comptage des visibles refait un second passage complet
+    data = {str(USER_ID): {"KF": {"Documents": hidden_list}}}
+
+    def is_hidden(user_id, category, subcategory, file_key):
+        user_id = str(user_id)
+        return (user_id in data and category in data[user_id]
+                and subcategory in data[user_id][category]
+                and file_key in data[user_id][category][subcategory])
+
+    visible = [f for f in files if not is_hidden(USER_ID, "KF", "Documents", f["id"])]
+    keyboard = [
+        [bot.InlineKeyboardButton(f"⬇️ {f['file_name']}", callback_data=f"file_KF_Documents_{f['id']}"),
+         bot.InlineKeyboardButton("👁️", callback_data=f"hide_KF_Documents_{f['id']}")]
+        for f in files if not is_hidden(USER_ID, "KF", "Documents", f["id"])
+    ]
+    return len(visible), bot.InlineKeyboardMarkup(keyboard)
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--hidden", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = bot.FileStorage(Path(tmp) / "file_storage.json", journal=False)
+        hidden = bot.HiddenFiles(Path(tmp) / "hidden_files.json")
+        storage.data["KF"]["Documents"] = {i: {"id": i, **synthetic_file(i)} for i in range(args.files)}
+        hidden_keys = random.Random(1).sample(range(args.files), args.hidden)
+        for file_key in hidden_keys:
+            hidden._add(str(USER_ID), "KF", "Documents", file_key)
+        bot.storage, bot.hidden_files = storage, hidden
+
+        files = storage.get_files("KF", "Documents")
+        results = {
+            "legacy render": timed(lambda: legacy_render(files, hidden_keys), args.repeat),
+            "indexed render": timed(lambda: (
+                bot.file_menu_text("KF", "Documents", USER_ID),
+                bot.create_file_menu("KF", "Documents", USER_ID),
+            ), args.repeat),
+            "visible count": timed(
+                lambda: hidden.visible_count(USER_ID, "KF", "Documents", args.files), args.repeat * 100
+            ),
+            "is_hidden": timed(
+                lambda: hidden.is_hidden(USER_ID, "KF", "Documents", args.files - 1), args.repeat * 100
+            ),
+        }
+
+    print(f"{args.files} files, {args.hidden} hidden for user {USER_ID}")
+    for name, stats in results.items():
+        print(f"{name:>15}: mean {stats['mean_us']:>10.1f} µs  p99 {stats['p99_us']:>10.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
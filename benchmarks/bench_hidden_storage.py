@@ -0,0 +1,106 @@
+"""Persistance des masquages : JSON imbriqué complet vs bitmaps par utilisateur.
+
+Pour --users utilisateurs masquant chacun --hidden fichiers dans --cells
+sous-catégories, mesure le coût d'écriture après un masquage (ancien format :
+tout le fichier réécrit ; nouveau : le seul fichier de l'utilisateur), la
+taille sur disque, la mémoire de l'index et le coût des opérations.
+
+    python -m benchmarks.bench_hidden_storage --users 2000 --hidden 200
+"""
+import argparse
+import gc
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.common import load_bot, summarize
+
+bot = load_bot()
+CELLS = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES]
+
+
+def legacy_payload(args):
+    rng = random.Random(1)
+    payload = {}
+    for user in range(args.users):
+        for cat, sub in rng.sample(CELLS, args.cells):
+            keys = sorted(rng.sample(range(args.files), args.hidden))
+            payload.setdefault(str(user), {}).setdefault(cat, {})[sub] = keys
+    return payload
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def index_bytes(build):
+    gc.collect()
+    tracemalloc.start()
+    index = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return index, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--cells", type=int, default=3, help="sous-catégories avec masquages par utilisateur")
+    parser.add_argument("--hidden", type=int, default=100, help="fichiers masqués par sous-catégorie")
+    parser.add_argument("--files", type=int, default=5000, help="fichiers par sous-catégorie")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = legacy_payload(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = Path(tmp) / "legacy.json"
+
+        def legacy_save():
+            with open(legacy_path, 'w') as f:
+                json.dump(payload, f, indent=4)
+
+        legacy_write = timed(legacy_save, args.repeat)
+        legacy_size = legacy_path.stat().st_size
+
+        path = Path(tmp) / "hidden_files.json"
+        with open(path, 'w') as f:
+            json.dump(payload, f)
+        hidden, bitmap_bytes = index_bytes(lambda: bot.HiddenFiles(path))
+        started = time.perf_counter()
+        bot.HiddenFiles(path)
+        load_s = time.perf_counter() - started
+        bitmap_size = sum(p.stat().st_size for p in hidden.bitmap_dir.iterdir())
+        rng = random.Random(2)
+        user_write = timed(lambda: hidden.save_user(str(rng.randrange(args.users))), args.repeat * 10)
+
+        _, set_bytes = index_bytes(lambda: {
+            (user, cat, sub): set(keys)
+            for user, cats in payload.items() for cat, subs in cats.items() for sub, keys in subs.items()
+        })
+        cat, sub = CELLS[0]
+        ops = {
+            "is_hidden": timed(lambda: hidden.is_hidden(rng.randrange(args.users), cat, sub,
+                                                        rng.randrange(args.files)), 100000),
+            "hide+unhide": timed(lambda: (hidden._add("x", cat, sub, 17), hidden._discard("x", cat, sub, 17)), 100000),
+            "visible_count": timed(lambda: hidden.visible_count(rng.randrange(args.users), cat, sub, args.files), 100000),
+        }
+
+    print(f"{args.users} users x {args.cells} subcategories x {args.hidden} hidden")
+    print(f"  legacy JSON : {legacy_size / 1e6:7.2f} MB, rewrite per change {legacy_write['mean_us'] / 1000:8.2f} ms")
+    print(f"  bitmaps     : {bitmap_size / 1e6:7.2f} MB, write per change {user_write['mean_us'] / 1000:8.2f} ms, "
+          f"load {load_s:.2f}s")
+    print(f"  index memory: sets {set_bytes / 1e6:.1f} MB, bitmaps {bitmap_bytes / 1e6:.1f} MB")
+    for name, stats in ops.items():
+        print(f"  {name:>13}: {stats['mean_us']:.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
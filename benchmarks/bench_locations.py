@@ -0,0 +1,132 @@
+"""Positions partagées : série temporelle compacte et index spatial en grille.
+
+Simule --users utilisateurs en position en direct (marche aléatoire autour
+d'Abidjan, une mise à jour toutes les --interval secondes) jusqu'à --updates
+mises à jour, enregistrées par LocationStore avec le PersistenceWorker du bot.
+Compare une recherche par rayon sur la grille au parcours de toutes les
+dernières positions (résultats identiques exigés), et le coût d'écriture par
+mise à jour à celui d'un fichier JSON des positions réécrit à chaque fois.
+Mesure aussi la mémoire par point et le rechargement.
+
+    python -m benchmarks.bench_locations --users 20000 --updates 1000000
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.common import load_bot, summarize
+
+bot = load_bot()
+CENTER = (5.35, -4.00)
+
+
+def live_updates(args):
+    rng = random.Random(1)
+    positions = [[CENTER[0] + rng.gauss(0, 0.5), CENTER[1] + rng.gauss(0, 0.5)] for _ in range(args.users)]
+    started = int(time.time()) - args.updates // args.users * args.interval
+    for n in range(args.updates):
+        user = n % args.users
+        position = positions[user]
+        position[0] += rng.gauss(0, 0.001)
+        position[1] += rng.gauss(0, 0.001)
+        yield user, position[0], position[1], started + n // args.users * args.interval
+
+
+def brute_within(store, latitude, longitude, radius):
+    found = []
+    for user_id, _, lat, lon in store.latest_positions():
+        if bot.haversine_km(latitude, longitude, lat, lon) <= radius:
+            found.append(user_id)
+    return sorted(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--updates", type=int, default=500000)
+    parser.add_argument("--interval", type=int, default=10, help="secondes entre deux mises à jour d'un utilisateur")
+    parser.add_argument("--radius", type=float, default=bot.LOCATION_NEARBY_KM)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    updates = list(live_updates(args))
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp) / "locations"
+        persistence = bot.PersistenceWorker()
+        store = bot.LocationStore(directory, persistence, shared=False)
+        started = time.perf_counter()
+        for user_id, latitude, longitude, when in updates:
+            store.record(user_id, latitude, longitude, when)
+        persistence.flush()
+        record_s = time.perf_counter() - started
+        persistence.stop()
+        disk = sum(path.stat().st_size for path in directory.iterdir())
+
+        # Ancienne approche : toutes les dernières positions dans un JSON réécrit
+        legacy_path = Path(tmp) / "locations.json"
+        payload = {str(u): [ts, lat, lon] for u, ts, lat, lon in store.latest_positions()}
+        samples = []
+        for _ in range(20):
+            begin = time.perf_counter()
+            with open(legacy_path, 'w') as f:
+                json.dump(payload, f)
+            samples.append(time.perf_counter() - begin)
+        legacy = summarize(samples)
+
+        rng = random.Random(2)
+        queries = [(CENTER[0] + rng.gauss(0, 0.5), CENTER[1] + rng.gauss(0, 0.5)) for _ in range(args.queries)]
+        grid_samples, identical = [], True
+        for latitude, longitude in queries:
+            begin = time.perf_counter()
+            store.within(latitude, longitude, args.radius)
+            grid_samples.append(time.perf_counter() - begin)
+        for latitude, longitude in queries[:50]:
+            found = sorted(user_id for _, user_id, _, _, _ in store.within(latitude, longitude, args.radius))
+            identical = identical and found == brute_within(store, latitude, longitude, args.radius)
+        scan_samples = []
+        for latitude, longitude in queries[:50]:
+            begin = time.perf_counter()
+            brute_within(store, latitude, longitude, args.radius)
+            scan_samples.append(time.perf_counter() - begin)
+        grid, scan = summarize(grid_samples), summarize(scan_samples)
+        latest_samples = []
+        for user_id in (rng.randrange(args.users) for _ in range(10000)):
+            begin = time.perf_counter()
+            store.latest(user_id)
+            latest_samples.append(time.perf_counter() - begin)
+        latest = summarize(latest_samples)
+
+        users, points = store.counts()
+        del store
+        # Durée mesurée hors tracemalloc, qui ralentit fortement les allocations
+        begin = time.perf_counter()
+        bot.LocationStore(directory, shared=False)
+        load_s = time.perf_counter() - begin
+        gc.collect()
+        tracemalloc.start()
+        reloaded = bot.LocationStore(directory, shared=False)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        same = reloaded.counts() == (users, points)
+
+    print(f"{args.updates} live updates from {args.users} users every {args.interval}s "
+          f"(kept {points} points, LOCATION_MIN_INTERVAL={bot.LOCATION_MIN_INTERVAL:g}s)")
+    print(f"  record      : {len(updates) / record_s:,.0f} updates/s including batched appends")
+    print(f"  disk        : {disk / 1e6:.1f} MB, {bot.LOCATION_RECORD.size} B/point appended; "
+          f"legacy JSON rewrite {legacy['mean_us'] / 1000:.1f} ms per update")
+    print(f"  memory      : {memory / 1e6:.1f} MB ({memory / max(points, 1):.0f} B/point), reload {load_s:.2f}s, "
+          f"identical: {same}")
+    print(f"  within {args.radius:g} km: grid p50 {grid['p50_us']:.0f} µs p99 {grid['p99_us']:.0f} µs, "
+          f"full scan p50 {scan['p50_us']:.0f} µs, identical: {identical}")
+    print(f"  latest      : {latest['mean_us']:.2f} µs")
+    sys.exit(0 if identical and same else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Coût de l'instrumentation : débit de handle_callback avec et sans métriques.
+
+Les appels à l'API Bot sont remplacés par des coroutines vides pour ne
+mesurer que le handler (menus en cache, comme en production une fois chaud).
+
+    python -m benchmarks.bench_metrics --updates 200000
+"""
+import argparse
+import asyncio
+import time
+import types
+
+from benchmarks.common import load_bot, synthetic_file
+
+bot = load_bot()
+CALLBACKS = ("cat_0", "sub_0.7", "pg_0.7_1", "back_to_main")
+
+
+class StubQuery:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = types.SimpleNamespace(id=user_id, first_name="U")
+        self.message = types.SimpleNamespace(chat_id=user_id, message_id=1)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+async def run(handler, updates, users):
+    context = types.SimpleNamespace(bot=None, user_data={}, application=None)
+    batch = [
+        types.SimpleNamespace(callback_query=StubQuery(CALLBACKS[i % len(CALLBACKS)], 100 + i % users))
+        for i in range(len(CALLBACKS) * users)
+    ]
+    started = time.perf_counter()
+    for i in range(updates):
+        await handler(batch[i % len(batch)], context)
+    return updates / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    for i in range(40):
+        bot.storage.add_file("KF", "Documents", synthetic_file(i))
+    instrumented = bot.instrument("callback", bot.handle_callback, bot.callback_branch)
+
+    best = {"plain": 0, "instrumented": 0}
+    for _ in range(args.rounds):
+        best["plain"] = max(best["plain"], asyncio.run(run(bot.handle_callback, args.updates, args.users)))
+        best["instrumented"] = max(best["instrumented"], asyncio.run(run(instrumented, args.updates, args.users)))
+    overhead = (1 / best["instrumented"] - 1 / best["plain"]) * 1e6
+    for name, rate in best.items():
+        print(f"{name:>13}: {rate:>10.0f} updates/s")
+    print(f"overhead: {overhead:.2f} µs/update ({best['plain'] / best['instrumented'] - 1:.1%})")
+
+
+if __name__ == "__main__":
+    main()
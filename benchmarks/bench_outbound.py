@@ -0,0 +1,139 @@
+"""Débit soutenu des appels sortants face aux limites de l'API Bot.
+
+Le serveur factice refuse (429 + retry_after) au-delà de --limit-global
+requêtes/s et --limit-chat requêtes/s par chat. Chaque chat simule une
+navigation : answerCallbackQuery, rafale d'éditions du même message puis
+envoi d'un document. On compare les appels directs et OutboundRateLimiter.
+Vérifie aussi qu'après un 429 visant un chat, la nouvelle tentative attend
+retry_after quelle que soit la priorité de l'appel (réponse, édition, envoi).
+
+    python -m benchmarks.bench_outbound --chats 40 --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:bench")
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+from benchmarks.common import load_bot, percentile
+from benchmarks.fake_bot_api import FakeBotAPI
+
+bot = load_bot()
+
+
+async def browse(ext_bot, chat_id, rounds, edits, results):
+    for r in range(rounds):
+        calls = [("answer", ext_bot.answer_callback_query(f"{chat_id}-{r}"))]
+        calls += [
+            ("edit", ext_bot.edit_message_text(f"menu {r}.{e}", chat_id=chat_id, message_id=1))
+            for e in range(edits)
+        ]
+        calls.append(("send", ext_bot.send_document(chat_id, document="BQACAgQAAxkBAAI")))
+        for kind, coroutine in calls:
+            started = time.perf_counter()
+            task = asyncio.ensure_future(coroutine)
+            task.add_done_callback(lambda t, k=kind, s=started: results.append((k, t, time.perf_counter() - s)))
+            if kind != "edit":
+                # Les éditions partent en rafale, le reste attend sa réponse
+                await asyncio.wait([task])
+        await asyncio.sleep(0)
+
+
+async def run(limited, args):
+    api = FakeBotAPI(args.delay, args.limit_global, args.limit_chat)
+    server = api.make_app().listen(args.api_port)
+    limiter = bot.OutboundRateLimiter(rate=args.limit_global, per_chat=args.limit_chat,
+                                      chat_burst=args.limit_chat) if limited else None
+    ext_bot = ExtBot(os.environ["TELEGRAM_BOT_TOKEN"], base_url=f"http://127.0.0.1:{args.api_port}/bot",
+                     request=HTTPXRequest(connection_pool_size=256), rate_limiter=limiter)
+    results = []
+    async with ext_bot:
+        started = time.perf_counter()
+        await asyncio.gather(*(browse(ext_bot, 1000 + c, args.rounds, args.edits, results)
+                               for c in range(args.chats)))
+        while len(results) < args.chats * args.rounds * (args.edits + 2):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+    server.stop()
+
+    failed = sum(1 for _, task, _ in results if task.exception())
+    flood = sum(1 for _, task, _ in results if isinstance(task.exception(), RetryAfter))
+    answers = [latency for kind, task, latency in results if kind == "answer" and not task.exception()]
+    delivered = sum(api.calls.values())
+    return {
+        "elapsed_s": elapsed,
+        "delivered": delivered,
+        "delivered_per_s": delivered / elapsed,
+        "failed": failed,
+        "flood_errors": flood,
+        "rejected_429": api.rejected,
+        "answer_p50_ms": percentile(answers, 50) * 1e3 if answers else float("nan"),
+        "answer_p99_ms": percentile(answers, 99) * 1e3 if answers else float("nan"),
+        "counters": limiter.counters if limiter else {},
+    }
+
+
+async def retry_delays(retry_after):
+    # Un 429 par appel, puis succès : délai entre le refus et la nouvelle tentative
+    calls = {
+        "answerCallbackQuery": {"callback_query_id": "1"},
+        "editMessageText": {"chat_id": 1002, "message_id": 1, "text": "menu"},
+        "sendMessage": {"chat_id": 1003, "text": "doc"},
+    }
+    limiter = bot.OutboundRateLimiter(rate=1000, per_chat=1000, chat_burst=1000)
+    
+    async def measure(endpoint, data):
+        attempts = []
+        
+        async def callback():
+            attempts.append(time.perf_counter())
+            if len(attempts) == 1:
+                raise RetryAfter(retry_after)
+            return True
+        
+        await limiter.process_request(callback, (), {}, endpoint, data, None)
+        return attempts[1] - attempts[0]
+    
+    # L'un après l'autre : une pause globale ne doit pas masquer celle d'un chat
+    delays = {endpoint: await measure(endpoint, data) for endpoint, data in calls.items()}
+    await limiter.shutdown()
+    return delays
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--edits", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=0.01)
+    parser.add_argument("--limit-global", type=int, default=30)
+    parser.add_argument("--limit-chat", type=int, default=1)
+    parser.add_argument("--api-port", type=int, default=18082)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    for limited in (False, True):
+        r = asyncio.run(run(limited, args))
+        print(f"{'limiter' if limited else 'direct':>8}: {r['elapsed_s']:.1f}s, "
+              f"{r['delivered']} delivered ({r['delivered_per_s']:.1f}/s), "
+              f"{r['failed']} failed ({r['flood_errors']} flood), {r['rejected_429']} x 429, "
+              f"answer p50 {r['answer_p50_ms']:.0f} ms p99 {r['answer_p99_ms']:.0f} ms")
+        if r["counters"]:
+            print(f"{'':>10}{r['counters']}")
+    
+    delays = asyncio.run(retry_delays(args.retry_after))
+    respected = all(delay >= args.retry_after * 0.95 for delay in delays.values())
+    print(f"retry after RetryAfter({args.retry_after}): "
+          + ", ".join(f"{endpoint} {delay:.2f}s" for endpoint, delay in delays.items())
+          + f", respected: {respected}")
+    sys.exit(0 if respected else 1)
+
+
+if __name__ == "__main__":
+    main()
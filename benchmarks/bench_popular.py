@@ -0,0 +1,108 @@
+"""Téléchargements populaires : Space-Saving par tranche vs comptage exact.
+
+Génère --downloads téléchargements suivant une loi de Zipf (exposant --skew)
+sur --files fichiers, étalés sur --days jours, et les enregistre dans
+DownloadStats. Compare le top --top obtenu au comptage exact (rappel,
+erreur relative des comptes), puis mesure le débit d'enregistrement, la
+mémoire, la durée d'une sauvegarde, la taille du fichier et le coût d'un
+classement (menu « Populaires »).
+
+    python -m benchmarks.bench_popular --downloads 1000000 --files 100000
+"""
+import argparse
+import gc
+import itertools
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+from benchmarks.common import load_bot
+
+bot = load_bot()
+
+
+def zipf_stream(args):
+    # Rangs tirés par bisection sur la fonction de répartition cumulée
+    rng = random.Random(1)
+    weights = list(itertools.accumulate(1 / (rank + 1) ** args.skew for rank in range(args.files)))
+    ranks = rng.choices(range(args.files), cum_weights=weights, k=args.downloads)
+    cells = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES]
+    # Rangs mélangés : les fichiers populaires ne sont pas les premiers créés
+    keys = list(range(args.files))
+    rng.shuffle(keys)
+    now = time.time()
+    span = args.days * 86400
+    return [
+        (*cells[keys[rank] % len(cells)], keys[rank], now - span + span * i / args.downloads)
+        for i, rank in enumerate(ranks)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--downloads", type=int, default=500000)
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--skew", type=float, default=1.1, help="exposant de la loi de Zipf")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--top", type=int, default=bot.POPULAR_MENU_SIZE)
+    parser.add_argument("--capacity", type=int, default=bot.POPULAR_CAPACITY)
+    args = parser.parse_args()
+
+    stream = zipf_stream(args)
+    exact = Counter((cat, sub, key) for cat, sub, key, _ in stream)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "popular.bin"
+        # Durée mesurée hors tracemalloc, qui ralentit fortement les allocations
+        stats = bot.DownloadStats(path, capacity=args.capacity, window_days=args.days, shared=False)
+        started = time.perf_counter()
+        for cat, sub, key, when in stream:
+            stats.record(cat, sub, key, when)
+        record_s = time.perf_counter() - started
+        del stats
+        gc.collect()
+        tracemalloc.start()
+        stats = bot.DownloadStats(path, capacity=args.capacity, window_days=args.days, shared=False)
+        for cat, sub, key, when in stream:
+            stats.record(cat, sub, key, when)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        started = time.perf_counter()
+        stats.save()
+        save_s = time.perf_counter() - started
+        size = path.stat().st_size
+        started = time.perf_counter()
+        reloaded = bot.DownloadStats(path, capacity=args.capacity, window_days=args.days, shared=False)
+        load_s = time.perf_counter() - started
+
+        window = (args.days + 1) * 86400
+        started = time.perf_counter()
+        ranking, total = reloaded.top(window, args.top)
+        top_ms = (time.perf_counter() - started) * 1000
+
+    expected = exact.most_common(args.top)
+    found = {key for key, _, _ in ranking}
+    recall = len(found & {key for key, _ in expected}) / len(expected)
+    # Erreur relative du compte estimé pour les vrais populaires présents
+    errors = [abs(n - exact[key]) / exact[key] for key, n, _ in ranking]
+    bounded = all(exact[key] <= n <= exact[key] + error for key, n, error in ranking)
+    buckets = len(reloaded._buckets)
+
+    print(f"{args.downloads} downloads over {args.files} files (Zipf s={args.skew}), {args.days} days, "
+          f"{buckets} buckets x {args.capacity} counters")
+    print(f"  top {args.top} recall : {recall:.0%} (max relative error {max(errors, default=0):.1%}, "
+          f"bounds hold: {bounded})")
+    print(f"  total        : {total} (exact {len(stream)})")
+    print(f"  record       : {len(stream) / record_s:,.0f} downloads/s ({record_s / len(stream) * 1e6:.2f} µs each)")
+    print(f"  memory       : {memory / 1e6:.1f} MB (exact counter: {len(exact)} keys)")
+    print(f"  file         : {size / 1e3:.0f} kB, save {save_s * 1000:.0f} ms, load {load_s * 1000:.0f} ms")
+    print(f"  ranking      : {top_ms:.1f} ms (then cached {bot.POPULAR_REFRESH:.0f}s)")
+    sys.exit(0 if recall >= 0.9 and bounded and total == len(stream) else 1)
+
+
+if __name__ == "__main__":
+    main()
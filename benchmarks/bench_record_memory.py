@@ -0,0 +1,126 @@
+"""Mémoire du catalogue : dicts (ancien format) vs FileRecord vs colonnes.
+
+Mesure avec tracemalloc les octets par entrée d'une sous-catégorie chargée,
+le temps de chargement depuis le JSON et le coût d'une lecture, puis vérifie
+que FileRecord se resérialise à l'identique. La variante en colonnes (arrays
+par sous-catégorie) sert de point de comparaison.
+
+    python -m benchmarks.bench_record_memory --files 200000
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+from datetime import datetime, timedelta
+
+from benchmarks.common import load_bot
+
+bot = load_bot()
+UPLOADERS = ("Admin", "Konan", "Aya", "Moussa")
+FILE_TYPES = ("document", "photo", "video", "audio", "voice")
+
+
+def realistic_file(i, rng):
+    # Comme extract_file_data : date ISO avec microsecondes, file_unique_id
+    date = datetime(2024, 1, 1) + timedelta(seconds=i * 37, microseconds=rng.randrange(1, 10**6))
+    return {
+        "id": i,
+        "file_id": f"BQACAgQAAxkBAAI{i:012d}{rng.getrandbits(64):016x}AAHpZq3sDgABHgQ",
+        "file_unique_id": f"AgAD{i:010d}{rng.getrandbits(32):08x}",
+        "file_name": f"document_{i}_{rng.getrandbits(24):06x}.pdf",
+        "file_type": rng.choice(FILE_TYPES),
+        "date": date.isoformat(),
+        "uploader": rng.choice(UPLOADERS),
+    }
+
+
+class ColumnarCell:
+    # Une colonne par champ : arrays pour les entiers et les codes, listes
+    # pour les chaînes propres à chaque fichier
+    def __init__(self, files):
+        self.ids = array("q")
+        self.dates = array("q")
+        self.types = array("B")
+        self.uploaders = array("B")
+        self.file_ids, self.unique_ids, self.names = [], [], []
+        self.type_table, self.uploader_table = [], []
+        for file_data in files:
+            self.ids.append(file_data["id"])
+            self.dates.append(bot.pack_date(file_data["date"]))
+            self.types.append(self._code(self.type_table, file_data["file_type"]))
+            self.uploaders.append(self._code(self.uploader_table, file_data["uploader"]))
+            self.file_ids.append(file_data["file_id"])
+            self.unique_ids.append(file_data["file_unique_id"])
+            self.names.append(file_data["file_name"])
+
+    @staticmethod
+    def _code(table, value):
+        if value not in table:
+            table.append(value)
+        return table.index(value)
+
+    def get(self, position):
+        return {
+            "id": self.ids[position], "file_id": self.file_ids[position],
+            "file_unique_id": self.unique_ids[position], "file_name": self.names[position],
+            "file_type": self.type_table[self.types[position]], "date": bot.unpack_date(self.dates[position]),
+            "uploader": self.uploader_table[self.uploaders[position]],
+        }
+
+
+def measure(build):
+    # Durée mesurée hors tracemalloc, qui ralentit fortement les allocations
+    gc.collect()
+    started = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def read_cost(lookup, keys):
+    started = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    return (time.perf_counter() - started) / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    raw = json.dumps([realistic_file(i, rng) for i in range(args.files)]).encode()
+    keys = [rng.randrange(args.files) for _ in range(100000)]
+
+    dicts, dict_bytes, dict_s = measure(lambda: {f["id"]: f for f in json.loads(raw)})
+    records, record_bytes, record_s = measure(
+        lambda: {f["id"]: bot.FileRecord.from_dict(f) for f in json.loads(raw)}
+    )
+    columns, column_bytes, column_s = measure(lambda: ColumnarCell(json.loads(raw)))
+
+    lossless = all(records[k].to_dict() == dicts[k] for k in dicts)
+    print(f"{args.files} files, JSON {len(raw) / 1e6:.1f} MB, lossless round trip: {lossless}")
+    rows = (
+        ("dict", dict_bytes, dict_s, read_cost(lambda k: dicts[k]["file_name"], keys)),
+        ("FileRecord", record_bytes, record_s, read_cost(lambda k: records[k]["file_name"], keys)),
+        ("columnar", column_bytes, column_s, read_cost(lambda k: columns.get(k)["file_name"], keys)),
+    )
+    for name, size, elapsed, read_us in rows:
+        print(f"{name:>10}: {size / args.files:7.0f} B/entry ({size / 1e6:7.1f} MB)  "
+              f"load {elapsed:5.2f}s  read {read_us:5.2f} µs")
+    print(f"FileRecord saves {1 - record_bytes / dict_bytes:.0%}, columnar {1 - column_bytes / dict_bytes:.0%}")
+    sys.exit(0 if lossless else 1)
+
+
+if __name__ == "__main__":
+    main()
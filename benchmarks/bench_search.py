@@ -0,0 +1,85 @@
+"""Recherche plein texte : construction de l'index et latence des requêtes.
+
+Catalogue synthétique de noms français (accents, dates, numéros) ; les
+requêtes mélangent termes exacts, préfixes, accents omis et filtrage par
+les fichiers masqués d'un utilisateur.
+
+    python -m benchmarks.bench_search --entries 1000000
+"""
+import argparse
+import random
+import time
+import resource
+
+from benchmarks.common import load_bot, summarize
+
+bot = load_bot()
+
+WORDS = ["rapport", "facture", "réunion", "élève", "été", "contrat", "procès-verbal", "relevé",
+         "bulletin", "décembre", "février", "audition", "témoin", "enquête", "dossier", "pièce",
+         "écoute", "transcription", "géolocalisation", "analyse", "synthèse", "annexe", "résumé"]
+UPLOADERS = ["Admin", "Léon", "Inès", "Gaëlle", "Noël"]
+TYPES = ["document", "photo", "video", "audio", "voice"]
+CELLS = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES]
+QUERIES = ["reunion", "proces verbal", "rapp 2023", "enquete temoin", "facture 12",
+           "inès", "geoloc", "transcription audio", "synthese dec", "2024-03"]
+
+
+class CatalogStub:
+    def __init__(self, size, seed=1):
+        self.size = size
+        self.seed = seed
+
+    def iter_files(self):
+        rng = random.Random(self.seed)
+        for i in range(self.size):
+            cat, sub = CELLS[i % len(CELLS)]
+            words = " ".join(rng.sample(WORDS, 2))
+            yield cat, sub, {
+                "id": i // len(CELLS),
+                "file_name": f"{words} {rng.randrange(10000)}.pdf",
+                "file_type": rng.choice(TYPES),
+                "uploader": rng.choice(UPLOADERS),
+                "date": f"202{rng.randrange(5)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}T10:00:00",
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    catalog = CatalogStub(args.entries)
+    index = bot.SearchIndex()
+    before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    index.rebuild(catalog)
+    build_s = time.perf_counter() - started
+    # Pic RSS : inclut les dicts temporaires produits par le catalogue factice
+    grown_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before_kb) / 1024
+    print(f"{len(index)} entries indexed in {build_s:.1f}s, peak RSS +{grown_mb:.0f} MB")
+
+    # Un utilisateur qui a masqué 2000 fichiers
+    rng = random.Random(2)
+    for _ in range(2000):
+        cat, sub = rng.choice(CELLS)
+        bot.hidden_files.hide_file(42, cat, sub, rng.randrange(args.entries // len(CELLS)))
+
+    for query in QUERIES:
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = index.search(query, user_id=42)
+            samples.append(time.perf_counter() - started)
+        r = summarize(samples)
+        print(f"{query:>22}: {len(results):>2} results  p50 {r['p50_us'] / 1e3:>7.2f} ms  p99 {r['p99_us'] / 1e3:>7.2f} ms")
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.add("KF", "Documents", {"id": 10 ** 7 + i, "file_name": f"nouveau rapport {i}.pdf"})
+    print(f"incremental add: {(time.perf_counter() - started) / 1000 * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Plusieurs instances sur un même dossier (SHARED_STORAGE=1).
+
+Lance --workers processus qui ajoutent, suppriment, masquent et démasquent
+en parallèle dans le même répertoire, avec un journal volontairement petit
+pour forcer des compactions concurrentes. Chaque instance attend ensuite les
+autres, se synchronise et publie sa vue : toutes doivent être identiques
+entre elles, à un rechargement à froid et au résultat attendu (identifiants
+uniques, aucune écriture perdue). Affiche le débit d'écriture et le délai de
+propagation observé entre instances.
+
+    python -m benchmarks.bench_shared_storage --workers 4 --ops 2000
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import ROOT, synthetic_file
+
+CELLS = [("KF", "SMS"), ("KF", "Audio"), ("BELO", "Contacts"), ("SOULAN", "Vidéo")]
+HIDDEN_CELL = ("Filtres", "Autres")
+HIDDEN_USERS = [str(1000 + n) for n in range(5)]
+
+
+def shared_env(directory, journal_bytes):
+    return {
+        **os.environ,
+        "ADMIN_ID": "1",
+        "RENDER_STORAGE_PATH": str(directory),
+        "SHARED_STORAGE": "1",
+        "SHARED_POLL_INTERVAL": "0.05",
+        "JOURNAL_MAX_BYTES": str(journal_bytes),
+        "METRICS_ENABLED": "0",
+        "PYTHONPATH": str(ROOT),
+    }
+
+
+def catalog_view(bot):
+    return {
+        f"{cat}/{sub}": sorted((f["id"], f["file_name"]) for f in bot.storage.get_files(cat, sub))
+        for cat, sub in CELLS
+    }
+
+
+def hidden_view(bot):
+    return {user: sorted(bot.hidden_files.hidden_keys(user, *HIDDEN_CELL)) for user in HIDDEN_USERS}
+
+
+def worker(args):
+    from benchmarks.common import load_bot
+    bot = load_bot(args.dir)
+    rng = random.Random(args.worker)
+    remote = []
+    bot.storage.add_listener(lambda event, cat, sub, file_data: remote.append(event))
+
+    added, removed, hidden = [], 0, {}
+    started = time.perf_counter()
+    for i in range(args.ops):
+        roll = rng.random()
+        if roll < 0.7 or not added:
+            cat, sub = rng.choice(CELLS)
+            name = f"w{args.worker}_{i}.pdf"
+            file_key = bot.storage.add_file(cat, sub, {**synthetic_file(i), "file_name": name})
+            added.append((cat, sub, file_key))
+        elif roll < 0.8:
+            cat, sub, file_key = added.pop(rng.randrange(len(added)))
+            removed += bot.storage.remove_file(cat, sub, file_key)
+        else:
+            # Clés propres à l'instance : l'état final attendu ne dépend pas de l'ordre
+            user, file_key = rng.choice(HIDDEN_USERS), args.worker * 1_000_000 + rng.randrange(200)
+            if file_key in hidden.setdefault(user, set()):
+                bot.hidden_files.unhide_file(user, *HIDDEN_CELL, file_key)
+                hidden[user].discard(file_key)
+            else:
+                bot.hidden_files.hide_file(user, *HIDDEN_CELL, file_key)
+                hidden[user].add(file_key)
+    elapsed = time.perf_counter() - started
+    bot.persistence.flush()
+
+    # Propagation : une sonde écrite par le premier processus, attendue par les autres
+    probe_delay = None
+    if args.worker == 0:
+        (Path(args.dir) / "probe.ready").write_text(str(bot.storage.add_file("KF", "SMS", synthetic_file(-1))))
+    else:
+        while not (Path(args.dir) / "probe.ready").exists():
+            time.sleep(0.005)
+        probe_key = int((Path(args.dir) / "probe.ready").read_text())
+        seen = time.perf_counter()
+        while probe_key not in bot.storage.file_keys("KF", "SMS"):
+            time.sleep(0.005)
+        probe_delay = time.perf_counter() - seen
+
+    (Path(args.dir) / f"done.{args.worker}").touch()
+    while len(list(Path(args.dir).glob("done.*"))) < args.workers:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    bot.storage.sync()
+    bot.hidden_files.sync()
+    report = {
+        "ops_per_s": args.ops / elapsed,
+        "added": len(added) + removed,
+        "removed": removed,
+        "remote_events": len(remote),
+        "probe_delay_s": probe_delay,
+        "hidden": {user: sorted(keys) for user, keys in hidden.items()},
+        "catalog": catalog_view(bot),
+        "hidden_view": hidden_view(bot),
+    }
+    bot.shutdown_storage()
+    print(json.dumps(report))
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = shared_env(tmp, args.journal_bytes)
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.bench_shared_storage", "--worker", str(n),
+                 "--workers", str(args.workers), "--ops", str(args.ops), "--dir", tmp],
+                env=env, cwd=ROOT, stdout=subprocess.PIPE,
+            )
+            for n in range(args.workers)
+        ]
+        reports = [json.loads(p.communicate()[0].splitlines()[-1]) for p in processes]
+
+        # Rechargement à froid dans un processus neuf
+        cold = subprocess.run(
+            [sys.executable, "-c",
+             "import json, os, benchmarks.bench_shared_storage as b; from benchmarks.common import load_bot; "
+             "bot = load_bot(os.environ['RENDER_STORAGE_PATH']); print(json.dumps([b.catalog_view(bot), b.hidden_view(bot)]))"],
+            env=env, cwd=ROOT, capture_output=True, text=True, check=True,
+        )
+        cold_catalog, cold_hidden = json.loads(cold.stdout.splitlines()[-1])
+        snapshots = len(list(Path(tmp).glob("file_storage.snap")))
+
+    expected_files = sum(r["added"] - r["removed"] for r in reports) + 1
+    expected_hidden = {user: sorted(k for r in reports for k in r["hidden"].get(user, ())) for user in HIDDEN_USERS}
+    total = sum(len(files) for files in cold_catalog.values())
+    checks = {
+        "views identical": all(r["catalog"] == cold_catalog for r in reports),
+        "no lost writes": total == expected_files,
+        "unique ids": all(len({i for i, _ in files}) == len(files) for files in cold_catalog.values()),
+        "hidden merged": cold_hidden == expected_hidden and all(r["hidden_view"] == cold_hidden for r in reports),
+    }
+    delays = [r["probe_delay_s"] for r in reports if r["probe_delay_s"] is not None]
+    print(f"{args.workers} processes x {args.ops} ops, journal compacted at {args.journal_bytes} B "
+          f"(binary snapshot present: {bool(snapshots)})")
+    print(f"  writes   : {sum(r['ops_per_s'] for r in reports):.0f} ops/s total, "
+          f"{min(r['ops_per_s'] for r in reports):.0f}-{max(r['ops_per_s'] for r in reports):.0f} per process")
+    print(f"  remote   : {sum(r['remote_events'] for r in reports)} changes applied from other processes")
+    if delays:
+        print(f"  propagation: max {max(delays) * 1000:.0f} ms")
+    print(f"  catalog  : {total} files (expected {expected_files})")
+    for name, ok in checks.items():
+        print(f"  {name:<16}: {'ok' if ok else 'FAILED'}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--ops", type=int, default=2000, help="opérations par processus")
+    parser.add_argument("--journal-bytes", type=int, default=64 * 1024, help="seuil de compaction du journal")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker is not None:
+        worker(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Comparaison des moteurs de stockage JSON et SQLite.
+
+    python -m benchmarks.bench_storage_engines --sizes 10000 100000 1000000
+"""
+import argparse
+import gc
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.common import load_bot, summarize, synthetic_file
+
+bot = load_bot()
+
+CELLS = [(cat, sub) for cat in bot.MAIN_CATEGORIES for sub in bot.SUB_CATEGORIES]
+USERS = 50
+HIDDEN_PER_USER = 200
+
+
+def build_json(directory, size):
+    catalog = {cat: {sub: [] for sub in bot.SUB_CATEGORIES} for cat in bot.MAIN_CATEGORIES}
+    for i in range(size):
+        cat, sub = CELLS[i % len(CELLS)]
+        catalog[cat][sub].append(synthetic_file(i))
+    per_cell = size // len(CELLS)
+    rng = random.Random(1)
+    hidden = {}
+    for user in range(USERS):
+        for _ in range(HIDDEN_PER_USER):
+            cat, sub = rng.choice(CELLS)
+            hidden.setdefault(str(user), {}).setdefault(cat, {}).setdefault(sub, []).append(
+                rng.randrange(per_cell)
+            )
+    with open(directory / "file_storage.json", 'w') as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    with open(directory / "hidden_files.json", 'w') as f:
+        json.dump(hidden, f)
+    return per_cell
+
+
+def open_engine(engine, directory):
+    if engine == "json":
+        return (bot.FileStorage(directory / "file_storage.json"),
+                bot.HiddenFiles(directory / "hidden_files.json"))
+    return bot.SqliteFileStorage(directory / "konntek.db"), bot.SqliteHiddenFiles(directory / "konntek.db")
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def run(engine, directory, per_cell, repeat):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    storage, hidden = open_engine(engine, directory)
+    open_s = time.perf_counter() - started
+    resident_mb = tracemalloc.get_traced_memory()[0] / 1e6
+    tracemalloc.stop()
+
+    rng = random.Random(2)
+    results = {
+        "open_s": open_s,
+        "resident_mb": resident_mb,
+        "get_file": timed(lambda: storage.get_file(*rng.choice(CELLS), rng.randrange(per_cell)), repeat),
+        "get_files": timed(lambda: storage.get_files(*rng.choice(CELLS)), max(1, repeat // 20)),
+        "is_hidden": timed(
+            lambda: hidden.is_hidden(rng.randrange(USERS), *rng.choice(CELLS), rng.randrange(per_cell)),
+            repeat
+        ),
+        "add_file": timed(lambda: storage.add_file("KF", "Documents", synthetic_file(0)), repeat),
+    }
+    storage.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp)
+            per_cell = build_json(directory, size)
+            bot.migrate_json_to_sqlite(
+                directory / "file_storage.json", directory / "hidden_files.json", directory / "konntek.db"
+            )
+            print(f"\n== {size} entries ==")
+            for engine in ("json", "sqlite"):
+                r = run(engine, directory, per_cell, args.repeat)
+                print(f"{engine:>7}: open {r['open_s']:.3f}s, resident {r['resident_mb']:.1f} MB")
+                for op in ("get_file", "get_files", "is_hidden", "add_file"):
+                    print(f"{'':>9}{op:<10} mean {r[op]['mean_us']:>10.1f} µs  p99 {r[op]['p99_us']:>10.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
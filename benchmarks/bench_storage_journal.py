@@ -0,0 +1,58 @@
+"""Latence par mutation de FileStorage : réécriture complète vs journal.
+
+    python -m benchmarks.bench_storage_journal --sizes 1000 10000 50000
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import load_bot, summarize, synthetic_file
+
+bot = load_bot()
+
+
+def build_snapshot(path, size):
+    per_sub = max(1, size // (len(bot.MAIN_CATEGORIES) * len(bot.SUB_CATEGORIES)))
+    catalog = {cat: {sub: [] for sub in bot.SUB_CATEGORIES} for cat in bot.MAIN_CATEGORIES}
+    i = 0
+    for cat in bot.MAIN_CATEGORIES:
+        for sub in bot.SUB_CATEGORIES:
+            for _ in range(per_sub):
+                catalog[cat][sub].append(synthetic_file(i))
+                i += 1
+    with open(path, 'w') as f:
+        json.dump(catalog, f, ensure_ascii=False)
+
+
+def run(size, journal, mutations):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "file_storage.json"
+        build_snapshot(path, size)
+        storage = bot.FileStorage(path, journal=journal)
+        samples = []
+        for i in range(mutations):
+            started = time.perf_counter()
+            storage.add_file("KF", "Documents", synthetic_file(size + i))
+            samples.append(time.perf_counter() - started)
+        storage.close()
+        return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--mutations", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'entries':>10} {'mode':>8} {'mean µs':>12} {'p50 µs':>12} {'p99 µs':>12}")
+    for size in args.sizes:
+        for mode, journal in (("rewrite", False), ("journal", True)):
+            stats = run(size, journal, args.mutations)
+            print(f"{size:>10} {mode:>8} {stats['mean_us']:>12.1f} "
+                  f"{stats['p50_us']:>12.1f} {stats['p99_us']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Outils partagés par les scripts de benchmark.
+
+Le module ``bot`` lit sa configuration dans l'environnement au moment de
+l'import : on le redirige vers un répertoire temporaire avant de l'importer.
+"""
+import os
+import sys
+import statistics
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_bot(storage_dir=None):
+    storage_dir = storage_dir or tempfile.mkdtemp(prefix="konntek-bench-")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ["RENDER_STORAGE_PATH"] = str(storage_dir)
+    if str(ROOT) not in sys.path:
+        sys.path.insert(0, str(ROOT))
+    import bot
+    return bot
+
+
+def synthetic_file(i):
+    return {
+        "file_id": f"BQACAgQAAxkBAAI{i:012d}",
+        "file_name": f"document_{i}.pdf",
+        "file_type": "document",
+        "date": "2024-01-01T12:00:00.000000",
+        "uploader": "Admin",
+    }
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(samples):
+    return {
+        "mean_us": statistics.fmean(samples) * 1e6,
+        "p50_us": percentile(samples, 50) * 1e6,
+        "p99_us": percentile(samples, 99) * 1e6,
+    }
@@ -0,0 +1,147 @@
+"""Serveur factice de l'API Bot Telegram pour les tests de charge.
+
+Répond aux méthodes utilisées par le bot avec un délai configurable et
+enregistre l'instant de réception de chaque appel : le load test s'en sert
+pour mesurer la latence bout en bout (POST webhook -> answerCallbackQuery).
+Avec --limit-global / --limit-chat, il applique des limites de débit à la
+manière de Telegram et répond 429 avec retry_after au-delà.
+
+    python -m benchmarks.fake_bot_api --port 8081 --delay 0.03
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl
+
+import tornado.httputil
+import tornado.web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Konntek", "username": "konntek_bot"}
+
+
+def _message(params, message_id=1):
+    chat_id = int(params.get("chat_id", 1))
+    return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+
+
+class FakeBotAPI:
+    def __init__(self, delay=0.0, limit_global=None, limit_chat=None):
+        self.delay = delay
+        self.limit_global = limit_global
+        self.limit_chat = limit_chat
+        self.windows = defaultdict(deque)
+        self.rejected = 0
+        self.calls = defaultdict(int)
+        # callback_query_id -> instant de l'answerCallbackQuery
+        self.answered = {}
+        self.waiters = {}
+
+    def params(self, request):
+        content_type = request.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(request.body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            args = {}
+            tornado.httputil.parse_body_arguments(content_type, request.body, args, {})
+            return {k: v[0].decode() for k, v in args.items()}
+        return dict(parse_qsl(request.body.decode()))
+
+    def wait_answer(self, query_id):
+        future = asyncio.get_running_loop().create_future()
+        if query_id in self.answered:
+            future.set_result(self.answered[query_id])
+        else:
+            self.waiters[query_id] = future
+        return future
+
+    def over_limit(self, key, limit):
+        # Fenêtre glissante d'une seconde
+        now = time.monotonic()
+        window = self.windows[key]
+        while window and now - window[0] >= 1:
+            window.popleft()
+        if len(window) >= limit:
+            return True
+        window.append(now)
+        return False
+
+    def throttled(self, method, params):
+        # Comme Telegram : seuls les messages comptent, les envois par chat
+        if method.startswith("answer"):
+            return False
+        if self.limit_chat and method.startswith("send"):
+            if self.over_limit(("chat", params.get("chat_id")), self.limit_chat):
+                return True
+        return bool(self.limit_global) and self.over_limit("global", self.limit_global)
+
+    def record(self, method, params):
+        self.calls[method] += 1
+        if method == "answerCallbackQuery":
+            query_id = params.get("callback_query_id")
+            now = time.perf_counter()
+            self.answered[query_id] = now
+            future = self.waiters.pop(query_id, None)
+            if future and not future.done():
+                future.set_result(now)
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "sendDocument", "sendPhoto", "sendVideo", "sendAudio", "sendVoice"):
+            return _message(params)
+        if method == "sendMediaGroup":
+            count = len(json.loads(params.get("media", "[]")))
+            return [_message(params, i + 1) for i in range(count)]
+        if method == "getUpdates":
+            return []
+        return True
+
+    def make_app(self):
+        return tornado.web.Application([(r"/bot[^/]+/(\w+)", MethodHandler, {"api": self})])
+
+
+class MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    async def post(self, method):
+        params = self.api.params(self.request)
+        if self.api.delay:
+            await asyncio.sleep(self.api.delay)
+        self.set_header("Content-Type", "application/json")
+        if self.api.throttled(method, params):
+            self.api.rejected += 1
+            self.set_status(429)
+            self.write(json.dumps({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }))
+            return
+        self.api.record(method, params)
+        self.write(json.dumps({"ok": True, "result": self.api.result(method, params)}))
+
+    get = post
+
+
+async def serve(port, delay, limit_global, limit_chat):
+    api = FakeBotAPI(delay, limit_global, limit_chat)
+    api.make_app().listen(port)
+    print(f"Fake Bot API on http://127.0.0.1:{port}/bot (delay {delay * 1000:.0f} ms)")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--limit-global", type=int, help="requêtes/s acceptées au total")
+    parser.add_argument("--limit-chat", type=int, help="requêtes/s acceptées par chat")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.delay, args.limit_global, args.limit_chat))
+
+
+if __name__ == "__main__":
+    main()
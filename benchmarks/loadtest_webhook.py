@@ -0,0 +1,112 @@
+"""Test de charge du mode webhook contre le serveur factice de l'API Bot.
+
+Envoie des callback queries de --users utilisateurs en parallèle et mesure
+la latence POST webhook -> answerCallbackQuery ainsi que le débit, pour
+plusieurs niveaux de concurrence (1 = ancien traitement séquentiel).
+
+    python -m benchmarks.loadtest_webhook --updates 2000 --users 50 --delay 0.03
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:loadtest")
+
+import httpx
+
+from benchmarks.common import load_bot, percentile
+from benchmarks.fake_bot_api import FakeBotAPI
+
+bot = load_bot()
+CALLBACKS = ("cat_0", "back_to_main", "cat_1", "back_to_main")
+
+
+def callback_update(update_id, user_id):
+    user = {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": CALLBACKS[update_id % len(CALLBACKS)],
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Konntek"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+async def run(concurrency, args):
+    api = FakeBotAPI(args.delay)
+    api_server = api.make_app().listen(args.api_port)
+    bot.TELEGRAM_BASE_URL = f"http://127.0.0.1:{args.api_port}/bot"
+    bot.WEBHOOK_URL = f"http://127.0.0.1:{args.port}"
+    bot.MAX_CONCURRENT_UPDATES = concurrency
+    bot.PORT = args.port
+    bot.API_RATE_GLOBAL = args.api_rate
+    app = bot.build_application()
+    app.post_shutdown = None
+
+    stop = asyncio.Event()
+    runner = asyncio.create_task(bot.run_webhook(app, stop))
+    url = f"http://127.0.0.1:{args.port}/{bot.WEBHOOK_PATH}"
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.users)) as client:
+        for _ in range(100):
+            try:
+                await client.get(f"http://127.0.0.1:{args.port}/")
+                break
+            except httpx.ConnectError:
+                await asyncio.sleep(0.05)
+
+        latencies = []
+        next_id = iter(range(1, args.updates + 1))
+
+        async def user_loop(user_id):
+            # Chaque utilisateur clique dès que son clic précédent est acquitté
+            for update_id in next_id:
+                answered = api.wait_answer(str(update_id))
+                started = time.perf_counter()
+                await client.post(url, content=json.dumps(callback_update(update_id, user_id)),
+                                  headers={"Content-Type": "application/json"})
+                latencies.append(await answered - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_loop(1000 + u) for u in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+    stop.set()
+    await runner
+    api_server.stop()
+    return {
+        "updates_per_s": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.03, help="latence simulée de l'API Bot (s)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 32])
+    parser.add_argument("--api-rate", type=float, default=1000, help="limite d'envoi du bot (msg/s)")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--api-port", type=int, default=18081)
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        r = asyncio.run(run(concurrency, args))
+        print(f"concurrency {concurrency:>3}: {r['updates_per_s']:>8.1f} updates/s  "
+              f"p50 {r['p50_ms']:>7.1f} ms  p99 {r['p99_ms']:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,176 @@
 import os
 import json
+import asyncio
+import contextlib
+import fcntl
+import time
 import logging
-from datetime import datetime
+import logging.handlers
+import gzip
+import queue
+import random
+import threading
+import math
+import mmap
+import struct
+import functools
+import heapq
+import itertools
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+import shutil
+import signal
+import sqlite3
+import sys
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
 from pathlib import Path
+import tornado.httpserver
+import tornado.web
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultCachedAudio,
+    InlineQueryResultCachedDocument,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+    InlineQueryResultCachedVoice,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
     KeyboardButton,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove
 )
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
     ConversationHandler,
+    InlineQueryHandler,
     filters
 )
+from telegram.error import RetryAfter
 
 # Configuration Render.com
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 
+# Mode de réception des mises à jour : "polling" ou "webhook" (service web Render)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+PORT = int(os.getenv("PORT", "10000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+# URL alternative de l'API Bot (serveur factice pour les tests de charge)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+
+# Limites d'envoi vers l'API Bot (messages/s)
+API_RATE_GLOBAL = float(os.getenv("API_RATE_GLOBAL", "30"))
+API_RATE_PER_CHAT = float(os.getenv("API_RATE_PER_CHAT", "1"))
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", "5"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+
 # Chemin de stockage Render
-RENDER_STORAGE = Path("/opt/render/project/.render/storage")
+RENDER_STORAGE = Path(os.getenv("RENDER_STORAGE_PATH", "/opt/render/project/.render/storage"))
 RENDER_STORAGE.mkdir(exist_ok=True, parents=True)
 
 # Chemins des fichiers
 STORAGE_PATH = RENDER_STORAGE / "file_storage.json"
 HIDDEN_PATH = RENDER_STORAGE / "hidden_files.json"
+DB_PATH = RENDER_STORAGE / "konntek.db"
 LOG_FILE = RENDER_STORAGE / "bot_activity.log"
+ACTIVITY_LOG = RENDER_STORAGE / "activity.jsonl"
+BACKUP_DIR = RENDER_STORAGE / "backups"
+POPULAR_PATH = RENDER_STORAGE / "popular.bin"
+LOCATION_DIR = RENDER_STORAGE / "locations"
+
+# Rotation des journaux (taille ou échéance, archives gzip)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "14"))
+# Métriques Prometheus (/metrics) et instrumentation des handlers
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+# Échantillonnage des événements fréquents, ex. "DOWNLOAD=0.1,SEARCH=0.5"
+ACTIVITY_SAMPLING = {
+    action.strip().upper(): float(rate)
+    for action, rate in (item.split("=") for item in os.getenv("ACTIVITY_SAMPLING", "").split(",") if "=" in item)
+}
+
+# Journal d'écriture du catalogue (append-only) et seuils de compaction
+STORAGE_JOURNAL = os.getenv("STORAGE_JOURNAL", "1") != "0"
+JOURNAL_MAX_BYTES = int(os.getenv("JOURNAL_MAX_BYTES", str(4 * 1024 * 1024)))
+JOURNAL_MAX_AGE = int(os.getenv("JOURNAL_MAX_AGE", "900"))
+SNAPSHOT_VERSION = 3
+# Format du snapshot écrit à la compaction : "binary" (mmap, sous-catégories
+# chargées à la première consultation) ou "json" (format d'import/export)
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "binary").lower()
+
+# Moteur de stockage : "json" (fichiers + journal) ou "sqlite" (WAL, index)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+
+# Plusieurs instances sur le même dossier (webhook derrière un répartiteur) :
+# écritures sérialisées par flock, journal commun relu toutes les
+# SHARED_POLL_INTERVAL secondes pour invalider les caches locaux
+SHARED_STORAGE = os.getenv("SHARED_STORAGE", "0") == "1"
+SHARED_POLL_INTERVAL = float(os.getenv("SHARED_POLL_INTERVAL", "1.0"))
+
+# Sauvegardes /export (JSON lines gzip) : nombre gardé sur le serveur,
+# niveau de compression, lignes par lot à la restauration
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "5"))
+BACKUP_COMPRESSION = int(os.getenv("BACKUP_COMPRESSION", "6"))
+BACKUP_CHUNK = 10000
+BACKUP_VERSION = 1
+BACKUP_PROGRESS_INTERVAL = 3.0
+# Limites de l'API Bot : envoi d'un document, téléchargement par getFile
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+
+# Fenêtre de regroupement des écritures (secondes)
+PERSIST_WINDOW = float(os.getenv("PERSIST_WINDOW", "0.05"))
+
+# Pagination des menus de fichiers
+FILE_PAGE_SIZE = int(os.getenv("FILE_PAGE_SIZE", "10"))
+# Taille maximale d'un album Telegram
+MEDIA_GROUP_SIZE = 10
+# Silence (s) après le dernier message d'un album avant de l'enregistrer
+ALBUM_WINDOW = 1.0
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", "1024"))
+MARKUP_CACHE_SIZE = int(os.getenv("MARKUP_CACHE_SIZE", "2048"))
+MENU_CACHE_SIZE = int(os.getenv("MENU_CACHE_SIZE", "256"))
+# Téléchargements populaires : tranches de POPULAR_BUCKET secondes gardées
+# POPULAR_WINDOW_DAYS jours, POPULAR_CAPACITY compteurs par tranche
+POPULAR_BUCKET = int(os.getenv("POPULAR_BUCKET", "3600"))
+POPULAR_WINDOW_DAYS = int(os.getenv("POPULAR_WINDOW_DAYS", "7"))
+POPULAR_CAPACITY = int(os.getenv("POPULAR_CAPACITY", "256"))
+POPULAR_SAVE_INTERVAL = float(os.getenv("POPULAR_SAVE_INTERVAL", "300"))
+POPULAR_MENU_SIZE = int(os.getenv("POPULAR_MENU_SIZE", "10"))
+POPULAR_MENU_DAYS = 7
+POPULAR_REFRESH = 60.0
+# Positions partagées : conservation, maille de l'index spatial, rayon par
+# défaut des recherches et intervalle minimal entre deux points enregistrés
+# d'une position en direct (la dernière position reste toujours à jour)
+LOCATION_RETENTION_DAYS = int(os.getenv("LOCATION_RETENTION_DAYS", "30"))
+LOCATION_GRID_KM = float(os.getenv("LOCATION_GRID_KM", "5"))
+LOCATION_NEARBY_KM = float(os.getenv("LOCATION_NEARBY_KM", "10"))
+LOCATION_MIN_INTERVAL = float(os.getenv("LOCATION_MIN_INTERVAL", "5"))
+LOCATION_REPORT_SIZE = 20
+# Doublons à l'upload : "reject" (refus), "link" (un seul exemplaire par
+# sous-catégorie, renvoi vers l'original ailleurs) ou "allow"
+DUPLICATE_POLICY = os.getenv("DUPLICATE_POLICY", "reject").lower()
 
 # Catégories
 MAIN_CATEGORIES = ["KF", "BELO", "SOULAN", "KFClone", "Filtres", "Géolocalisation"]
+GEO_CATEGORY = "Géolocalisation"
 SUB_CATEGORIES = ["SMS", "Contacts", "Historiques appels", "iMessenger", 
                  "Facebook Messenger", "Audio", "Vidéo", "Documents", "Autres"]
 
@@ -43,67 +178,1332 @@ SUB_CATEGORIES = ["SMS", "Contacts", "Historiques appels", "iMessenger",
 SELECTING_CATEGORY, SELECTING_SUBCATEGORY, CONFIRMING_DELETE, VIEWING_HIDDEN = range(4)
 
 # Configuration du logging
-logging.basicConfig(
-    filename=LOG_FILE,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+class CompressedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    # Rotation à l'échéance ou dès max_bytes, archives compressées en gzip.
+    # Chaque archive d'une période reçoit un numéro sur 4 chiffres, croissant et
+    # jamais réutilisé : le tri lexical de getFilesToDelete suit l'ordre des
+    # rotations, la rétention supprime bien les plus anciennes.
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, when=LOG_ROTATE_WHEN, backup_count=LOG_BACKUPS):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding="utf-8")
+        self.max_bytes = max_bytes
+        self.namer = self._archive_name
+        self.rotator = self._compress
+    
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+    
+    @staticmethod
+    def _archive_name(name):
+        directory, base = os.path.split(name)
+        pattern = re.compile(re.escape(base) + r"\.(\d+)\.gz$")
+        numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(directory or ".")) if m]
+        return f"{name}.{max(numbers, default=0) + 1:04d}.gz"
+    
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        event = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds")}
+        event.update(record.activity)
+        return json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+
+# Les appels de logging ne font que déposer l'enregistrement dans une file :
+# écriture disque et rotation se font dans le thread du listener
+log_queue = queue.SimpleQueue()
+
+app_log_handler = CompressedRotatingFileHandler(LOG_FILE)
+app_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+app_log_handler.addFilter(lambda record: not hasattr(record, "activity"))
+activity_handler = CompressedRotatingFileHandler(ACTIVITY_LOG)
+activity_handler.setFormatter(JsonLinesFormatter())
+activity_handler.addFilter(lambda record: hasattr(record, "activity"))
+
+log_listener = logging.handlers.QueueListener(log_queue, app_log_handler, activity_handler)
+log_listener.start()
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Même le formatage est laissé au listener : l'appelant ne paie que l'enfilage
+    def prepare(self, record):
+        return record
+
+logging.basicConfig(handlers=[DeferredQueueHandler(log_queue)], level=logging.INFO)
 logger = logging.getLogger(__name__)
+activity_logger = logging.getLogger("activity")
 logger.info("=== BOT STARTED ===")
 
+# Métriques au format d'exposition Prometheus, sans dépendance externe
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+class HistogramSeries:
+    # Chaque série n'est alimentée que par un seul thread (boucle asyncio ou
+    # thread de persistance) : pas de verrou sur le chemin chaud
+    __slots__ = ("buckets", "counts", "total", "n")
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.n = 0
+    
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.n += 1
+
+class Histogram:
+    # Une série par combinaison de labels ; labels() la renvoie pour que les
+    # chemins chauds la gardent sous la main
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def labels(self, **labels):
+        key = tuple(labels.items())
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, HistogramSeries(self.buckets))
+        return series
+    
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(s.counts), s.total, s.n) for key, s in self._series.items()]
+        for key, counts, total, n in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {n}")
+        return lines
+
+class MetricCounter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"] + [
+            f"{self.name}{_format_labels(key)} {value}" for key, value in values
+        ]
+
+class Gauge:
+    # Valeur calculée à la lecture : fn() renvoie un nombre ou {labels: valeur}
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+    
+    def render(self):
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"] + [
+            f"{self.name}{_format_labels(key)} {v}" for key, v in items
+        ]
+
+class Metrics:
+    def __init__(self):
+        self._metrics = {}
+    
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+    
+    def counter(self, name, help_text):
+        return self._register(MetricCounter(name, help_text))
+    
+    def gauge(self, name, help_text, fn):
+        return self._register(Gauge(name, help_text, fn))
+    
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Metric {metric.name} failed: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+handler_seconds = metrics.histogram("konntek_handler_seconds", "Durée des handlers Telegram")
+handler_errors = metrics.counter("konntek_handler_errors_total", "Exceptions sorties des handlers")
+flush_seconds = metrics.histogram("konntek_storage_flush_seconds", "Durée des écritures disque par opération")
+api_seconds = metrics.histogram("konntek_telegram_api_seconds", "Durée des appels à l'API Bot")
+api_wait_seconds = metrics.histogram("konntek_telegram_api_wait_seconds", "Attente dans le limiteur de débit")
+api_errors = metrics.counter("konntek_telegram_api_errors_total", "Appels à l'API Bot en erreur")
+sync_records = metrics.counter("konntek_shared_sync_total", "Changements appliqués depuis les autres instances")
+
+# Écritures disque hors de la boucle asyncio
+class PersistenceWorker:
+    # Thread unique propriétaire des écritures : les marques "dirty" reçues
+    # pendant la fenêtre PERSIST_WINDOW sont regroupées en un seul flush.
+    def __init__(self, window=PERSIST_WINDOW):
+        self.window = window
+        self._cond = threading.Condition()
+        self._operations = deque()
+        self._dirty = {}
+        self._generation = 0
+        self._flushed = 0
+        self._deadline = None
+        self._urgent = False
+        self._stopping = False
+        self._waiters = []
+        self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self._thread.start()
+    
+    def mark_dirty(self, key, flush):
+        with self._cond:
+            self._dirty[key] = flush
+            self._schedule()
+    
+    def submit(self, operation):
+        with self._cond:
+            self._operations.append(operation)
+            self._schedule()
+    
+    def _schedule(self):
+        self._generation += 1
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.window
+        self._cond.notify()
+    
+    async def durable(self):
+        # Barrière : rend la main quand tout ce qui a été demandé avant l'appel est sur disque
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self._flushed >= self._generation:
+                return
+            self._waiters.append((self._generation, loop, future))
+            self._urgent = True
+            self._cond.notify()
+        await future
+    
+    def flush(self):
+        with self._cond:
+            target = self._generation
+            self._urgent = True
+            self._cond.notify()
+            while self._flushed < target and self._thread.is_alive():
+                self._cond.wait()
+    
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and self._flushed == self._generation:
+                    self._cond.wait()
+                while not (self._stopping or self._urgent):
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopping and self._flushed == self._generation:
+                    return
+                target = self._generation
+                operations, self._operations = self._operations, deque()
+                dirty, self._dirty = self._dirty, {}
+                self._deadline = None
+                self._urgent = False
+            
+            error = None
+            for operation in list(operations) + list(dirty.values()):
+                started = time.perf_counter()
+                try:
+                    operation()
+                except Exception as e:
+                    logger.error(f"Persistence error: {str(e)}")
+                    error = error or e
+                name = getattr(getattr(operation, "func", operation), "__qualname__", "operation")
+                flush_seconds.observe(time.perf_counter() - started, operation=name)
+            
+            with self._cond:
+                self._flushed = target
+                waiters = [w for w in self._waiters if w[0] <= target]
+                self._waiters = [w for w in self._waiters if w[0] > target]
+                self._cond.notify_all()
+            for _, loop, future in waiters:
+                loop.call_soon_threadsafe(self._resolve, future, error)
+    
+    @staticmethod
+    def _resolve(future, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+
+# Verrou exclusif (ou partagé en lecture) entre processus, par flock sur un
+# fichier voisin des données. Réentrant : seul le premier niveau pose le flock,
+# les threads du processus étant sérialisés par le verrou interne.
+class ProcessLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.RLock()
+        self._depth = 0
+    
+    @contextlib.contextmanager
+    def hold(self, shared=False):
+        with self._lock:
+            if not self._depth:
+                fcntl.flock(self._file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+    
+    def close(self):
+        self._file.close()
+
+# Abonnements aux modifications du catalogue (index, caches, masquages)
+class CatalogEvents:
+    _listeners = ()
+    
+    def add_listener(self, listener):
+        self._listeners = [*self._listeners, listener]
+    
+    def _notify(self, event, *args):
+        for listener in self._listeners:
+            try:
+                listener(event, *args)
+            except Exception as e:
+                logger.error(f"Catalog listener error: {str(e)}")
+    
+    def _publish(self):
+        # Changements lus depuis les autres instances, notifiés hors des verrous
+        with self._lock:
+            changes, self._unpublished = self._unpublished, []
+        for change in changes:
+            self._notify(*change)
+        if changes:
+            sync_records.inc(len(changes), store=type(self).__name__)
+
+# Entrée du catalogue : attributs fixes au lieu d'un dict par fichier. Elle se
+# lit comme un dict (record["file_name"], .get, **record) et se resérialise à
+# l'identique : un attribut absent n'est pas défini, les clés inconnues vont
+# dans `extra`. La date est gardée en microsecondes quand l'ISO se reconstruit
+# tel quel, file_type et uploader sont internés.
+DATE_EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{6})?")
+
+def pack_date(value):
+    # Seules les dates que isoformat() reproduit à l'identique sont converties
+    if type(value) is not str:
+        return value
+    match = ISO_DATE_RE.fullmatch(value)
+    if match is None:
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if bool(match.group(1)) != bool(moment.microsecond):
+        return value
+    return (moment - DATE_EPOCH) // ONE_MICROSECOND
+
+def unpack_date(value):
+    if type(value) is int:
+        return (DATE_EPOCH + timedelta(microseconds=value)).isoformat()
+    return value
+
+class FileRecord:
+    FIELDS = ("id", "file_id", "file_unique_id", "file_name", "file_type", "date", "uploader", "file_size")
+    INTERNED = frozenset(("file_type", "uploader"))
+    __slots__ = FIELDS + ("extra",)
+    
+    @classmethod
+    def from_dict(cls, file_data):
+        record = cls()
+        extra = None
+        for key, value in file_data.items():
+            if key not in RECORD_FIELDS:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+                continue
+            if key == "date":
+                value = pack_date(value)
+            elif key in cls.INTERNED and type(value) is str:
+                value = sys.intern(value)
+            setattr(record, key, value)
+        record.extra = extra
+        return record
+    
+    def __getitem__(self, key):
+        if key in RECORD_FIELDS:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+            return unpack_date(value) if key == "date" else value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __contains__(self, key):
+        if key in RECORD_FIELDS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+    
+    def keys(self):
+        keys = [key for key in self.FIELDS if hasattr(self, key)]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+    
+    def to_dict(self):
+        return dict(self.items())
+    
+    def __repr__(self):
+        return f"FileRecord({self.to_dict()!r})"
+
+RECORD_FIELDS = frozenset(FileRecord.FIELDS)
+
+# Snapshot binaire : les fichiers de chaque sous-catégorie en JSON compact,
+# bout à bout, puis l'index des positions et un pied de taille fixe. Le
+# fichier est projeté en mémoire et une sous-catégorie n'est décodée qu'à
+# sa première consultation.
+SNAPSHOT_MAGIC = b"KNTKSNAP"
+SNAPSHOT_TRAILER = struct.Struct("<HQQI8s")
+
+class SnapshotCell:
+    # Sous-catégorie pas encore chargée : emplacement de ses fichiers dans le
+    # snapshot, dont elle garde le mmap (un rechargement en ouvre un autre)
+    __slots__ = ("snapshot", "offset", "length", "count")
+    
+    def __init__(self, snapshot, offset, length, count):
+        self.snapshot = snapshot
+        self.offset = offset
+        self.length = length
+        self.count = count
+    
+    def raw(self):
+        return self.snapshot[self.offset:self.offset + self.length]
+
+class SnapshotWriter:
+    # Snapshot binaire écrit en flux : les sous-catégories à la suite (tableaux
+    # JSON, recopiés tels quels ou fichier par fichier), puis l'index et le trailer
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._index = []
+        self._written = set()
+        self._cell = None
+        self._start = 0
+        self._count = 0
+        self.max_ids = {}
+    
+    def write_cell(self, category, subcategory, blob, count):
+        self._end_cell()
+        self._index.append([category, subcategory, count, self._file.tell(), len(blob)])
+        self._file.write(blob)
+    
+    def add(self, category, subcategory, file_data):
+        if self._cell != (category, subcategory):
+            self._end_cell()
+            if (category, subcategory) in self._written:
+                raise ValueError(f"{category}/{subcategory} is not contiguous")
+            self._cell, self._start, self._count = (category, subcategory), self._file.tell(), 0
+            self._file.write(b"[")
+        elif self._count:
+            self._file.write(b",")
+        self._file.write(json.dumps(file_data, ensure_ascii=False, separators=(',', ':'),
+                                    default=FileRecord.to_dict).encode('utf-8'))
+        self._count += 1
+        key = (category, subcategory)
+        self.max_ids[key] = max(self.max_ids.get(key, -1), file_data["id"])
+    
+    def _end_cell(self):
+        if self._cell is None:
+            return
+        self._file.write(b"]")
+        self._index.append([*self._cell, self._count, self._start, self._file.tell() - self._start])
+        self._written.add(self._cell)
+        self._cell = None
+    
+    def finish(self, seq, next_ids):
+        self._end_cell()
+        index_offset = self._file.tell()
+        raw_index = json.dumps({"next_ids": next_ids, "cells": self._index}, ensure_ascii=False).encode('utf-8')
+        self._file.write(raw_index)
+        self._file.write(SNAPSHOT_TRAILER.pack(SNAPSHOT_VERSION, seq, index_offset, len(raw_index), SNAPSHOT_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+    
+    def discard(self):
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
 # Gestion de la base de données
-class FileStorage:
-    def __init__(self, storage_path):
+class FileStorage(CatalogEvents):
+    # Mode journal : chaque mutation ajoute une ligne compacte au journal,
+    # la compaction replie périodiquement le journal dans le snapshot JSON.
+    # Chaque fichier porte un identifiant stable, unique dans sa sous-catégorie
+    # et jamais réutilisé ; data[cat][sub] est un dict {id: fichier} qui
+    # conserve l'ordre d'upload, ou une SnapshotCell tant qu'elle n'a pas été lue.
+    # Mode partagé : plusieurs processus sur le même dossier. Chaque mutation
+    # prend le verrou inter-processus, rattrape d'abord le journal commun (les
+    # enregistrements des autres instances sont appliqués et notifiés), puis y
+    # écrit immédiatement ; une compaction à la fois, toutes instances confondues.
+    def __init__(self, storage_path, journal=STORAGE_JOURNAL, persistence=None, snapshot_format=SNAPSHOT_FORMAT,
+                 shared=SHARED_STORAGE):
         self.storage_path = storage_path
-        self.data = self.load_data()
-        logger.info("Storage initialized")
+        self.snapshot_path = storage_path.with_suffix(".snap")
+        self.snapshot_format = snapshot_format
+        self.journal_enabled = journal
+        self.persistence = persistence
+        self.journal_path = storage_path.with_suffix(".journal")
+        self.rotated_journal_path = Path(f"{self.journal_path}.old")
+        self.shared = shared and journal
+        self._process_lock = ProcessLock(storage_path.with_suffix(".lock")) if self.shared else None
+        self._compaction_lock = open(storage_path.with_suffix(".compact.lock"), 'a') if self.shared else None
+        self._lock = threading.RLock()
+        self._seq = 0
+        self._next_ids = {}
+        self._needs_migration = False
+        self._journal = None
+        self._pending = []
+        self._journal_bytes = 0
+        self._journal_started = None
+        self._compaction = None
+        self._map = None
+        self._loaded_from = None
+        self._feed_inode = None
+        self._feed_offset = 0
+        self._replay_gap = False
+        self._unpublished = []
+        with self._lock, self._exclusive():
+            self.data = self._load_consistent()
+            self.migrated = self._needs_migration
+            if self.journal_enabled:
+                self._open_journal()
+            if self._needs_migration:
+                self.save_data()
+                logger.info("Storage migrated to stable file IDs")
+            elif self.journal_enabled and self.snapshot_format == "binary" and self._loaded_from == self.storage_path:
+                # Import d'un snapshot JSON : converti tout de suite pour les prochains démarrages
+                self.compact()
+            elif self.journal_enabled:
+                self._maybe_compact()
+        logger.info("Storage initialized" + (" (shared)" if self.shared else ""))
+    
+    def _exclusive(self):
+        return self._process_lock.hold() if self.shared else contextlib.nullcontext()
+    
+    @contextlib.contextmanager
+    def _writing(self):
+        # Toute mutation passe par ici : en mode partagé, le journal commun est
+        # rattrapé sous le verrou inter-processus avant d'attribuer ids et seq
+        with self._lock, self._exclusive():
+            if self.shared:
+                self._catch_up()
+            yield
+    
+    def _newest_snapshot(self):
+        # Le plus récent des deux formats fait foi : déposer un JSON plus récent l'importe
+        existing = [path for path in (self.snapshot_path, self.storage_path) if path.exists()]
+        return max(existing, key=lambda path: path.stat().st_mtime_ns, default=None)
     
     def load_data(self):
+        if self._newest_snapshot() == self.snapshot_path:
+            try:
+                data = self._open_binary_snapshot()
+            except Exception as e:
+                logger.error(f"Binary snapshot load error: {str(e)}")
+            else:
+                self._loaded_from = self.snapshot_path
+                if self.journal_enabled:
+                    self._replay_journal(lambda record: self._apply(data, record))
+                return data
+        
+        catalog, version, next_ids = None, SNAPSHOT_VERSION, {}
         try:
             if self.storage_path.exists():
                 with open(self.storage_path, 'r') as f:
-                    return json.load(f)
-            logger.info("Creating new storage file")
+                    catalog, version, self._seq, next_ids = self._unwrap_snapshot(json.load(f))
+                self._loaded_from = self.storage_path
+            else:
+                logger.info("Creating new storage file")
         except Exception as e:
             logger.error(f"Storage load error: {str(e)}")
         
-        return {cat: {sub: [] for sub in SUB_CATEGORIES} for cat in MAIN_CATEGORIES}
+        if catalog is None:
+            catalog = {cat: {sub: [] for sub in SUB_CATEGORIES} for cat in MAIN_CATEGORIES}
+        
+        # Ancien format : le journal adresse les fichiers par position
+        legacy = version < SNAPSHOT_VERSION
+        if legacy and self.journal_enabled:
+            self._replay_journal(lambda record: self._apply_positional(catalog, record))
+        
+        data = {}
+        for cat, subs in catalog.items():
+            cat = sys.intern(cat)
+            data[cat] = {}
+            for sub, files in subs.items():
+                sub = sys.intern(sub)
+                data[cat][sub], next_id = self._index_files(files)
+                self._next_ids[(cat, sub)] = max(next_id, next_ids.get(cat, {}).get(sub, 0))
+                if len(files) and legacy:
+                    self._needs_migration = True
+        
+        if not legacy and self.journal_enabled:
+            self._replay_journal(lambda record: self._apply(data, record))
+        return data
+    
+    def _open_binary_snapshot(self):
+        with open(self.snapshot_path, 'rb') as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            version, seq, index_offset, index_length, magic = SNAPSHOT_TRAILER.unpack(
+                snapshot[-SNAPSHOT_TRAILER.size:]
+            )
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError(f"unsupported snapshot (version {version})")
+            index = json.loads(snapshot[index_offset:index_offset + index_length])
+        except Exception:
+            snapshot.close()
+            raise
+        
+        # Seul l'index est lu : les fichiers restent dans le mmap
+        data = {}
+        for category, subcategory, count, offset, length in index["cells"]:
+            category, subcategory = sys.intern(category), sys.intern(subcategory)
+            data.setdefault(category, {})[subcategory] = SnapshotCell(snapshot, offset, length, count) if count else {}
+        for category, subs in index["next_ids"].items():
+            for subcategory, next_id in subs.items():
+                self._next_ids[(category, subcategory)] = next_id
+        self._seq = seq
+        self._map = snapshot
+        logger.info(f"Binary snapshot opened: {len(index['cells'])} subcategories (seq {seq})")
+        return data
+    
+    @staticmethod
+    def _decode(cell):
+        return json.loads(cell.raw())
+    
+    def _materialize(self, data, category, subcategory):
+        files = data[category][subcategory]
+        if type(files) is SnapshotCell:
+            files = data[category][subcategory] = {
+                f["id"]: FileRecord.from_dict(f) for f in self._decode(files)
+            }
+        return files
+    
+    def _files(self, category, subcategory):
+        files = self.data.get(category, {}).get(subcategory, {})
+        if type(files) is SnapshotCell:
+            with self._lock:
+                files = self._materialize(self.data, category, subcategory)
+        return files
+    
+    @staticmethod
+    def _unwrap_snapshot(raw):
+        # Ancien format : le catalogue brut, sans numéro de séquence
+        if isinstance(raw, dict) and isinstance(raw.get("version"), int) and "catalog" in raw:
+            return raw["catalog"], raw["version"], raw.get("seq", 0), raw.get("next_ids", {})
+        return raw, 0, 0, {}
+    
+    @staticmethod
+    def _index_files(files):
+        # Migration : un fichier sans identifiant reçoit son ancienne position,
+        # ce qui conserve les index déjà enregistrés dans hidden_files.json
+        used = {f["id"] for f in files if "id" in f}
+        next_id = max(used, default=-1) + 1
+        indexed = {}
+        for position, file_data in enumerate(files):
+            if "id" not in file_data:
+                if position in used:
+                    file_id, next_id = next_id, next_id + 1
+                else:
+                    file_id = position
+                used.add(file_id)
+                file_data = {"id": file_id, **file_data}
+            indexed[file_data["id"]] = FileRecord.from_dict(file_data)
+        return indexed, max(next_id, max(used, default=-1) + 1)
+    
+    def _next_ids_payload(self):
+        next_ids = {}
+        for (cat, sub), next_id in self._next_ids.items():
+            next_ids.setdefault(cat, {})[sub] = next_id
+        return next_ids
+    
+    def _snapshot_payload(self, catalog, seq):
+        return {"version": SNAPSHOT_VERSION, "seq": seq, "next_ids": self._next_ids_payload(), "catalog": catalog}
+    
+    def _replay_journal(self, apply):
+        replayed = 0
+        for path in (self.rotated_journal_path, self.journal_path):
+            if not path.exists():
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Dernière ligne tronquée par un arrêt brutal
+                        logger.warning(f"Truncated journal record ignored in {path.name}")
+                        break
+                    # Les enregistrements déjà repliés dans le snapshot sont ignorés
+                    if record["seq"] <= self._seq:
+                        continue
+                    # Marqueur "base" : tout ce qui le précède est dans un snapshot plus récent
+                    if record["op"] == "base" or record["seq"] != self._seq + 1:
+                        self._replay_gap = True
+                    apply(record)
+                    self._seq = record["seq"]
+                    replayed += 1
+        if replayed:
+            logger.info(f"Journal replayed: {replayed} record(s)")
+    
+    @staticmethod
+    def _apply_positional(catalog, record):
+        category, subcategory = record["c"], record["s"]
+        if record["op"] == "add":
+            if category not in catalog:
+                catalog[category] = {sub: [] for sub in SUB_CATEGORIES}
+            catalog[category].setdefault(subcategory, []).append(record["file"])
+        elif record["op"] == "del":
+            files = catalog.get(category, {}).get(subcategory, [])
+            if 0 <= record["i"] < len(files):
+                del files[record["i"]]
+    
+    def _apply(self, data, record):
+        if record["op"] in ("restore", "base"):
+            return
+        category, subcategory = record["c"], record["s"]
+        key = (category, subcategory)
+        if record["op"] == "add":
+            file_data = record["file"]
+            if "id" not in file_data:
+                file_data = {"id": self._next_ids.get(key, 0), **file_data}
+            if category not in data:
+                data[category] = {sub: {} for sub in SUB_CATEGORIES}
+            data[category].setdefault(subcategory, {})
+            self._materialize(data, category, subcategory)[file_data["id"]] = FileRecord.from_dict(file_data)
+            self._next_ids[key] = max(self._next_ids.get(key, 0), file_data["id"] + 1)
+        elif record["op"] == "del":
+            if subcategory not in data.get(category, {}):
+                return
+            files = self._materialize(data, category, subcategory)
+            if "id" in record:
+                files.pop(record["id"], None)
+            elif 0 <= record["i"] < len(files):
+                # Ancien enregistrement positionnel sans snapshot associé
+                del files[list(files)[record["i"]]]
+    
+    def _open_journal(self):
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_bytes = self.journal_path.stat().st_size
+        if self.shared:
+            self._follow_journal()
+        if self.rotated_journal_path.exists():
+            self._journal_bytes += self.rotated_journal_path.stat().st_size
+        self._journal_started = time.monotonic() if self._journal_bytes else None
+    
+    def _follow_journal(self):
+        # Position de lecture du journal commun : tout ce qui précède est appliqué
+        stat = os.fstat(self._journal.fileno())
+        self._feed_inode, self._feed_offset = stat.st_ino, stat.st_size
+        self._journal_bytes = stat.st_size
+    
+    def _catch_up(self):
+        # Appelé sous le verrou inter-processus (partagé ou exclusif) : applique
+        # les enregistrements ajoutés par les autres instances depuis la dernière
+        # lecture. Si le journal a tourné, la fin de l'ancien est lue dans .old.
+        try:
+            inode = os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        sources = [(self.journal_path, self._feed_offset if inode == self._feed_inode else 0)]
+        if inode != self._feed_inode:
+            try:
+                if os.stat(self.rotated_journal_path).st_ino == self._feed_inode:
+                    sources.insert(0, (self.rotated_journal_path, self._feed_offset))
+            except FileNotFoundError:
+                pass
+        
+        records = []
+        for path, offset in sources:
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    chunk = f.read()
+            except FileNotFoundError:
+                chunk = b""
+            # Une ligne incomplète (écrivain interrompu) sera relue au prochain passage
+            chunk = chunk[:chunk.rfind(b"\n") + 1]
+            for line in chunk.splitlines():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Corrupt journal record ignored in {path.name}")
+            self._feed_offset = offset + len(chunk)
+        self._feed_inode = inode
+        
+        for record in records:
+            if record["seq"] <= self._seq:
+                continue
+            if record["op"] == "base" or record["seq"] != self._seq + 1:
+                # Des enregistrements ont déjà été repliés dans un snapshot plus récent
+                self._reload()
+                return
+            change = self._apply_remote(record)
+            if change is not None:
+                self._unpublished.append(change)
+            self._seq = record["seq"]
+        
+        if self._journal is not None and os.fstat(self._journal.fileno()).st_ino != inode:
+            # Journal tourné par une autre instance : on écrit désormais dans le nouveau
+            self._journal.close()
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal_started = None
+            self._follow_journal()
+        self._journal_bytes = self._feed_offset
+    
+    def _apply_remote(self, record):
+        if record["op"] == "restore":
+            self._reload()
+            return None
+        category, subcategory = record["c"], record["s"]
+        if record["op"] == "del":
+            if subcategory not in self.data.get(category, {}):
+                return None
+            file_data = self._files(category, subcategory).get(record.get("id"))
+            self._apply(self.data, record)
+            return ("remove", category, subcategory, file_data) if file_data is not None else None
+        self._apply(self.data, record)
+        return ("add", category, subcategory, record["file"])
+    
+    def _snapshot_identity(self):
+        identity = []
+        for path in (self.snapshot_path, self.storage_path):
+            try:
+                stat = os.stat(path)
+                identity.append((stat.st_ino, stat.st_mtime_ns))
+            except FileNotFoundError:
+                identity.append(None)
+        return identity
+    
+    def _load_consistent(self):
+        # Mode partagé : la compaction d'une autre instance remplace le snapshot
+        # puis supprime .old sans notre verrou. Lus entre les deux, l'ancien
+        # snapshot et le nouveau journal laissent un trou : on recommence.
+        for _ in range(10):
+            self._seq, self._next_ids, self._replay_gap = 0, {}, False
+            identity = self._snapshot_identity() if self.shared else None
+            data = self.load_data()
+            if not self.shared or (not self._replay_gap and identity == self._snapshot_identity()):
+                return data
+            time.sleep(0.01)
+        logger.error(f"Storage loaded with a journal gap (seq {self._seq})")
+        return data
+    
+    def _reload(self):
+        # Le mmap précédent reste ouvert tant que des SnapshotCell y renvoient
+        self.data = self._load_consistent()
+        if self._journal is not None:
+            self._journal.close()
+            self._open_journal()
+        self._unpublished.append(("reload", None, None, None))
+        logger.warning(f"Storage reloaded from snapshot (seq {self._seq}) after compaction by another instance")
+    
+    def sync(self):
+        # Appelé périodiquement en mode partagé : lecture seule, verrou partagé
+        if not self.shared:
+            return
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_size) != (self._feed_inode, self._feed_offset):
+            with self._lock, self._process_lock.hold(shared=True):
+                self._catch_up()
+        self._publish()
+    
+    def _commit(self, *records):
+        if self.journal_enabled:
+            for record in records:
+                self._seq += 1
+                record["seq"] = self._seq
+                self._pending.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            flush = self.flush
+        else:
+            flush = self.save_data
+        
+        if self.shared:
+            # Écrit tout de suite, sous le verrou : l'ordre du journal commun suit les seq
+            flush()
+        elif self.persistence is not None:
+            self.persistence.mark_dirty(self, flush)
+        else:
+            flush()
+    
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+            self._maybe_compact()
+    
+    def _write_pending(self):
+        if not self._pending:
+            return
+        chunk = "".join(self._pending)
+        self._pending = []
+        self._journal.write(chunk)
+        self._journal.flush()
+        self._journal_bytes += len(chunk.encode('utf-8'))
+        if self.shared:
+            # Journal rattrapé avant l'écriture : nos propres lignes sont déjà appliquées
+            self._follow_journal()
+        if self._journal_started is None:
+            self._journal_started = time.monotonic()
+    
+    def _maybe_compact(self):
+        if not self._journal_bytes or self._journal_started is None:
+            return
+        too_big = self._journal_bytes >= JOURNAL_MAX_BYTES
+        too_old = time.monotonic() - self._journal_started >= JOURNAL_MAX_AGE
+        if too_big or too_old:
+            self.compact()
+    
+    def _copy_catalog(self):
+        # Copie superficielle : les entrées ne sont jamais modifiées en place
+        return {
+            cat: {
+                sub: self._decode(files) if type(files) is SnapshotCell else list(files.values())
+                for sub, files in subs.items()
+            }
+            for cat, subs in self.data.items()
+        }
+    
+    def compact(self, wait=False):
+        with self._writing():
+            if self._compaction is not None and self._compaction.is_alive():
+                if not wait:
+                    return
+                self._compaction.join()
+            if self.shared and not self._claim_compaction():
+                # Une autre instance écrit déjà son snapshot
+                return
+            if self.snapshot_format == "binary":
+                # Les sous-catégories jamais lues sont recopiées telles quelles du mmap
+                cells = [
+                    (cat, sub, files if type(files) is SnapshotCell else list(files.values()))
+                    for cat, subs in self.data.items() for sub, files in subs.items()
+                ]
+                target, args = self._write_binary_snapshot, (self._seq, self._next_ids_payload(), cells)
+            else:
+                target, args = self._write_snapshot, (self._snapshot_payload(self._copy_catalog(), self._seq),)
+            self._write_pending()
+            self._rotate_journal()
+            self._compaction = threading.Thread(
+                target=self._run_compaction, args=(target, args),
+                name="storage-compaction", daemon=True
+            )
+            self._compaction.start()
+        if wait:
+            self._compaction.join()
+    
+    def _claim_compaction(self):
+        try:
+            fcntl.flock(self._compaction_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+    
+    def _run_compaction(self, target, args):
+        # Le verrou de compaction est tenu jusqu'à la suppression de .old : deux
+        # snapshots concurrents pourraient sinon se remplacer dans le désordre
+        try:
+            target(*args)
+        finally:
+            if self.shared:
+                fcntl.flock(self._compaction_lock, fcntl.LOCK_UN)
+    
+    def _rotate_journal(self):
+        self._journal.close()
+        if self.rotated_journal_path.exists():
+            # Compaction précédente échouée : on conserve tout son contenu
+            with open(self.rotated_journal_path, 'ab') as dst, open(self.journal_path, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            self.journal_path.unlink()
+        else:
+            os.replace(self.journal_path, self.rotated_journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_bytes = 0
+        self._journal_started = None
+        if self.shared:
+            # Une instance en retard dont l'ancien journal a déjà disparu ne
+            # verrait qu'un journal vide : le marqueur lui signale le trou
+            self._journal.write(json.dumps({"op": "base", "seq": self._seq}, separators=(',', ':')) + "\n")
+            self._journal.flush()
+            self._follow_journal()
+    
+    def _write_snapshot(self, payload):
+        tmp_path = self.storage_path.with_suffix(".json.tmp")
+        try:
+            started = time.perf_counter()
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(payload, f, ensure_ascii=False, separators=(',', ':'), default=FileRecord.to_dict)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.storage_path)
+            self.rotated_journal_path.unlink(missing_ok=True)
+            logger.info(f"Storage compacted (seq {payload['seq']}) in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Storage compaction error: {str(e)}")
+    
+    def _write_binary_snapshot(self, seq, next_ids, cells):
+        tmp_path = self.snapshot_path.with_suffix(".snap.tmp")
+        try:
+            started = time.perf_counter()
+            writer = SnapshotWriter(tmp_path)
+            for category, subcategory, files in cells:
+                if type(files) is SnapshotCell:
+                    writer.write_cell(category, subcategory, files.raw(), files.count)
+                else:
+                    blob = json.dumps(files, ensure_ascii=False, separators=(',', ':'),
+                                      default=FileRecord.to_dict).encode('utf-8')
+                    writer.write_cell(category, subcategory, blob, len(files))
+            writer.finish(seq, next_ids)
+            os.replace(tmp_path, self.snapshot_path)
+            self.rotated_journal_path.unlink(missing_ok=True)
+            logger.info(f"Storage compacted to binary snapshot (seq {seq}) in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Storage compaction error: {str(e)}")
     
     def save_data(self):
+        if self.journal_enabled:
+            self.compact(wait=True)
+            return
+        with self._lock:
+            payload = self._snapshot_payload(self._copy_catalog(), self._seq)
         try:
             with open(self.storage_path, 'w') as f:
-                json.dump(self.data, f, indent=4, ensure_ascii=False)
+                json.dump(payload, f, indent=4, ensure_ascii=False, default=FileRecord.to_dict)
         except Exception as e:
             logger.error(f"Storage save error: {str(e)}")
     
+    def close(self):
+        if self._journal is not None:
+            self.flush()
+        if self._compaction is not None:
+            self._compaction.join()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self.shared:
+            self._process_lock.close()
+            self._compaction_lock.close()
+    
+    def get_files(self, category, subcategory):
+        return list(self._files(category, subcategory).values())
+    
+    def count_files(self, category, subcategory):
+        files = self.data.get(category, {}).get(subcategory, {})
+        return files.count if type(files) is SnapshotCell else len(files)
+    
+    def file_keys(self, category, subcategory):
+        return list(self._files(category, subcategory))
+    
+    def _capture_cells(self):
+        # Références seulement : les entrées ne sont jamais modifiées en place
+        return [
+            (cat, sub, files if type(files) is SnapshotCell else list(files.values()))
+            for cat, subs in self.data.items() for sub, files in subs.items()
+        ]
+    
+    def iter_files(self):
+        with self._lock:
+            cells = self._capture_cells()
+        return self._iter_cells(cells)
+    
+    def export(self):
+        # Vue cohérente pour la sauvegarde, capturée d'un coup sous le verrou ;
+        # les sous-catégories encore dans le mmap sont décodées une à une
+        self.sync()
+        with self._lock:
+            cells = self._capture_cells()
+            next_ids = self._next_ids_payload()
+        total = sum(files.count if type(files) is SnapshotCell else len(files) for _, _, files in cells)
+        return next_ids, total, self._iter_cells(cells)
+    
+    @contextlib.contextmanager
+    def restoring(self, next_ids):
+        # Restauration : les fichiers reçus sont écrits en flux dans un nouveau
+        # snapshot binaire, qui ne remplace l'ancien qu'une fois complet. Le
+        # catalogue restauré est ensuite ouvert en lazy, comme au démarrage.
+        writer = SnapshotWriter(self.snapshot_path.with_suffix(".restore.tmp"))
+        try:
+            yield writer.add
+        except BaseException:
+            writer.discard()
+            raise
+        
+        with self._writing():
+            # Une compaction en cours remplacerait le snapshot restauré
+            if self._compaction is not None:
+                self._compaction.join()
+            if self.shared:
+                fcntl.flock(self._compaction_lock, fcntl.LOCK_EX)
+            try:
+                for (category, subcategory), max_id in writer.max_ids.items():
+                    subs = next_ids.setdefault(category, {})
+                    subs[subcategory] = max(subs.get(subcategory, 0), max_id + 1)
+                seq = self._seq + 1
+                writer.finish(seq, next_ids)
+                self._write_pending()
+                self._journal.close()
+                os.replace(writer.path, self.snapshot_path)
+                self.storage_path.unlink(missing_ok=True)
+                self.rotated_journal_path.unlink(missing_ok=True)
+                self.journal_path.unlink(missing_ok=True)
+                self.data = self._load_consistent()
+                self._open_journal()
+                # Seq suivante sans snapshot correspondant : les autres instances rechargent
+                self._commit({"op": "restore"})
+            finally:
+                if self.shared:
+                    fcntl.flock(self._compaction_lock, fcntl.LOCK_UN)
+            self._unpublished.append(("reload", None, None, None))
+        self._publish()
+        logger.info(f"Storage restored (seq {seq})")
+    
+    def _iter_cells(self, cells):
+        for category, subcategory, files in cells:
+            if type(files) is SnapshotCell:
+                # Parcours complet (index) : décodé sans être gardé en mémoire
+                files = self._decode(files)
+            for file_data in files:
+                yield category, subcategory, file_data
+    
+    def get_files_by_keys(self, category, subcategory, file_keys):
+        files = self._files(category, subcategory)
+        return [files[k] for k in file_keys if k in files]
+    
+    def get_file(self, category, subcategory, file_key):
+        return self._files(category, subcategory)[file_key]
+    
     def add_file(self, category, subcategory, file_data):
-        if category not in self.data:
-            self.data[category] = {sub: [] for sub in SUB_CATEGORIES}
-        if subcategory not in self.data[category]:
-            self.data[category][subcategory] = []
-            
-        self.data[category][subcategory].append(file_data)
-        self.save_data()
+        with self._writing():
+            file_key = self._next_ids.get((category, subcategory), 0)
+            record = {"op": "add", "c": category, "s": subcategory,
+                      "file": {"id": file_key, **file_data}}
+            self._apply(self.data, record)
+            self._commit(record)
+        self._publish()
+        self._notify("add", category, subcategory, record["file"])
         logger.info(f"File added to {category}/{subcategory}")
+        return file_key
     
-    def remove_file(self, category, subcategory, file_index):
+    def add_files(self, category, subcategory, files):
+        # Lot d'ajouts : une seule écriture du journal (ou du snapshot)
+        with self._writing():
+            records = []
+            for file_data in files:
+                file_key = self._next_ids.get((category, subcategory), 0)
+                record = {"op": "add", "c": category, "s": subcategory,
+                          "file": {"id": file_key, **file_data}}
+                self._apply(self.data, record)
+                records.append(record)
+            if records:
+                self._commit(*records)
+        self._publish()
+        for record in records:
+            self._notify("add", category, subcategory, record["file"])
+        logger.info(f"{len(records)} files added to {category}/{subcategory}")
+        return [record["file"]["id"] for record in records]
+    
+    def remove_file(self, category, subcategory, file_key):
         try:
-            if category in self.data and subcategory in self.data[category]:
-                if 0 <= file_index < len(self.data[category][subcategory]):
-                    file_name = self.data[category][subcategory][file_index]["file_name"]
-                    del self.data[category][subcategory][file_index]
-                    self.save_data()
-                    logger.info(f"File removed: {category}/{subcategory}/{file_name}")
-                    return True
+            with self._writing():
+                file_data = self._files(category, subcategory).get(file_key)
+                if file_data is not None:
+                    record = {"op": "del", "c": category, "s": subcategory, "id": file_key}
+                    self._apply(self.data, record)
+                    self._commit(record)
+            self._publish()
+            if file_data is None:
+                return False
+            self._notify("remove", category, subcategory, file_data)
+            logger.info(f"File removed: {category}/{subcategory}/{file_data['file_name']}")
+            return True
         except Exception as e:
             logger.error(f"Remove file error: {str(e)}")
         return False
 
+# Bitmap d'identifiants masqués dans une sous-catégorie : des blocs de 1024
+# bits (128 octets) indexés par id >> 10, créés à la demande et retirés
+# quand ils se vident, façon roaring. Test, ajout et retrait en O(1) ; le
+# nombre d'éléments est tenu à jour, recompté par popcount au chargement.
+HIDDEN_CHUNK_BITS = 10
+HIDDEN_CHUNK_BYTES = (1 << HIDDEN_CHUNK_BITS) // 8
+HIDDEN_EMPTY_CHUNK = bytes(HIDDEN_CHUNK_BYTES)
+HIDDEN_MAGIC = b"KNTKHID1"
+HIDDEN_CHANGES_MAX_BYTES = 1 << 20
+
+class HiddenBitmap:
+    __slots__ = ("chunks", "count")
+    
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}
+        self.count = sum(int.from_bytes(chunk, "little").bit_count() for chunk in self.chunks.values())
+    
+    def add(self, file_key):
+        chunk = self.chunks.get(file_key >> HIDDEN_CHUNK_BITS)
+        if chunk is None:
+            chunk = self.chunks[file_key >> HIDDEN_CHUNK_BITS] = bytearray(HIDDEN_CHUNK_BYTES)
+        offset = file_key & ((1 << HIDDEN_CHUNK_BITS) - 1)
+        bit = 1 << (offset & 7)
+        if chunk[offset >> 3] & bit:
+            return False
+        chunk[offset >> 3] |= bit
+        self.count += 1
+        return True
+    
+    def discard(self, file_key):
+        high = file_key >> HIDDEN_CHUNK_BITS
+        chunk = self.chunks.get(high)
+        offset = file_key & ((1 << HIDDEN_CHUNK_BITS) - 1)
+        bit = 1 << (offset & 7)
+        if chunk is None or not chunk[offset >> 3] & bit:
+            return False
+        chunk[offset >> 3] &= ~bit
+        self.count -= 1
+        if chunk == HIDDEN_EMPTY_CHUNK:
+            del self.chunks[high]
+        return True
+    
+    def __contains__(self, file_key):
+        chunk = self.chunks.get(file_key >> HIDDEN_CHUNK_BITS)
+        if chunk is None:
+            return False
+        offset = file_key & ((1 << HIDDEN_CHUNK_BITS) - 1)
+        return bool(chunk[offset >> 3] >> (offset & 7) & 1)
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        # Identifiants croissants
+        for high in sorted(self.chunks):
+            bits = int.from_bytes(self.chunks[high], "little")
+            base = high << HIDDEN_CHUNK_BITS
+            while bits:
+                lowest = bits & -bits
+                yield base + lowest.bit_length() - 1
+                bits ^= lowest
+
 # Système de masquage des fichiers
-class HiddenFiles:
-    def __init__(self, file_path):
+class HiddenFiles(CatalogEvents):
+    # Index à plat {(user_id, cat, sub): HiddenBitmap} : appartenance en O(1)
+    # et nombre de fichiers masqués par sous-catégorie maintenu à chaque
+    # opération. Un fichier binaire par utilisateur dans le dossier voisin de
+    # hidden_files.json : un masquage ne réécrit que celui de l'utilisateur.
+    # L'ancien JSON imbriqué est importé au premier démarrage.
+    # Mode partagé : l'écriture d'un utilisateur relit son fichier sous le
+    # verrou inter-processus et y rejoue les opérations locales pas encore
+    # écrites (masquer et démasquer sont idempotents), puis ajoute son
+    # identifiant à hidden_files.changes, que les autres instances relisent.
+    def __init__(self, file_path, persistence=None, shared=SHARED_STORAGE):
         self.file_path = file_path
-        self.data = self.load_data()
+        self.bitmap_dir = file_path.parent / file_path.stem
+        self.changes_path = file_path.with_suffix(".changes")
+        self.persistence = persistence
+        self.shared = shared
+        self._process_lock = ProcessLock(file_path.with_suffix(".lock")) if shared else None
+        self._lock = threading.RLock()
+        self._sets = {}
+        self._cells_by_user = {}
+        self._users_by_cell = {}
+        self._pending_ops = {}
+        self._unpublished = []
+        self._feed_inode = None
+        self._feed_offset = 0
+        with self._lock, (self._process_lock.hold() if shared else contextlib.nullcontext()):
+            if shared:
+                self._follow_changes()
+            self._load()
+    
+    def _load(self):
+        if self.bitmap_dir.is_dir():
+            self._load_bitmaps()
+            return
+        for user_id, cats in self.load_data().items():
+            for cat, subs in cats.items():
+                for sub, file_keys in subs.items():
+                    for file_key in file_keys:
+                        self._add(user_id, cat, sub, file_key)
+        if self._cells_by_user:
+            self.save_data()
+            logger.info(f"Hidden files imported from {self.file_path.name} ({len(self._cells_by_user)} users)")
     
     def load_data(self):
         try:
@@ -114,173 +1514,2870 @@ class HiddenFiles:
             logger.error(f"Hidden files load error: {str(e)}")
         return {}
     
+    def _load_bitmaps(self):
+        for path in self.bitmap_dir.glob("*.bin"):
+            try:
+                for category, subcategory, bitmap in self._read_user(path):
+                    self._attach(path.stem, category, subcategory, bitmap)
+            except Exception as e:
+                logger.error(f"Hidden files load error ({path.name}): {str(e)}")
+    
+    @staticmethod
+    def _read_user(path):
+        # Par sous-catégorie : noms (longueur + UTF-8), nombre de blocs, puis
+        # (numéro de bloc, 128 octets) pour chacun
+        raw = path.read_bytes()
+        if not raw.startswith(HIDDEN_MAGIC):
+            raise ValueError("unknown format")
+        position = len(HIDDEN_MAGIC)
+        cells = []
+        while position < len(raw):
+            names = []
+            for _ in range(2):
+                (length,) = struct.unpack_from("<H", raw, position)
+                names.append(sys.intern(raw[position + 2:position + 2 + length].decode("utf-8")))
+                position += 2 + length
+            (chunk_count,) = struct.unpack_from("<I", raw, position)
+            position += 4
+            chunks = {}
+            for _ in range(chunk_count):
+                (high,) = struct.unpack_from("<I", raw, position)
+                chunks[high] = bytearray(raw[position + 4:position + 4 + HIDDEN_CHUNK_BYTES])
+                position += 4 + HIDDEN_CHUNK_BYTES
+            cells.append((names[0], names[1], HiddenBitmap(chunks)))
+        return cells
+    
+    def _user_path(self, user_id):
+        return self.bitmap_dir / f"{user_id}.bin"
+    
+    @property
+    def data(self):
+        with self._lock:
+            nested = {}
+            for (user_id, cat, sub), file_keys in self._sets.items():
+                nested.setdefault(user_id, {}).setdefault(cat, {})[sub] = list(file_keys)
+        return nested
+    
     def save_data(self):
+        # Écriture complète (import, création) : l'état en mémoire fait foi
+        with self._lock:
+            users = list(self._cells_by_user)
+        self.bitmap_dir.mkdir(exist_ok=True)
+        for user_id in users:
+            self._write_user(user_id)
+    
+    def save_user(self, user_id):
+        if not self.shared:
+            self._write_user(user_id)
+            return
+        with self._lock, self._process_lock.hold():
+            self._merge_user(user_id)
+            self._pending_ops.pop(user_id, None)
+            self._write_user(user_id)
+            self._append_change(user_id)
+        self._publish()
+    
+    def _write_user(self, user_id):
+        with self._lock:
+            parts = [HIDDEN_MAGIC]
+            for category, subcategory in sorted(self._cells_by_user.get(user_id, ())):
+                chunks = self._sets[(user_id, category, subcategory)].chunks
+                for name in (category, subcategory):
+                    encoded = name.encode("utf-8")
+                    parts.append(struct.pack("<H", len(encoded)) + encoded)
+                parts.append(struct.pack("<I", len(chunks)))
+                for high in sorted(chunks):
+                    parts.append(struct.pack("<I", high) + chunks[high])
+        path = self._user_path(user_id)
         try:
-            with open(self.file_path, 'w') as f:
-                json.dump(self.data, f, indent=4)
+            if len(parts) == 1:
+                path.unlink(missing_ok=True)
+                return
+            self.bitmap_dir.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(b"".join(parts))
+            os.replace(tmp_path, path)
         except Exception as e:
             logger.error(f"Hidden files save error: {str(e)}")
     
-    def hide_file(self, user_id, category, subcategory, file_index):
-        user_id = str(user_id)
-        if user_id not in self.data:
-            self.data[user_id] = {}
-        
-        if category not in self.data[user_id]:
-            self.data[user_id][category] = {}
+    def _follow_changes(self):
+        try:
+            stat = os.stat(self.changes_path)
+        except FileNotFoundError:
+            return
+        self._feed_inode, self._feed_offset = stat.st_ino, stat.st_size
+    
+    def _append_change(self, user_id):
+        with open(self.changes_path, 'a') as f:
+            f.write(f"{user_id}\n")
+            size = f.tell()
+        if size >= HIDDEN_CHANGES_MAX_BYTES:
+            # Remplacé par un fichier vide : les autres instances voient l'inode
+            # changer et relisent tous les utilisateurs
+            tmp_path = self.changes_path.with_suffix(".changes.tmp")
+            tmp_path.write_bytes(b"")
+            os.replace(tmp_path, self.changes_path)
+    
+    def _merge_user(self, user_id):
+        # Fichier de l'utilisateur (écrit par n'importe quelle instance) plus
+        # les opérations locales pas encore écrites ; les bitmaps sont
+        # remplacés un par un, les lecteurs sans verrou ne voient pas de trou
+        path = self._user_path(user_id)
+        try:
+            cells = {(cat, sub): bitmap for cat, sub, bitmap in self._read_user(path)} if path.exists() else {}
+        except Exception as e:
+            logger.error(f"Hidden files load error ({path.name}): {str(e)}")
+            return
+        for op, category, subcategory, file_key in self._pending_ops.get(user_id, ()):
+            bitmap = cells.setdefault((category, subcategory), HiddenBitmap())
+            if op == "hide":
+                bitmap.add(file_key)
+            else:
+                bitmap.discard(file_key)
         
-        if subcategory not in self.data[user_id][category]:
-            self.data[user_id][category][subcategory] = []
+        for cell in set(self._cells_by_user.get(user_id, ())) | set(cells):
+            current = self._sets.get((user_id, *cell))
+            bitmap = cells.get(cell)
+            if (current.chunks if current else {}) == (bitmap.chunks if bitmap else {}):
+                continue
+            if bitmap:
+                self._attach(user_id, *cell, bitmap)
+            else:
+                self._detach(user_id, *cell)
+            self._unpublished.append(("sync", user_id, *cell, None))
+    
+    def sync(self):
+        # Appelé périodiquement en mode partagé : relit les utilisateurs modifiés ailleurs
+        if not self.shared:
+            return
+        try:
+            stat = os.stat(self.changes_path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_size) != (self._feed_inode, self._feed_offset):
+            with self._lock, self._process_lock.hold(shared=True):
+                self._catch_up()
+        self._publish()
+    
+    def _catch_up(self):
+        try:
+            with open(self.changes_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                replaced = stat.st_ino != self._feed_inode or stat.st_size < self._feed_offset
+                offset = 0 if replaced else self._feed_offset
+                f.seek(offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+        if replaced:
+            users = set(self._cells_by_user) | {path.stem for path in self.bitmap_dir.glob("*.bin")}
+        else:
+            users = set(chunk.decode("utf-8").split())
+        self._feed_inode, self._feed_offset = stat.st_ino, offset + len(chunk)
+        for user_id in users:
+            self._merge_user(user_id)
+    
+    def _track(self, user_id, op, category, subcategory, file_key):
+        if self.shared:
+            self._pending_ops.setdefault(user_id, []).append((op, category, subcategory, file_key))
+    
+    def _changed(self, *users):
+        for user_id in users:
+            if self.persistence is not None:
+                self.persistence.mark_dirty((self, user_id), functools.partial(self.save_user, user_id))
+            else:
+                self.save_user(user_id)
+    
+    def _attach(self, user_id, category, subcategory, bitmap):
+        if not bitmap:
+            return
+        self._sets[(user_id, category, subcategory)] = bitmap
+        self._cells_by_user.setdefault(user_id, set()).add((category, subcategory))
+        self._users_by_cell.setdefault((category, subcategory), set()).add(user_id)
+    
+    def _add(self, user_id, category, subcategory, file_key):
+        key = (user_id, category, subcategory)
+        file_keys = self._sets.get(key)
+        if file_keys is None:
+            file_keys = self._sets[key] = HiddenBitmap()
+            self._cells_by_user.setdefault(user_id, set()).add((category, subcategory))
+            self._users_by_cell.setdefault((category, subcategory), set()).add(user_id)
+        return file_keys.add(file_key)
+    
+    def _discard(self, user_id, category, subcategory, file_key):
+        key = (user_id, category, subcategory)
+        file_keys = self._sets.get(key)
+        if file_keys is None or not file_keys.discard(file_key):
+            return False
         
-        if file_index not in self.data[user_id][category][subcategory]:
-            self.data[user_id][category][subcategory].append(file_index)
-            self.save_data()
-            return True
-        return False
+        # Nettoyer les structures vides
+        if not file_keys:
+            self._detach(user_id, category, subcategory)
+        return True
     
-    def unhide_file(self, user_id, category, subcategory, file_index):
-        user_id = str(user_id)
+    def _detach(self, user_id, category, subcategory):
+        del self._sets[(user_id, category, subcategory)]
+        cells = self._cells_by_user[user_id]
+        cells.discard((category, subcategory))
+        if not cells:
+            del self._cells_by_user[user_id]
+        users = self._users_by_cell[(category, subcategory)]
+        users.discard(user_id)
+        if not users:
+            del self._users_by_cell[(category, subcategory)]
+    
+    def hide_file(self, user_id, category, subcategory, file_key):
+        with self._lock:
+            added = self._add(str(user_id), category, subcategory, file_key)
+            if added:
+                self._track(str(user_id), "hide", category, subcategory, file_key)
+        if added:
+            self._changed(str(user_id))
+            self._notify("hide", str(user_id), category, subcategory, file_key)
+        return added
+    
+    def unhide_file(self, user_id, category, subcategory, file_key):
         try:
-            if (user_id in self.data and
-                category in self.data[user_id] and
-                subcategory in self.data[user_id][category] and
-                file_index in self.data[user_id][category][subcategory]):
-                
-                self.data[user_id][category][subcategory].remove(file_index)
-                
-                # Nettoyer les structures vides
-                if not self.data[user_id][category][subcategory]:
-                    del self.data[user_id][category][subcategory]
-                    if not self.data[user_id][category]:
-                        del self.data[user_id][category]
-                        if not self.data[user_id]:
-                            del self.data[user_id]
-                
-                self.save_data()
-                return True
+            with self._lock:
+                removed = self._discard(str(user_id), category, subcategory, file_key)
+                if removed:
+                    self._track(str(user_id), "unhide", category, subcategory, file_key)
+            if removed:
+                self._changed(str(user_id))
+                self._notify("unhide", str(user_id), category, subcategory, file_key)
+            return removed
         except Exception as e:
             logger.error(f"Unhide file error: {str(e)}")
         return False
     
-    def is_hidden(self, user_id, category, subcategory, file_index):
-        user_id = str(user_id)
-        return (
-            user_id in self.data and
-            category in self.data[user_id] and
-            subcategory in self.data[user_id][category] and
-            file_index in self.data[user_id][category][subcategory]
-        )
+    def forget_file(self, category, subcategory, file_key):
+        # Fichier supprimé du catalogue : il disparaît des masquages de tous les utilisateurs
+        with self._lock:
+            users = list(self._users_by_cell.get((category, subcategory), ()))
+            removed = [u for u in users if self._discard(u, category, subcategory, file_key)]
+            for user_id in removed:
+                self._track(user_id, "unhide", category, subcategory, file_key)
+        self._changed(*removed)
+    
+    def is_hidden(self, user_id, category, subcategory, file_key):
+        return file_key in self._sets.get((str(user_id), category, subcategory), ())
+    
+    def hidden_keys(self, user_id, category, subcategory):
+        return self._sets.get((str(user_id), category, subcategory), frozenset())
+    
+    def has_hidden(self, user_id, category=None, subcategory=None):
+        if category is None:
+            return str(user_id) in self._cells_by_user
+        return (str(user_id), category, subcategory) in self._sets
+    
+    def visible_count(self, user_id, category, subcategory, total):
+        return total - len(self._sets.get((str(user_id), category, subcategory), ()))
+    
+    def drop_missing(self, storage):
+        # Après migration : retire les index qui ne désignent plus aucun fichier
+        changed = set()
+        with self._lock:
+            for (user_id, cat, sub), file_keys in list(self._sets.items()):
+                existing = {f["id"] for f in storage.get_files(cat, sub)}
+                for file_key in [k for k in file_keys if k not in existing]:
+                    self._discard(user_id, cat, sub, file_key)
+                    self._track(user_id, "unhide", cat, sub, file_key)
+                    changed.add(user_id)
+        self._changed(*changed)
+    
+    def export(self):
+        # Copie des bitmaps sous le verrou, identifiants énumérés ensuite
+        self.sync()
+        with self._lock:
+            cells = [
+                (user_id, cat, sub, HiddenBitmap({high: bytes(chunk) for high, chunk in bitmap.chunks.items()}))
+                for (user_id, cat, sub), bitmap in sorted(self._sets.items())
+            ]
+        return sum(len(bitmap) for *_, bitmap in cells), cells
+    
+    def restore(self, entries):
+        # Remplace tous les masquages : {(user_id, cat, sub): [ids]}
+        with self._lock, (self._process_lock.hold() if self.shared else contextlib.nullcontext()):
+            previous = set(self._cells_by_user)
+            self._sets, self._cells_by_user, self._users_by_cell = {}, {}, {}
+            self._pending_ops = {}
+            for (user_id, cat, sub), file_keys in entries.items():
+                for file_key in file_keys:
+                    self._add(user_id, sys.intern(cat), sys.intern(sub), file_key)
+            self.bitmap_dir.mkdir(exist_ok=True)
+            for user_id in previous - set(self._cells_by_user):
+                self._user_path(user_id).unlink(missing_ok=True)
+            self.save_data()
+            if self.shared:
+                # Nouveau fichier de changements : les autres instances relisent tout
+                tmp_path = self.changes_path.with_suffix(".changes.tmp")
+                tmp_path.write_bytes(b"")
+                os.replace(tmp_path, self.changes_path)
+                self._follow_changes()
+        self._notify("reset", None, None, None, None)
+        logger.info(f"Hidden files restored ({len(self._cells_by_user)} users)")
     
     def get_hidden_files(self, user_id):
         user_id = str(user_id)
-        if user_id not in self.data:
-            return []
-        
         hidden_list = []
-        for category, subcategories in self.data[user_id].items():
-            for subcategory, indexes in subcategories.items():
-                for index in indexes:
+        with self._lock:
+            for category, subcategory in sorted(self._cells_by_user.get(user_id, ())):
+                for file_key in self._sets[(user_id, category, subcategory)]:
                     hidden_list.append({
                         "category": category,
                         "subcategory": subcategory,
-                        "index": index
+                        "file_key": file_key
                     })
         return hidden_list
 
-# Initialisation des stockages
-storage = FileStorage(STORAGE_PATH)
-hidden_files = HiddenFiles(HIDDEN_PATH)
+# Moteur SQLite (mode WAL) : seules les sous-catégories consultées sont chargées
+FILE_COLUMNS = ("file_id", "file_name", "file_type", "date", "uploader")
 
-# Helpers
-def log_activity(user_id: int, action: str, details: str):
-    log_entry = f"User:{user_id} | {action} | {details}"
-    logger.info(log_entry)
-    print(log_entry)
+def open_database(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_name TEXT,
+            file_type TEXT,
+            date TEXT,
+            uploader TEXT,
+            extra TEXT,
+            file_key INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_by_subcategory ON files (category, subcategory, id);
+        CREATE TABLE IF NOT EXISTS next_keys (
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL,
+            next_key INTEGER NOT NULL,
+            PRIMARY KEY (category, subcategory)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS hidden (
+            user_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL,
+            file_key INTEGER NOT NULL,
+            PRIMARY KEY (user_id, category, subcategory, file_key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS hidden_by_file ON hidden (category, subcategory, file_key);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    _upgrade_schema(conn)
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS files_by_key ON files (category, subcategory, file_key)"
+    )
+    return conn
 
-def create_main_menu(user_id=None):
-    keyboard = []
-    for cat in MAIN_CATEGORIES:
-        keyboard.append([InlineKeyboardButton(cat, callback_data=f"cat_{cat}")])
-    
-    # Ajouter le bouton pour les fichiers masqués
-    if user_id and hidden_files.get_hidden_files(user_id):
-        keyboard.append([InlineKeyboardButton("👁️‍🗨️ Fichiers masqués", callback_data="view_hidden")])
+PRUNE_HIDDEN_SQL = (
+    "DELETE FROM hidden WHERE NOT EXISTS (SELECT 1 FROM files f WHERE "
+    "f.category = hidden.category AND f.subcategory = hidden.subcategory "
+    "AND f.file_key = hidden.file_key)"
+)
+
+def _upgrade_schema(conn):
+    # Bases créées avant les identifiants stables : chaque fichier reçoit sa
+    # position actuelle, ce qui conserve les index de la table hidden
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+    if "file_key" in columns:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+        if "file_key" not in columns:
+            conn.execute("ALTER TABLE files ADD COLUMN file_key INTEGER")
+            conn.execute("CREATE TEMP TABLE positions (id INTEGER PRIMARY KEY, pos INTEGER)")
+            conn.execute(
+                "INSERT INTO positions SELECT id, ROW_NUMBER() OVER "
+                "(PARTITION BY category, subcategory ORDER BY id) - 1 FROM files"
+            )
+            conn.execute("UPDATE files SET file_key = (SELECT pos FROM positions WHERE positions.id = files.id)")
+            conn.execute(
+                "INSERT OR REPLACE INTO next_keys SELECT category, subcategory, MAX(file_key) + 1 "
+                "FROM files GROUP BY category, subcategory"
+            )
+            conn.execute("DROP TABLE positions")
+            # Index déjà décalés par d'anciennes suppressions : ils ne désignent aucun fichier
+            conn.execute(PRUNE_HIDDEN_SQL)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+FILE_INSERT_SQL = (
+    f"INSERT INTO files (category, subcategory, file_key, {', '.join(FILE_COLUMNS)}, extra) "
+    f"VALUES ({', '.join('?' * (len(FILE_COLUMNS) + 4))})"
+)
+FILE_SELECT_COLUMNS = f"file_key, {', '.join(FILE_COLUMNS)}, extra"
+
+def _file_row(category, subcategory, file_data):
+    extra = {k: v for k, v in file_data.items() if k not in FILE_COLUMNS and k != "id"}
+    return (
+        category, subcategory, file_data["id"],
+        *(file_data.get(col) for col in FILE_COLUMNS),
+        json.dumps(extra, ensure_ascii=False) if extra else None
+    )
+
+def _file_from_row(row):
+    file_data = {"id": row[0], **dict(zip(FILE_COLUMNS, row[1:-1]))}
+    if row[-1]:
+        file_data.update(json.loads(row[-1]))
+    return file_data
+
+class SqliteStore:
+    # Lectures sur une connexion dédiée, écritures regroupées en une transaction
+    # par flush sur une seconde connexion (possible grâce au mode WAL).
+    def __init__(self, db_path, persistence=None):
+        self.db_path = db_path
+        self.persistence = persistence
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._op_counter = 0
+        self.conn = open_database(db_path)
+        self.write_conn = open_database(db_path)
+    
+    def _write(self, sql, params):
+        with self._lock:
+            self._op_counter += 1
+            self._pending.append((sql, params))
+            op_id = self._op_counter
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self, self.flush)
+        else:
+            self.flush()
+        return op_id
+    
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                last_op = self._op_counter
+            if not pending:
+                return
+            self.write_conn.execute("BEGIN")
+            try:
+                for sql, params in pending:
+                    self.write_conn.execute(sql, params)
+                self.write_conn.execute("COMMIT")
+            except Exception:
+                self.write_conn.execute("ROLLBACK")
+                raise
+            self._flushed(last_op)
+    
+    def _flushed(self, last_op):
+        pass
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+        self.write_conn.close()
+
+class SqliteFileStorage(SqliteStore, CatalogEvents):
+    def __init__(self, db_path, persistence=None):
+        super().__init__(db_path, persistence)
+        # Ajouts et suppressions pas encore écrits, vus par les lectures (les
+        # événements partent avant le flush) : (catégorie, sous-catégorie, clé)
+        # -> (fichier ou None si supprimé, numéro d'opération)
+        self._overlay = {}
+        self._load_counters()
+        logger.info("SQLite storage initialized")
+    
+    def _flushed(self, last_op):
+        with self._lock:
+            self._overlay = {k: v for k, v in self._overlay.items() if v[1] > last_op}
+    
+    def _pending_files(self, category, subcategory):
+        # Sous self._lock
+        return {
+            file_key: file_data for (cat, sub, file_key), (file_data, _) in self._overlay.items()
+            if (cat, sub) == (category, subcategory)
+        }
+    
+    def _load_counters(self):
+        with self._lock:
+            self._next_keys = {
+                (category, subcategory): next_key
+                for category, subcategory, next_key in self.conn.execute("SELECT * FROM next_keys")
+            }
+            self._counts = {
+                (category, subcategory): count
+                for category, subcategory, count in self.conn.execute(
+                    "SELECT category, subcategory, COUNT(*) FROM files GROUP BY category, subcategory"
+                )
+            }
+    
+    def export(self):
+        # Lecture en flux sur une connexion dédiée, dans une transaction : un
+        # instantané WAL cohérent, sans bloquer les écritures du bot
+        self.flush()
+        conn = open_database(self.db_path)
+        conn.execute("BEGIN")
+        next_ids = {}
+        for category, subcategory, next_key in conn.execute("SELECT * FROM next_keys"):
+            next_ids.setdefault(category, {})[subcategory] = next_key
+        (total,) = conn.execute("SELECT COUNT(*) FROM files").fetchone()
+        return next_ids, total, self._stream_files(conn)
+    
+    @staticmethod
+    def _stream_files(conn):
+        try:
+            for row in conn.execute(
+                f"SELECT category, subcategory, {FILE_SELECT_COLUMNS} FROM files "
+                "ORDER BY category, subcategory, id"
+            ):
+                yield row[0], row[1], _file_from_row(row[2:])
+        finally:
+            conn.close()
+    
+    @contextlib.contextmanager
+    def restoring(self, next_ids):
+        # Une seule transaction par lots d'insertions : l'ancien catalogue reste
+        # servi jusqu'au COMMIT, les écritures du bot attendent la fin
+        max_ids, rows = {}, []
+        
+        def load(category, subcategory, file_data):
+            rows.append(_file_row(category, subcategory, file_data))
+            max_ids[(category, subcategory)] = max(max_ids.get((category, subcategory), -1), file_data["id"])
+            if len(rows) >= BACKUP_CHUNK:
+                self.write_conn.executemany(FILE_INSERT_SQL, rows)
+                rows.clear()
+        
+        self.flush()
+        with self._write_lock:
+            self.write_conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.write_conn.execute("DELETE FROM files")
+                self.write_conn.execute("DELETE FROM next_keys")
+                yield load
+                self.write_conn.executemany(FILE_INSERT_SQL, rows)
+                next_keys = {
+                    (category, subcategory): next_key
+                    for category, subs in next_ids.items() for subcategory, next_key in subs.items()
+                }
+                for key, max_id in max_ids.items():
+                    next_keys[key] = max(next_keys.get(key, 0), max_id + 1)
+                self.write_conn.executemany(
+                    "INSERT INTO next_keys VALUES (?, ?, ?)",
+                    ((category, subcategory, next_key) for (category, subcategory), next_key in next_keys.items())
+                )
+                self.write_conn.execute("COMMIT")
+            except BaseException:
+                self.write_conn.execute("ROLLBACK")
+                raise
+        self._load_counters()
+        self._notify("reload", None, None, None)
+        logger.info("SQLite storage restored")
+    
+    def count_files(self, category, subcategory):
+        return self._counts.get((category, subcategory), 0)
+    
+    def file_keys(self, category, subcategory):
+        with self._lock:
+            file_keys = [
+                file_key for (file_key,) in self.conn.execute(
+                    "SELECT file_key FROM files WHERE category = ? AND subcategory = ? ORDER BY id",
+                    (category, subcategory)
+                )
+            ]
+            pending = self._pending_files(category, subcategory)
+        if not pending:
+            return file_keys
+        # Clés attribuées dans l'ordre croissant : l'ordre d'ajout est conservé
+        return sorted(k for k in {*file_keys, *pending} if pending.get(k, True) is not None)
+    
+    def iter_files(self):
+        # Parcours complet (index) en flux sur une connexion dédiée, sans le
+        # verrou : les lectures de la boucle n'attendent pas. Les écritures en
+        # attente sont relevées avant la lecture ; celles qui suivent arrivent
+        # aussi par les événements du catalogue.
+        with self._lock:
+            overlay = dict(self._overlay)
+        conn = open_database(self.db_path)
+        conn.execute("BEGIN")
+        return self._stream_catalog(conn, overlay)
+    
+    @staticmethod
+    def _stream_catalog(conn, overlay):
+        try:
+            for row in conn.execute(f"SELECT category, subcategory, {FILE_SELECT_COLUMNS} FROM files ORDER BY id"):
+                if (row[0], row[1], row[2]) not in overlay:
+                    yield row[0], row[1], _file_from_row(row[2:])
+        finally:
+            conn.close()
+        for (category, subcategory, _), (file_data, _) in overlay.items():
+            if file_data is not None:
+                yield category, subcategory, dict(file_data)
+    
+    def get_files_by_keys(self, category, subcategory, file_keys):
+        if not file_keys:
+            return []
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {FILE_SELECT_COLUMNS} FROM files WHERE category = ? AND subcategory = ? "
+                f"AND file_key IN ({', '.join('?' * len(file_keys))})",
+                (category, subcategory, *file_keys)
+            ).fetchall()
+            pending = self._pending_files(category, subcategory)
+        files = {row[0]: _file_from_row(row) for row in rows}
+        for file_key, file_data in pending.items():
+            files[file_key] = dict(file_data) if file_data is not None else None
+        return [files[k] for k in file_keys if files.get(k) is not None]
+    
+    def get_files(self, category, subcategory):
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {FILE_SELECT_COLUMNS} FROM files "
+                "WHERE category = ? AND subcategory = ? ORDER BY id",
+                (category, subcategory)
+            ).fetchall()
+            pending = self._pending_files(category, subcategory)
+        files = {row[0]: _file_from_row(row) for row in rows}
+        for file_key, file_data in pending.items():
+            files[file_key] = dict(file_data) if file_data is not None else None
+        return [file_data for _, file_data in sorted(files.items()) if file_data is not None]
+    
+    def get_file(self, category, subcategory, file_key):
+        with self._lock:
+            if (category, subcategory, file_key) in self._overlay:
+                row = None
+                file_data = self._overlay[(category, subcategory, file_key)][0]
+            else:
+                row = self.conn.execute(
+                    f"SELECT {FILE_SELECT_COLUMNS} FROM files "
+                    "WHERE category = ? AND subcategory = ? AND file_key = ?",
+                    (category, subcategory, file_key)
+                ).fetchone()
+                file_data = row and _file_from_row(row)
+        if file_data is None:
+            raise KeyError(f"{category}/{subcategory}/{file_key}")
+        return dict(file_data) if row is None else file_data
+    
+    def add_file(self, category, subcategory, file_data):
+        with self._lock:
+            file_key = self._next_keys.get((category, subcategory), 0)
+            self._next_keys[(category, subcategory)] = file_key + 1
+            self._counts[(category, subcategory)] = self.count_files(category, subcategory) + 1
+            file_data = {**file_data, "id": file_key}
+            self._overlay[(category, subcategory, file_key)] = (file_data, self._op_counter + 1)
+            self._write(FILE_INSERT_SQL, _file_row(category, subcategory, file_data))
+            self._write(
+                "INSERT INTO next_keys VALUES (?, ?, ?) ON CONFLICT (category, subcategory) "
+                "DO UPDATE SET next_key = excluded.next_key",
+                (category, subcategory, file_key + 1)
+            )
+        self._notify("add", category, subcategory, file_data)
+        logger.info(f"File added to {category}/{subcategory}")
+        return file_key
+    
+    def add_files(self, category, subcategory, files):
+        # Toutes les lignes partent dans la même transaction d'écriture
+        with self._lock:
+            file_key = self._next_keys.get((category, subcategory), 0)
+            added = []
+            for file_data in files:
+                file_data = {**file_data, "id": file_key + len(added)}
+                self._overlay[(category, subcategory, file_data["id"])] = (file_data, self._op_counter + 1)
+                self._write(FILE_INSERT_SQL, _file_row(category, subcategory, file_data))
+                added.append(file_data)
+            if added:
+                self._next_keys[(category, subcategory)] = file_key + len(added)
+                self._counts[(category, subcategory)] = self.count_files(category, subcategory) + len(added)
+                self._write(
+                    "INSERT INTO next_keys VALUES (?, ?, ?) ON CONFLICT (category, subcategory) "
+                    "DO UPDATE SET next_key = excluded.next_key",
+                    (category, subcategory, file_key + len(added))
+                )
+        for file_data in added:
+            self._notify("add", category, subcategory, file_data)
+        logger.info(f"{len(added)} files added to {category}/{subcategory}")
+        return [file_data["id"] for file_data in added]
+    
+    def remove_file(self, category, subcategory, file_key):
+        try:
+            with self._lock:
+                file_data = self.get_file(category, subcategory, file_key)
+                self._counts[(category, subcategory)] -= 1
+                self._overlay[(category, subcategory, file_key)] = (None, self._op_counter + 1)
+                self._write(
+                    "DELETE FROM files WHERE category = ? AND subcategory = ? AND file_key = ?",
+                    (category, subcategory, file_key)
+                )
+            self._notify("remove", category, subcategory, file_data)
+            logger.info(f"File removed: {category}/{subcategory}/{file_data['file_name']}")
+            return True
+        except KeyError:
+            pass
+        except Exception as e:
+            logger.error(f"Remove file error: {str(e)}")
+        return False
+
+class SqliteHiddenFiles(SqliteStore, CatalogEvents):
+    def __init__(self, db_path, persistence=None):
+        super().__init__(db_path, persistence)
+        # Masquages pas encore écrits : clé -> (masqué, numéro d'opération)
+        self._overlay = {}
+    
+    def _flushed(self, last_op):
+        with self._lock:
+            self._overlay = {k: v for k, v in self._overlay.items() if v[1] > last_op}
+    
+    def _set(self, user_id, category, subcategory, file_key, hidden):
+        key = (str(user_id), category, subcategory, file_key)
+        with self._lock:
+            if self.is_hidden(*key) == hidden:
+                return False
+            if hidden:
+                sql = "INSERT OR IGNORE INTO hidden VALUES (?, ?, ?, ?)"
+            else:
+                sql = ("DELETE FROM hidden WHERE user_id = ? AND category = ? "
+                       "AND subcategory = ? AND file_key = ?")
+            self._overlay[key] = (hidden, self._op_counter + 1)
+            self._write(sql, key)
+        self._notify("hide" if hidden else "unhide", *key)
+        return True
+    
+    def hide_file(self, user_id, category, subcategory, file_key):
+        return self._set(user_id, category, subcategory, file_key, True)
+    
+    def unhide_file(self, user_id, category, subcategory, file_key):
+        try:
+            return self._set(user_id, category, subcategory, file_key, False)
+        except Exception as e:
+            logger.error(f"Unhide file error: {str(e)}")
+        return False
+    
+    def is_hidden(self, user_id, category, subcategory, file_key):
+        key = (str(user_id), category, subcategory, file_key)
+        with self._lock:
+            if key in self._overlay:
+                return self._overlay[key][0]
+            row = self.conn.execute(
+                "SELECT 1 FROM hidden WHERE user_id = ? AND category = ? "
+                "AND subcategory = ? AND file_key = ?",
+                key
+            ).fetchone()
+        return row is not None
+    
+    def hidden_keys(self, user_id, category, subcategory):
+        user_id = str(user_id)
+        with self._lock:
+            file_keys = {
+                file_key for (file_key,) in self.conn.execute(
+                    "SELECT file_key FROM hidden WHERE user_id = ? AND category = ? AND subcategory = ?",
+                    (user_id, category, subcategory)
+                )
+            }
+            for (uid, cat, sub, file_key), (is_hidden, _) in self._overlay.items():
+                if (uid, cat, sub) == (user_id, category, subcategory):
+                    if is_hidden:
+                        file_keys.add(file_key)
+                    else:
+                        file_keys.discard(file_key)
+        return file_keys
+    
+    def visible_count(self, user_id, category, subcategory, total):
+        return total - len(self.hidden_keys(user_id, category, subcategory))
+    
+    def has_hidden(self, user_id, category=None, subcategory=None):
+        if category is not None:
+            return bool(self.hidden_keys(user_id, category, subcategory))
+        user_id = str(user_id)
+        with self._lock:
+            if any(key[0] == user_id for key in self._overlay):
+                return bool(self.get_hidden_files(user_id))
+            row = self.conn.execute("SELECT 1 FROM hidden WHERE user_id = ? LIMIT 1", (user_id,)).fetchone()
+        return row is not None
+    
+    def forget_file(self, category, subcategory, file_key):
+        with self._lock:
+            for key in [k for k in self._overlay if k[1:] == (category, subcategory, file_key)]:
+                del self._overlay[key]
+            # Masquages déjà en base : invisibles dès maintenant, avant le flush
+            for (user_id,) in self.conn.execute(
+                "SELECT user_id FROM hidden WHERE category = ? AND subcategory = ? AND file_key = ?",
+                (category, subcategory, file_key)
+            ).fetchall():
+                self._overlay[(user_id, category, subcategory, file_key)] = (False, self._op_counter + 1)
+            self._write(
+                "DELETE FROM hidden WHERE category = ? AND subcategory = ? AND file_key = ?",
+                (category, subcategory, file_key)
+            )
+    
+    def export(self):
+        self.flush()
+        conn = open_database(self.db_path)
+        conn.execute("BEGIN")
+        (total,) = conn.execute("SELECT COUNT(*) FROM hidden").fetchone()
+        return total, self._stream_hidden(conn)
+    
+    @staticmethod
+    def _stream_hidden(conn):
+        try:
+            rows = conn.execute(
+                "SELECT user_id, category, subcategory, file_key FROM hidden "
+                "ORDER BY user_id, category, subcategory, file_key"
+            )
+            for (user_id, category, subcategory), group in itertools.groupby(rows, key=lambda row: row[:3]):
+                yield user_id, category, subcategory, [row[3] for row in group]
+        finally:
+            conn.close()
+    
+    def restore(self, entries):
+        self.flush()
+        with self._write_lock:
+            self.write_conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.write_conn.execute("DELETE FROM hidden")
+                self.write_conn.executemany(
+                    "INSERT OR IGNORE INTO hidden VALUES (?, ?, ?, ?)",
+                    (
+                        (user_id, category, subcategory, file_key)
+                        for (user_id, category, subcategory), file_keys in entries.items()
+                        for file_key in file_keys
+                    )
+                )
+                self.write_conn.execute(PRUNE_HIDDEN_SQL)
+                self.write_conn.execute("COMMIT")
+            except BaseException:
+                self.write_conn.execute("ROLLBACK")
+                raise
+            with self._lock:
+                self._overlay = {}
+        self._notify("reset", None, None, None, None)
+        logger.info("SQLite hidden files restored")
+    
+    def get_hidden_files(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT category, subcategory, file_key FROM hidden WHERE user_id = ?",
+                (user_id,)
+            ).fetchall()
+            hidden = {row: True for row in rows}
+            for (uid, category, subcategory, file_key), (is_hidden, _) in self._overlay.items():
+                if uid == user_id:
+                    hidden[(category, subcategory, file_key)] = is_hidden
+        return [
+            {"category": category, "subcategory": subcategory, "file_key": file_key}
+            for (category, subcategory, file_key), is_hidden in hidden.items() if is_hidden
+        ]
+
+def migrate_json_to_sqlite(storage_path, hidden_path, db_path):
+    # Migration unique : ne s'exécute que si la base n'a jamais été alimentée
+    conn = open_database(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+            return
+        if conn.execute("SELECT 1 FROM files LIMIT 1").fetchone():
+            return
+        
+        started = time.perf_counter()
+        files, next_keys = [], {}
+        if storage_path.exists() or storage_path.with_suffix(".snap").exists():
+            json_storage = FileStorage(storage_path)
+            files, next_keys = list(json_storage.iter_files()), json_storage._next_ids
+            json_storage.close()
+        hidden = HiddenFiles(hidden_path).data if hidden_path.exists() else {}
+        
+        conn.execute("BEGIN")
+        conn.executemany(
+            FILE_INSERT_SQL,
+            (_file_row(cat, sub, file_data) for cat, sub, file_data in files)
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO next_keys VALUES (?, ?, ?)",
+            ((cat, sub, next_key) for (cat, sub), next_key in next_keys.items())
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO hidden VALUES (?, ?, ?, ?)",
+            (
+                (user_id, cat, sub, file_key)
+                for user_id, cats in hidden.items()
+                for cat, subs in cats.items()
+                for sub, file_keys in subs.items()
+                for file_key in file_keys
+            )
+        )
+        conn.execute(PRUNE_HIDDEN_SQL)
+        conn.execute(
+            "INSERT INTO meta VALUES ('migrated_from_json', ?)",
+            (datetime.now().isoformat(),)
+        )
+        conn.execute("COMMIT")
+        logger.info(f"JSON data migrated to SQLite in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.error(f"SQLite migration error: {str(e)}")
+        raise
+    finally:
+        conn.close()
+
+# Initialisation des stockages
+persistence = PersistenceWorker()
+if STORAGE_BACKEND == "sqlite":
+    migrate_json_to_sqlite(STORAGE_PATH, HIDDEN_PATH, DB_PATH)
+    storage = SqliteFileStorage(DB_PATH, persistence)
+    hidden_files = SqliteHiddenFiles(DB_PATH, persistence)
+else:
+    storage = FileStorage(STORAGE_PATH, persistence=persistence)
+    hidden_files = HiddenFiles(HIDDEN_PATH, persistence)
+    if storage.migrated:
+        hidden_files.drop_missing(storage)
+
+# Vues ordonnées des fichiers visibles
+class CacheGenerations:
+    # Génération par (catégorie, sous-catégorie), et une globale pour clear() :
+    # une entrée calculée hors verrou n'est gardée que si aucune invalidation
+    # (thread de synchronisation, listeners) n'est passée entre-temps. À
+    # appeler sous self._lock.
+    def _init_generations(self):
+        self._epoch = 0
+        self._generations = {}
+    
+    def _generation(self, category, subcategory):
+        return self._epoch, self._generations.get((category, subcategory), 0)
+    
+    def _bump(self, category=None, subcategory=None):
+        if category is None:
+            self._epoch += 1
+        else:
+            self._generations[(category, subcategory)] = self._generations.get((category, subcategory), 0) + 1
+
+class VisibleViews(CacheGenerations):
+    # Identifiants visibles dans l'ordre d'upload, par (utilisateur, catégorie,
+    # sous-catégorie) : une page ne coûte ensuite qu'un découpage de liste.
+    def __init__(self, max_entries=VIEW_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+        self._init_generations()
+    
+    def get(self, user_id, category, subcategory):
+        key = (str(user_id), category, subcategory)
+        with self._lock:
+            view = self._views.get(key)
+            if view is not None:
+                self._views.move_to_end(key)
+                return view
+            generation = self._generation(category, subcategory)
+        
+        hidden = hidden_files.hidden_keys(user_id, category, subcategory)
+        view = [k for k in storage.file_keys(category, subcategory) if k not in hidden]
+        with self._lock:
+            if self._generation(category, subcategory) == generation:
+                self._views[key] = view
+                if len(self._views) > self.max_entries:
+                    self._views.popitem(last=False)
+        return view
+    
+    def invalidate(self, category, subcategory, user_id=None):
+        with self._lock:
+            self._bump(category, subcategory)
+            if user_id is not None:
+                self._views.pop((str(user_id), category, subcategory), None)
+                return
+            for key in [k for k in self._views if k[1:] == (category, subcategory)]:
+                del self._views[key]
+    
+    def clear(self):
+        with self._lock:
+            self._bump()
+            self._views.clear()
+
+visible_views = VisibleViews()
+
+# Cache des claviers de fichiers déjà rendus
+class MarkupCache(CacheGenerations):
+    # LRU de (texte, clavier) par (catégorie, sous-catégorie, page, propriétaire).
+    # Le propriétaire vaut "admin", l'identifiant d'un utilisateur ayant des
+    # masquages dans la sous-catégorie, ou None : tous les autres utilisateurs
+    # partagent alors la même entrée.
+    def __init__(self, max_entries=MARKUP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._init_generations()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get_or_build(self, key, build):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self._generation(*key[:2])
+        
+        entry = build()
+        with self._lock:
+            if self._generation(*key[:2]) == generation:
+                self._entries[key] = entry
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return entry
+    
+    def invalidate(self, category, subcategory, user_id=None):
+        with self._lock:
+            self._bump(category, subcategory)
+            for key in [k for k in self._entries if k[:2] == (category, subcategory)]:
+                if user_id is None or key[3] == str(user_id):
+                    del self._entries[key]
+    
+    def clear(self):
+        with self._lock:
+            self._bump()
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+markup_cache = MarkupCache()
+metrics.gauge("konntek_markup_cache", "Cache des menus (entrées, hits, misses, évictions)", lambda: {
+    (("stat", stat),): value for stat, value in markup_cache.stats().items() if stat != "hit_ratio"
+})
+
+class BackgroundIndex:
+    # Index construits en tâche de fond à partir du catalogue. Le parcours se
+    # fait hors verrou dans des structures neuves ; les modifications notifiées
+    # pendant ce temps sont journalisées (et appliquées à l'index courant s'il
+    # existe), puis rejouées sur le nouvel index avant l'échange, sous verrou.
+    # Rejouer est sans effet pour ce que le parcours a déjà vu. Les lectures
+    # n'attendent jamais : sur la boucle, les handlers testent ready() ou
+    # attendent wait_ready() dans un thread.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._building = None
+        self._ready = threading.Event()
+    
+    def ready(self):
+        return self._ready.is_set()
+    
+    async def wait_ready(self):
+        if not self._ready.is_set():
+            await asyncio.to_thread(self._ready.wait)
+    
+    def _mutate(self, operation, *args):
+        with self._lock:
+            if self._building is not None:
+                self._building.append((operation, args))
+            if self._ready.is_set():
+                return operation(self, *args)
+    
+    def _rebuilt(self, fresh):
+        # Appelé sous self._lock : rejoue le journal sur `fresh` puis l'adopte
+        for operation, args in self._building:
+            operation(fresh, *args)
+        self._building = None
+        self._adopt(fresh)
+        self._ready.set()
+
+class ContentIndex(BackgroundIndex):
+    # {contenu: [(catégorie, sous-catégorie, id), ...]} sur tout le catalogue :
+    # détection des doublons en O(1) à l'upload. Le contenu est identifié par
+    # file_unique_id, ou par file_id pour les entrées antérieures qui n'en ont pas.
+    def __init__(self):
+        super().__init__()
+        self._locations = {}
+    
+    @staticmethod
+    def content_key(file_data):
+        return file_data.get("file_unique_id") or file_data["file_id"]
+    
+    def rebuild(self, storage):
+        with self._build_lock:
+            with self._lock:
+                self._building = []
+            fresh = ContentIndex()
+            for category, subcategory, file_data in storage.iter_files():
+                fresh._locations.setdefault(self.content_key(file_data), []).append(
+                    (category, subcategory, file_data["id"])
+                )
+            with self._lock:
+                self._rebuilt(fresh)
+    
+    def _adopt(self, fresh):
+        self._locations = fresh._locations
+    
+    def _add(self, category, subcategory, file_data):
+        location = (category, subcategory, file_data["id"])
+        locations = self._locations.setdefault(self.content_key(file_data), [])
+        if location not in locations:
+            locations.append(location)
+    
+    def _remove(self, category, subcategory, file_data):
+        key = self.content_key(file_data)
+        locations = self._locations.get(key, [])
+        if (category, subcategory, file_data["id"]) in locations:
+            locations.remove((category, subcategory, file_data["id"]))
+        if not locations:
+            self._locations.pop(key, None)
+    
+    def add(self, category, subcategory, file_data):
+        self._mutate(ContentIndex._add, category, subcategory, file_data)
+    
+    def remove(self, category, subcategory, file_data):
+        self._mutate(ContentIndex._remove, category, subcategory, file_data)
+    
+    def find(self, file_data):
+        with self._lock:
+            return list(self._locations.get(self.content_key(file_data), ()))
+    
+    def duplicates(self):
+        with self._lock:
+            return {key: list(locs) for key, locs in self._locations.items() if len(locs) > 1}
+
+content_index = ContentIndex()
+
+SEARCH_TOKEN_RE = re.compile(r"\d{4}-\d{2}(?:-\d{2})?|[a-z0-9]+")
+LIGATURES = str.maketrans({"œ": "oe", "Œ": "OE", "æ": "ae", "Æ": "AE", "ß": "ss"})
+
+def fold_text(text):
+    # Minuscules sans accents : « Réunion » et « reunion » donnent le même jeton
+    decomposed = unicodedata.normalize("NFKD", str(text).translate(LIGATURES))
+    return decomposed.encode("ascii", "ignore").decode("ascii").lower()
+
+def search_tokens(text):
+    return SEARCH_TOKEN_RE.findall(fold_text(text))
+
+class SearchIndex(BackgroundIndex):
+    # Index inversé en mémoire : {champ: {jeton: postings}}. Un posting est
+    # l'identifiant interne du document (int) tant qu'il est seul, puis un
+    # array d'identifiants croissants : les ajouts restent triés, l'appartenance
+    # se teste par dichotomie. Les suppressions laissent une tombe dans _docs,
+    # nettoyée par reconstruction quand elles dominent.
+    FIELDS = {"file_name": 3, "uploader": 1, "file_type": 1, "date": 1}
+    MAX_PREFIX_TOKENS = 1024
+    MAX_SCAN = 2000
+    
+    def __init__(self):
+        super().__init__()
+        self._compacting = False
+        self._reset()
+    
+    def _reset(self):
+        self._docs = []
+        self._doc_ids = {}
+        self._removed = 0
+        self._postings = {field: {} for field in self.FIELDS}
+        self._vocab = {field: [] for field in self.FIELDS}
+    
+    @staticmethod
+    def _field_tokens(file_data):
+        for field in SearchIndex.FIELDS:
+            value = file_data.get(field)
+            if not value:
+                continue
+            if field == "date":
+                value = value[:10]
+            yield field, set(search_tokens(value))
+    
+    def _index(self, category, subcategory, file_data, sort_vocab=True):
+        if (category, subcategory, file_data["id"]) in self._doc_ids:
+            return
+        doc = len(self._docs)
+        self._docs.append((category, subcategory, file_data["id"]))
+        self._doc_ids[(category, subcategory, file_data["id"])] = doc
+        for field, tokens in self._field_tokens(file_data):
+            postings = self._postings[field]
+            for token in tokens:
+                posting = postings.get(token)
+                if posting is None:
+                    postings[token] = doc
+                    if sort_vocab:
+                        insort(self._vocab[field], token)
+                elif isinstance(posting, int):
+                    postings[token] = array("I", (posting, doc))
+                else:
+                    posting.append(doc)
+    
+    def rebuild(self, storage):
+        with self._build_lock:
+            with self._lock:
+                self._building = []
+                self._storage = storage
+            fresh = SearchIndex()
+            for category, subcategory, file_data in storage.iter_files():
+                fresh._index(category, subcategory, file_data, sort_vocab=False)
+            fresh._vocab = {field: sorted(postings) for field, postings in fresh._postings.items()}
+            with self._lock:
+                self._rebuilt(fresh)
+    
+    def _adopt(self, fresh):
+        self._docs, self._doc_ids, self._removed = fresh._docs, fresh._doc_ids, fresh._removed
+        self._postings, self._vocab = fresh._postings, fresh._vocab
+    
+    def _unindex(self, category, subcategory, file_key):
+        doc = self._doc_ids.pop((category, subcategory, file_key), None)
+        if doc is None:
+            return False
+        self._docs[doc] = None
+        self._removed += 1
+        return self._removed > max(1000, len(self._doc_ids))
+    
+    def add(self, category, subcategory, file_data):
+        self._mutate(SearchIndex._index, category, subcategory, file_data)
+    
+    def remove(self, category, subcategory, file_key):
+        if not self._mutate(SearchIndex._unindex, category, subcategory, file_key):
+            return
+        # Nettoyage des tombes hors de la boucle : l'index courant reste lisible
+        # jusqu'à l'échange, un seul nettoyage à la fois
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self._compact, name="search-rebuild", daemon=True).start()
+    
+    def _compact(self):
+        try:
+            self.rebuild(self._storage)
+        finally:
+            with self._lock:
+                self._compacting = False
+    
+    def __len__(self):
+        return len(self._doc_ids)
+    
+    def _expand(self, term):
+        # (posting, poids) du terme : correspondance exacte (poids double) ou
+        # préfixe, dans chaque champ
+        matches = []
+        for field, weight in self.FIELDS.items():
+            postings = self._postings[field]
+            if term in postings:
+                matches.append((postings[term], weight * 2))
+            if len(term) < 2:
+                continue
+            vocab = self._vocab[field]
+            i = bisect_left(vocab, term)
+            for token in itertools.islice(vocab, i, i + self.MAX_PREFIX_TOKENS):
+                if not token.startswith(term):
+                    break
+                if token != term:
+                    matches.append((postings[token], weight))
+        return matches
+    
+    @staticmethod
+    def _contains(posting, doc):
+        if isinstance(posting, int):
+            return posting == doc
+        i = bisect_left(posting, doc)
+        return i < len(posting) and posting[i] == doc
+    
+    @staticmethod
+    def _size(posting):
+        return 1 if isinstance(posting, int) else len(posting)
+    
+    def _checker(self, matches, budget):
+        # Vérification d'appartenance d'un terme : dichotomie sur chaque
+        # posting, ou dictionnaire {doc: poids} si c'est moins cher pour le
+        # nombre de candidats attendu
+        if len(matches) * budget <= sum(self._size(p) for p, _ in matches):
+            return lambda doc: max((w for p, w in matches if self._contains(p, doc)), default=0)
+        weights = {}
+        for posting, weight in matches:
+            for doc in ((posting,) if isinstance(posting, int) else posting):
+                if weights.get(doc, 0) < weight:
+                    weights[doc] = weight
+        return lambda doc: weights.get(doc, 0)
+    
+    def search(self, query, user_id=None, limit=20):
+        terms = list(dict.fromkeys(search_tokens(query)))
+        if not terms:
+            return []
+        # Sous verrou : l'expansion (le vocabulaire trié bouge à chaque ajout) et
+        # la liste des documents courante. Le parcours se fait hors verrou, les
+        # ajouts de la boucle ne l'attendent pas : les postings ne font que
+        # croître, une suppression ne fait que vider son entrée de `docs`, une
+        # reconstruction remplace les structures sans modifier celles-ci.
+        with self._lock:
+            expanded = [self._expand(term) for term in terms]
+            docs = self._docs
+        if not all(expanded):
+            return []
+        # Le terme le plus sélectif fournit les candidats, du plus récent au
+        # plus ancien ; les autres sont vérifiés par dichotomie
+        expanded.sort(key=lambda matches: sum(self._size(p) for p, _ in matches))
+        driver = [reversed(p) if not isinstance(p, int) else iter((p,)) for p, _ in expanded[0]]
+        candidates = heapq.merge(*driver, reverse=True) if len(driver) > 1 else driver[0]
+        budget = min(sum(self._size(p) for p, _ in expanded[0]), self.MAX_SCAN * 4)
+        checkers = [self._checker(matches, budget) for matches in expanded]
+        # Les candidats arrivent du plus récent au plus ancien : dès que
+        # `limit` documents ont le score maximal, aucun suivant ne passe devant
+        max_score = sum(max(w for _, w in matches) for matches in expanded)
+        
+        found = []
+        perfect = 0
+        previous = None
+        for doc in candidates:
+            if doc == previous:
+                continue
+            previous = doc
+            location = docs[doc]
+            if location is None:
+                continue
+            score = 0
+            for check in checkers:
+                best = check(doc)
+                if not best:
+                    break
+                score += best
+            else:
+                if user_id is not None and hidden_files.is_hidden(user_id, *location):
+                    continue
+                found.append((score, doc, location))
+                perfect += score == max_score
+                if perfect >= limit or len(found) >= self.MAX_SCAN:
+                    break
+        return [location for _, _, location in heapq.nlargest(limit, found)]
+
+search_index = SearchIndex()
+
+class CatalogStats:
+    # Agrégats tenus à jour par les notifications du catalogue et des
+    # masquages : par sous-catégorie, par catégorie et au total, un Counter
+    # de fichiers, d'octets, de fichiers par type, par uploader et par jour ;
+    # fichiers masqués par (utilisateur, sous-catégorie). Toute lecture est un
+    # accès à un compteur. Construit en tâche de fond comme ContentIndex ;
+    # d'ici là, les totaux viennent du stockage. Un ajout ou une suppression
+    # notifié pendant la construction peut être compté deux fois ou manqué :
+    # reconcile() compare chaque sous-catégorie au compte exact du stockage
+    # et recompte celles qui divergent. Les masquages sont recomptés à chaque
+    # notification (len des masqués), ce qui ne dérive pas.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._building = None
+        self._reset()
+    
+    def _reset(self):
+        self._cells = {}
+        self._categories = {}
+        self._totals = Counter()
+        self._hidden = Counter()
+        self._hidden_by_category = Counter()
+        self._hidden_totals = Counter()
+        self._hidden_cells_by_user = Counter()
+        self._hidden_users = {}
+    
+    @staticmethod
+    def _entries(file_data):
+        return (
+            ("files", 1),
+            ("bytes", file_data.get("file_size") or 0),
+            (("type", file_data.get("file_type") or "unknown"), 1),
+            (("uploader", file_data.get("uploader") or "?"), 1),
+            (("day", str(file_data.get("date") or "?")[:10]), 1),
+        )
+    
+    def _account(self, category, subcategory, entries, sign):
+        for counter in (self._cells.setdefault((category, subcategory), Counter()),
+                        self._categories.setdefault(category, Counter()), self._totals):
+            for key, n in entries:
+                counter[key] += sign * n
+                if not counter[key]:
+                    del counter[key]
+    
+    def _count_cell(self, files):
+        cell = Counter()
+        for file_data in files:
+            for key, n in self._entries(file_data):
+                cell[key] += n
+        return +cell
+    
+    def _replace_cell(self, category, subcategory, cell):
+        old = Counter(self._cells.get((category, subcategory), ()))
+        self._account(category, subcategory, old.items(), -1)
+        self._account(category, subcategory, cell.items(), 1)
+    
+    def _set_hidden(self, user_id, category, subcategory, count):
+        key = (user_id, category, subcategory)
+        previous = self._hidden[key]
+        for counter, total_key in ((self._hidden_by_category, (user_id, category)),
+                                   (self._hidden_totals, category), (self._hidden_totals, None)):
+            counter[total_key] += count - previous
+            if not counter[total_key]:
+                del counter[total_key]
+        self._hidden_cells_by_user[user_id] += bool(count) - bool(previous)
+        if not self._hidden_cells_by_user[user_id]:
+            del self._hidden_cells_by_user[user_id]
+        self._hidden[key] = count
+        users = self._hidden_users.setdefault((category, subcategory), set())
+        if count:
+            users.add(user_id)
+        else:
+            del self._hidden[key]
+            users.discard(user_id)
+    
+    def rebuild(self, storage, hidden_files):
+        with self._build_lock:
+            self._rebuild(storage, hidden_files)
+    
+    def _rebuild(self, storage, hidden_files):
+        # Compté hors verrou ; les masquages notifiés entre-temps sont recomptés après
+        with self._lock:
+            self._ready.clear()
+            self._building = set()
+        cells = {}
+        for category, subcategory, file_data in storage.iter_files():
+            cell = cells.setdefault((category, subcategory), Counter())
+            for key, n in self._entries(file_data):
+                cell[key] += n
+        _, hidden = hidden_files.export()
+        with self._lock:
+            self._reset()
+            for (category, subcategory), cell in cells.items():
+                self._account(category, subcategory, cell.items(), 1)
+            for user_id, category, subcategory, file_keys in hidden:
+                self._set_hidden(user_id, category, subcategory, len(file_keys))
+            touched, self._building = self._building, None
+            self._ready.set()
+        for key in touched:
+            self._recount_hidden(*key)
+        self.reconcile(storage)
+    
+    def reconcile(self, storage):
+        cells = {(cat, sub) for cat in MAIN_CATEGORIES for sub in SUB_CATEGORIES} | set(self._cells)
+        drifted = [cell for cell in cells if self.count(*cell) != storage.count_files(*cell)]
+        for category, subcategory in drifted:
+            counted = self._count_cell(storage.get_files(category, subcategory))
+            with self._lock:
+                self._replace_cell(category, subcategory, counted)
+        if drifted:
+            logger.info(f"Catalog stats recounted for {len(drifted)} subcategorie(s)")
+        return len(drifted)
+    
+    def add(self, category, subcategory, file_data):
+        with self._lock:
+            if self._ready.is_set():
+                self._account(category, subcategory, self._entries(file_data), 1)
+    
+    def remove(self, category, subcategory, file_data):
+        with self._lock:
+            if self._ready.is_set():
+                self._account(category, subcategory, self._entries(file_data), -1)
+            users = list(self._hidden_users.get((category, subcategory), ()))
+        # Le fichier vient de quitter les masquages de ces utilisateurs
+        for user_id in users:
+            self._recount_hidden(user_id, category, subcategory)
+    
+    def _recount_hidden(self, user_id, category, subcategory):
+        count = len(hidden_files.hidden_keys(user_id, category, subcategory))
+        with self._lock:
+            if self._building is not None:
+                self._building.add((user_id, category, subcategory))
+            elif self._ready.is_set():
+                self._set_hidden(user_id, category, subcategory, count)
+    
+    def hidden_changed(self, user_id, category, subcategory):
+        if user_id is None:
+            # Masquages remplacés en bloc (restauration) : tout est recompté
+            threading.Thread(target=self.rebuild, args=(storage, hidden_files),
+                             name="stats-build", daemon=True).start()
+            return
+        self._recount_hidden(str(user_id), category, subcategory)
+    
+    def count(self, category=None, subcategory=None, key="files"):
+        with self._lock:
+            if self._ready.is_set():
+                if category is None:
+                    return self._totals[key]
+                if subcategory is None:
+                    return self._categories.get(category, Counter())[key]
+                return self._cells.get((category, subcategory), Counter())[key]
+        if key != "files":
+            return 0
+        subcategories = SUB_CATEGORIES if subcategory is None else (subcategory,)
+        categories = MAIN_CATEGORIES if category is None else (category,)
+        return sum(storage.count_files(cat, sub) for cat in categories for sub in subcategories)
+    
+    def visible(self, user_id, category, subcategory=None):
+        total = self.count(category, subcategory)
+        if not user_id:
+            return total
+        user_id = str(user_id)
+        with self._lock:
+            if self._ready.is_set():
+                if subcategory is None:
+                    return total - self._hidden_by_category[(user_id, category)]
+                return total - self._hidden[(user_id, category, subcategory)]
+        subcategories = SUB_CATEGORIES if subcategory is None else (subcategory,)
+        return total - sum(len(hidden_files.hidden_keys(user_id, category, sub)) for sub in subcategories)
+    
+    def menu_counts(self, user_id, category=None):
+        # Compteurs visibles d'un menu (catégories, ou sous-catégories de category) en une prise du verrou
+        user_id = str(user_id) if user_id else None
+        with self._lock:
+            if self._ready.is_set():
+                if category is None:
+                    return tuple(
+                        self._categories.get(cat, Counter())["files"] - self._hidden_by_category[(user_id, cat)]
+                        for cat in MAIN_CATEGORIES
+                    )
+                return tuple(
+                    self._cells.get((category, sub), Counter())["files"] - self._hidden[(user_id, category, sub)]
+                    for sub in SUB_CATEGORIES
+                )
+        if category is None:
+            return tuple(self.visible(user_id, cat) for cat in MAIN_CATEGORIES)
+        return tuple(self.visible(user_id, category, sub) for sub in SUB_CATEGORIES)
+    
+    def summary(self, category=None):
+        # Copie du Counter agrégé : fichiers, octets et répartitions
+        with self._lock:
+            if category is None:
+                counter = Counter(self._totals)
+            else:
+                counter = Counter(self._categories.get(category, ()))
+            hidden = self._hidden_totals[category]
+            users = len(self._hidden_cells_by_user)
+        breakdown = {"type": Counter(), "uploader": Counter(), "day": Counter()}
+        for key, n in counter.items():
+            if isinstance(key, tuple):
+                breakdown[key[0]][key[1]] = n
+        return {"ready": self._ready.is_set(), "files": counter["files"], "bytes": counter["bytes"],
+                "hidden": hidden, "hidden_users": users, **breakdown}
+
+catalog_stats = CatalogStats()
+
+class SpaceSaving:
+    # Top-k approximatif (Space-Saving, Metwally et al.) sur au plus
+    # `capacity` compteurs : un nouvel élément prend la place du plus petit et
+    # hérite de son compte, noté comme erreur maximale. Tout élément plus
+    # fréquent que total/capacity est présent, son compte surestimé d'au plus
+    # son erreur. Deux résumés s'additionnent puis sont tronqués ; un élément
+    # absent d'un résumé plein y compte pour son minimum, en erreur aussi.
+    __slots__ = ("capacity", "counts", "errors", "total", "_victims", "_victim_count")
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self._victims = []
+        self._victim_count = 0
+    
+    def _victim(self):
+        # Les comptes ne font que croître : tant qu'une clé a encore le
+        # minimum relevé, c'est un minimum. Un seul parcours pour toutes les
+        # clés à égalité, nombreuses dans la traîne d'une distribution.
+        while self._victims:
+            key = self._victims.pop()
+            if self.counts.get(key) == self._victim_count:
+                return key
+        self._victim_count = min(self.counts.values())
+        self._victims = [key for key, n in self.counts.items() if n == self._victim_count]
+        return self._victims.pop()
+    
+    def add(self, key, n=1):
+        self.total += n
+        if key in self.counts:
+            self.counts[key] += n
+            return
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            victim = self._victim()
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+        self.counts[key] = floor + n
+        self.errors[key] = floor
+    
+    def _floor(self):
+        # Compte maximal d'un élément absent d'un résumé plein
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+    
+    def merge(self, other):
+        mine, theirs = self._floor(), other._floor()
+        self._victims = []
+        if theirs:
+            for key in self.counts.keys() - other.counts.keys():
+                self.counts[key] += theirs
+                self.errors[key] += theirs
+        for key, n in other.counts.items():
+            if key in self.counts:
+                self.counts[key] += n
+                self.errors[key] += other.errors[key]
+            else:
+                self.counts[key] = n + mine
+                self.errors[key] = other.errors[key] + mine
+        self.total += other.total
+        if len(self.counts) > self.capacity:
+            for key in heapq.nsmallest(len(self.counts) - self.capacity, self.counts, key=self.counts.__getitem__):
+                del self.counts[key], self.errors[key]
+        return self
+
+POPULAR_MAGIC = b"KNTKPOP1"
+POPULAR_HEADER = struct.Struct("<8sI")
+POPULAR_BUCKET_HEADER = struct.Struct("<qQI")
+POPULAR_ENTRY = struct.Struct("<BBIII")
+
+class DownloadStats:
+    # Téléchargements par tranche de POPULAR_BUCKET secondes, chaque tranche
+    # résumée par un SpaceSaving : mémoire et fichier bornés quel que soit le
+    # trafic. Les téléchargements récents restent dans `_pending` et sont
+    # fusionnés au fichier toutes les POPULAR_SAVE_INTERVAL secondes (format
+    # binaire compact, remplacé atomiquement). En mode partagé, le fichier est
+    # relu sous verrou avant la fusion : il cumule toutes les instances.
+    # Un fichier est identifié par (catégorie, sous-catégorie, id), codé par
+    # les positions dans MAIN_CATEGORIES/SUB_CATEGORIES comme les callbacks.
+    def __init__(self, path, capacity=POPULAR_CAPACITY, bucket_seconds=POPULAR_BUCKET,
+                 window_days=POPULAR_WINDOW_DAYS, shared=SHARED_STORAGE):
+        self.path = path
+        self.capacity = capacity
+        self.bucket_seconds = bucket_seconds
+        self.window = window_days * 86400
+        self.shared = shared
+        self._process_lock = ProcessLock(path.with_suffix(".lock")) if shared else None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._top_cache = {}
+        self._buckets = self._read()
+        logger.info(f"Download stats loaded: {len(self._buckets)} bucket(s)")
+    
+    def record(self, category, subcategory, file_key, when=None):
+        start = int(when if when is not None else time.time()) // self.bucket_seconds * self.bucket_seconds
+        with self._lock:
+            bucket = self._pending.get(start)
+            if bucket is None:
+                bucket = self._pending[start] = SpaceSaving(self.capacity)
+            bucket.add((category, subcategory, file_key))
+    
+    def _read(self):
+        buckets = {}
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return buckets
+        try:
+            magic, count = POPULAR_HEADER.unpack_from(raw)
+            if magic != POPULAR_MAGIC:
+                raise ValueError("bad magic")
+            offset = POPULAR_HEADER.size
+            for _ in range(count):
+                start, total, entries = POPULAR_BUCKET_HEADER.unpack_from(raw, offset)
+                offset += POPULAR_BUCKET_HEADER.size
+                bucket = buckets[start] = SpaceSaving(self.capacity)
+                bucket.total = total
+                for cat_idx, sub_idx, file_key, n, error in POPULAR_ENTRY.iter_unpack(
+                    raw[offset:offset + entries * POPULAR_ENTRY.size]
+                ):
+                    key = (MAIN_CATEGORIES[cat_idx], SUB_CATEGORIES[sub_idx], file_key)
+                    bucket.counts[key] = n
+                    bucket.errors[key] = error
+                offset += entries * POPULAR_ENTRY.size
+        except Exception as e:
+            logger.error(f"Download stats load error: {str(e)}")
+            return {}
+        return buckets
+    
+    def _write(self, buckets):
+        chunks = [POPULAR_HEADER.pack(POPULAR_MAGIC, len(buckets))]
+        for start, bucket in sorted(buckets.items()):
+            chunks.append(POPULAR_BUCKET_HEADER.pack(start, bucket.total, len(bucket.counts)))
+            chunks.extend(
+                POPULAR_ENTRY.pack(MAIN_CATEGORIES.index(cat), SUB_CATEGORIES.index(sub), file_key,
+                                   n, bucket.errors[(cat, sub, file_key)])
+                for (cat, sub, file_key), n in bucket.counts.items()
+            )
+        tmp_path = self.path.with_suffix(".bin.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(b"".join(chunks))
+        os.replace(tmp_path, self.path)
+    
+    def save(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending and not self.shared:
+            return
+        cutoff = time.time() - self.window - self.bucket_seconds
+        lock = self._process_lock.hold() if self.shared else contextlib.nullcontext()
+        try:
+            with lock:
+                buckets = self._read() if self.shared else dict(self._buckets)
+                for start, bucket in pending.items():
+                    if start in buckets:
+                        # Copie : la tranche publiée reste intacte pour les lecteurs
+                        merged = SpaceSaving(self.capacity).merge(buckets[start])
+                        buckets[start] = merged.merge(bucket)
+                    else:
+                        buckets[start] = bucket
+                buckets = {start: bucket for start, bucket in buckets.items() if start >= cutoff}
+                if pending:
+                    self._write(buckets)
+        except Exception as e:
+            # Rien n'est perdu : les tranches reviennent dans _pending
+            logger.error(f"Download stats save error: {str(e)}")
+            with self._lock:
+                for start, bucket in pending.items():
+                    self._pending[start] = bucket.merge(self._pending[start]) if start in self._pending else bucket
+            return
+        with self._lock:
+            self._buckets = buckets
+            self._top_cache.clear()
+    
+    def top(self, seconds, limit=None):
+        # Fusion des tranches de la fenêtre, gardée POPULAR_REFRESH secondes :
+        # [(clé, compte, erreur)] par compte décroissant, et le total
+        now = time.monotonic()
+        with self._lock:
+            cached = self._top_cache.get(seconds)
+            if cached is None or cached[0] <= now:
+                cutoff = time.time() - seconds
+                merged = SpaceSaving(self.capacity)
+                for buckets in (self._buckets, self._pending):
+                    for start, bucket in buckets.items():
+                        if start + self.bucket_seconds > cutoff:
+                            merged.merge(bucket)
+                ranking = sorted(merged.counts.items(), key=lambda item: -item[1])
+                cached = self._top_cache[seconds] = (
+                    now + POPULAR_REFRESH,
+                    [(key, n, merged.errors[key]) for key, n in ranking],
+                    merged.total,
+                )
+        _, ranking, total = cached
+        return (ranking if limit is None else ranking[:limit]), total
+    
+    def close(self):
+        self.save()
+        if self._process_lock is not None:
+            self._process_lock.close()
+
+download_stats = DownloadStats(POPULAR_PATH)
+
+LOCATION_MAGIC = b"KNTKLOC1"
+# Utilisateur, horodatage (s), latitude et longitude en 1e-7 degré
+LOCATION_RECORD = struct.Struct("<qIii")
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+class LocationStore:
+    # Positions partagées : série temporelle par utilisateur (trois arrays,
+    # 12 octets par point) et dernière position de chacun rangée dans une
+    # grille de LOCATION_GRID_KM, si bien qu'une recherche par rayon ne visite
+    # que les mailles couvertes. Sur disque, un fichier par jour d'arrivée
+    # (UTC) d'enregistrements fixes, uniquement complété : une position en
+    # direct coûte un ajout, jamais une réécriture, et la rétention supprime
+    # des fichiers entiers. En mode partagé, les fichiers du jour servent de
+    # flux de changements entre instances, comme le journal du catalogue.
+    def __init__(self, directory, persistence=None, retention_days=LOCATION_RETENTION_DAYS,
+                 grid_km=LOCATION_GRID_KM, min_interval=LOCATION_MIN_INTERVAL, shared=SHARED_STORAGE):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.persistence = persistence
+        self.retention = retention_days * 86400
+        self.step = grid_km / KM_PER_DEGREE
+        self.lon_cells = math.ceil(360 / self.step)
+        self.min_interval = min_interval
+        self.shared = shared
+        self._process_lock = ProcessLock(directory / "locations.lock") if shared else None
+        self._lock = threading.RLock()
+        self._series = {}
+        self._latest = {}
+        self._grid = {}
+        self._cell_of = {}
+        self._pending = {}
+        self._offsets = {}
+        self._expired_day = None
+        started = time.perf_counter()
+        with (self._process_lock.hold() if shared else contextlib.nullcontext()), self._lock:
+            self._follow(sorted(path.stem for path in self.directory.glob("*.bin")))
+            self._expire()
+        users, points = self.counts()
+        logger.info(f"Locations loaded in {time.perf_counter() - started:.2f}s ({users} users, {points} points)")
+    
+    @staticmethod
+    def _day(ts):
+        return time.strftime("%Y%m%d", time.gmtime(ts))
+    
+    def _cell(self, lat, lon):
+        return (math.floor((lat / 1e7 + 90) / self.step),
+                math.floor((lon / 1e7 + 180) / self.step) % self.lon_cells)
+    
+    def _apply(self, user_id, ts, lat, lon):
+        series = self._series.get(user_id)
+        if series is None:
+            series = self._series[user_id] = (array("I"), array("i"), array("i"))
+        times, lats, lons = series
+        # Points d'autres instances : presque toujours dans l'ordre, sinon insérés à leur place
+        position = len(times) if not times or times[-1] <= ts else bisect_left(times, ts)
+        times.insert(position, ts)
+        lats.insert(position, lat)
+        lons.insert(position, lon)
+        self._move(user_id, ts, lat, lon)
+    
+    def _move(self, user_id, ts, lat, lon):
+        latest = self._latest.get(user_id)
+        if latest is not None and latest[0] > ts:
+            return
+        self._latest[user_id] = (ts, lat, lon)
+        cell = self._cell(lat, lon)
+        previous = self._cell_of.get(user_id)
+        if previous == cell:
+            return
+        if previous is not None:
+            self._grid[previous].discard(user_id)
+            if not self._grid[previous]:
+                del self._grid[previous]
+        self._grid.setdefault(cell, set()).add(user_id)
+        self._cell_of[user_id] = cell
+    
+    def _forget(self, user_id):
+        del self._latest[user_id]
+        cell = self._cell_of.pop(user_id)
+        self._grid[cell].discard(user_id)
+        if not self._grid[cell]:
+            del self._grid[cell]
+    
+    def _follow(self, days):
+        # Lit ce qui a été ajouté aux fichiers de ces jours depuis le dernier passage
+        for day in days:
+            path = self.directory / f"{day}.bin"
+            offset = self._offsets.get(path.name, 0)
+            try:
+                if offset and path.stat().st_size <= offset:
+                    continue
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    raw = f.read()
+            except FileNotFoundError:
+                continue
+            if not offset:
+                if not raw.startswith(LOCATION_MAGIC):
+                    if raw:
+                        logger.error(f"Locations load error ({path.name}): unknown format")
+                    continue
+                raw, offset = raw[len(LOCATION_MAGIC):], len(LOCATION_MAGIC)
+            # Un enregistrement incomplet (arrêt brutal) est ignoré, puis tronqué à la prochaine écriture
+            usable = len(raw) - len(raw) % LOCATION_RECORD.size
+            for user_id, ts, lat, lon in LOCATION_RECORD.iter_unpack(memoryview(raw)[:usable]):
+                self._apply(user_id, ts, lat, lon)
+            self._offsets[path.name] = offset + usable
+    
+    def _expire(self):
+        # Une fois par jour : points hors rétention oubliés, fichiers supprimés
+        cutoff = int(time.time()) - self.retention
+        day = self._day(cutoff)
+        if day == self._expired_day:
+            return
+        self._expired_day = day
+        for user_id, (times, lats, lons) in list(self._series.items()):
+            start = bisect_left(times, cutoff)
+            if start:
+                del times[:start], lats[:start], lons[:start]
+            if not times:
+                del self._series[user_id]
+        for user_id in [u for u, (ts, _, _) in self._latest.items() if ts < cutoff]:
+            self._forget(user_id)
+        for path in self.directory.glob("*.bin"):
+            if path.stem < day:
+                path.unlink(missing_ok=True)
+                self._offsets.pop(path.name, None)
+    
+    def record(self, user_id, latitude, longitude, when=None):
+        # Renvoie False quand le point ne fait que mettre à jour la dernière position
+        ts = int(when if when is not None else time.time())
+        user_id = int(user_id)
+        lat, lon = round(latitude * 1e7), round(longitude * 1e7)
+        with self._lock:
+            series = self._series.get(user_id)
+            if series is not None and series[0] and 0 <= ts - series[0][-1] < self.min_interval:
+                self._move(user_id, ts, lat, lon)
+                return False
+            self._apply(user_id, ts, lat, lon)
+            # Fichier du jour d'arrivée, pas de l'horodatage : seul le fichier courant grandit
+            self._pending.setdefault(self._day(time.time()), bytearray()).extend(
+                LOCATION_RECORD.pack(user_id, ts, lat, lon)
+            )
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self, self.flush)
+        else:
+            self.flush()
+        return True
+    
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        lock = self._process_lock.hold() if self.shared else contextlib.nullcontext()
+        try:
+            # Verrou tenu pendant l'ajout : sync() ne doit pas relire nos propres points
+            with lock, self._lock:
+                if self.shared:
+                    # Rattrape les autres instances : les offsets suivent ensuite nos propres ajouts
+                    self._follow(sorted(pending))
+                for day, chunk in sorted(pending.items()):
+                    path = self.directory / f"{day}.bin"
+                    with open(path, 'ab') as f:
+                        size = f.tell()
+                        if size < len(LOCATION_MAGIC):
+                            f.truncate(0)
+                            f.write(LOCATION_MAGIC)
+                            size = len(LOCATION_MAGIC)
+                        elif (size - len(LOCATION_MAGIC)) % LOCATION_RECORD.size:
+                            size -= (size - len(LOCATION_MAGIC)) % LOCATION_RECORD.size
+                            f.truncate(size)
+                        f.write(chunk)
+                    self._offsets[path.name] = size + len(chunk)
+                    del pending[day]
+                self._expire()
+        except Exception:
+            # Les points non écrits reviennent en attente, devant les plus récents
+            with self._lock:
+                for day, chunk in pending.items():
+                    self._pending[day] = chunk + self._pending.get(day, b"")
+            raise
+    
+    def sync(self):
+        # Mode partagé : seuls les fichiers d'hier et d'aujourd'hui grandissent encore
+        now = time.time()
+        with self._lock:
+            self._follow(sorted({self._day(now - 86400), self._day(now)}))
+    
+    def latest(self, user_id):
+        with self._lock:
+            latest = self._latest.get(int(user_id))
+        if latest is None:
+            return None
+        ts, lat, lon = latest
+        return ts, lat / 1e7, lon / 1e7
+    
+    def latest_positions(self, limit=None):
+        # Dernière position de chaque utilisateur, la plus récente d'abord
+        with self._lock:
+            items = list(self._latest.items())
+        if limit is not None:
+            items = heapq.nlargest(limit, items, key=lambda item: item[1][0])
+        else:
+            items.sort(key=lambda item: -item[1][0])
+        return [(user_id, ts, lat / 1e7, lon / 1e7) for user_id, (ts, lat, lon) in items]
+    
+    def within(self, latitude, longitude, radius_km, limit=None):
+        # Dernières positions à moins de radius_km, par distance croissante :
+        # [(distance, utilisateur, horodatage, latitude, longitude)]
+        dlat = radius_km / KM_PER_DEGREE
+        lat_min, lat_max = max(-90.0, latitude - dlat), min(90.0, latitude + dlat)
+        cos_lat = math.cos(math.radians(max(abs(lat_min), abs(lat_max))))
+        dlon = radius_km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 360.0
+        rows = range(math.floor((lat_min + 90) / self.step), math.floor((lat_max + 90) / self.step) + 1)
+        first = math.floor((longitude - dlon + 180) / self.step)
+        last = math.floor((longitude + dlon + 180) / self.step)
+        columns = range(self.lon_cells) if last - first + 1 >= self.lon_cells else {
+            column % self.lon_cells for column in range(first, last + 1)
+        }
+        found = []
+        with self._lock:
+            if len(rows) * len(columns) > len(self._latest):
+                # Rayon très large : parcourir les utilisateurs coûte moins que les mailles
+                candidates = list(self._latest)
+            else:
+                candidates = [user_id for row in rows for column in columns
+                              for user_id in self._grid.get((row, column), ())]
+            for user_id in candidates:
+                ts, lat, lon = self._latest[user_id]
+                distance = haversine_km(latitude, longitude, lat / 1e7, lon / 1e7)
+                if distance <= radius_km:
+                    found.append((distance, user_id, ts, lat / 1e7, lon / 1e7))
+        found.sort()
+        return found if limit is None else found[:limit]
+    
+    def history(self, user_id, since=None):
+        with self._lock:
+            series = self._series.get(int(user_id))
+            if series is None:
+                return []
+            times, lats, lons = series
+            start = bisect_left(times, since) if since is not None else 0
+            return [(times[i], lats[i] / 1e7, lons[i] / 1e7) for i in range(start, len(times))]
+    
+    def counts(self):
+        with self._lock:
+            return len(self._latest), sum(len(times) for times, _, _ in self._series.values())
+    
+    def close(self):
+        if self._process_lock is not None:
+            self._process_lock.close()
+
+location_store = LocationStore(LOCATION_DIR, persistence)
+
+metrics.gauge("konntek_catalog_files", "Fichiers par sous-catégorie", lambda: {
+    (("category", cat), ("subcategory", sub)): storage.count_files(cat, sub)
+    for cat in MAIN_CATEGORIES for sub in SUB_CATEGORIES
+})
+metrics.gauge("konntek_search_index_entries", "Entrées de l'index de recherche", lambda: len(search_index))
+
+def on_catalog_change(event, category, subcategory, file_data):
+    if event == "reload":
+        # Catalogue relu depuis le snapshot d'une autre instance
+        visible_views.clear()
+        markup_cache.clear()
+        threading.Thread(target=build_indexes, name="index-build", daemon=True).start()
+        return
+    if event == "remove":
+        hidden_files.forget_file(category, subcategory, file_data["id"])
+        content_index.remove(category, subcategory, file_data)
+        search_index.remove(category, subcategory, file_data["id"])
+        catalog_stats.remove(category, subcategory, file_data)
+    else:
+        content_index.add(category, subcategory, file_data)
+        search_index.add(category, subcategory, file_data)
+        catalog_stats.add(category, subcategory, file_data)
+    visible_views.invalidate(category, subcategory)
+    markup_cache.invalidate(category, subcategory)
+
+def on_hidden_change(event, user_id, category, subcategory, file_key):
+    catalog_stats.hidden_changed(user_id, category, subcategory)
+    if event == "reset":
+        visible_views.clear()
+        markup_cache.clear()
+        return
+    visible_views.invalidate(category, subcategory, user_id)
+    markup_cache.invalidate(category, subcategory, user_id)
+
+storage.add_listener(on_catalog_change)
+hidden_files.add_listener(on_hidden_change)
+
+def build_indexes():
+    # Hors du chemin de démarrage : le parcours complet du catalogue ne
+    # retarde plus la première réponse du bot
+    started = time.perf_counter()
+    content_index.rebuild(storage)
+    search_index.rebuild(storage)
+    catalog_stats.rebuild(storage, hidden_files)
+    logger.info(f"Indexes built in {time.perf_counter() - started:.2f}s ({len(search_index)} files)")
+    prefetch_popular()
+
+def prefetch_popular():
+    # Fichiers les plus demandés : leurs sous-catégories sont décodées d'avance,
+    # le premier clic ne paie pas le décodage sur la boucle
+    started = time.perf_counter()
+    ranking, _ = download_stats.top(POPULAR_MENU_DAYS * 86400, POPULAR_CAPACITY)
+    warmed = 0
+    for (category, subcategory, file_key), _, _ in ranking:
+        try:
+            storage.get_file(category, subcategory, file_key)
+            warmed += 1
+        except KeyError:
+            continue
+    if warmed:
+        logger.info(f"Prefetched {warmed} popular file(s) in {time.perf_counter() - started:.2f}s")
+
+threading.Thread(target=build_indexes, name="index-build", daemon=True).start()
+
+def save_download_stats():
+    while True:
+        time.sleep(POPULAR_SAVE_INTERVAL)
+        download_stats.save()
+        # Classement du menu recalculé ici plutôt qu'au prochain clic
+        download_stats.top(POPULAR_MENU_DAYS * 86400)
+
+threading.Thread(target=save_download_stats, name="popular-save", daemon=True).start()
+
+def sync_instances():
+    # Mode partagé : applique les écritures des autres instances et invalide les caches
+    while True:
+        time.sleep(SHARED_POLL_INTERVAL)
+        for store in (storage, hidden_files, location_store):
+            try:
+                store.sync()
+            except Exception as e:
+                logger.error(f"Shared storage sync error: {str(e)}")
+
+if SHARED_STORAGE and STORAGE_BACKEND != "sqlite":
+    threading.Thread(target=sync_instances, name="storage-sync", daemon=True).start()
+
+async def mutate_storage(mutation, *args):
+    # Mode partagé : verrou inter-processus, rattrapage du journal commun et
+    # écriture immédiate ; hors de la boucle, le temps d'attendre les autres
+    # instances. Ailleurs l'écriture part déjà au PersistenceWorker.
+    if getattr(storage, "shared", False):
+        return await asyncio.to_thread(mutation, *args)
+    return mutation(*args)
+
+def shutdown_storage():
+    # Vide les écritures en attente puis ferme les fichiers
+    persistence.stop()
+    storage.close()
+    if isinstance(hidden_files, SqliteStore):
+        hidden_files.close()
+    download_stats.close()
+    location_store.close()
+
+# Sauvegarde : JSON lines gzip, un en-tête (compteurs, next_ids), une ligne
+# par fichier (groupés par sous-catégorie), une par sous-catégorie masquée
+# d'un utilisateur, puis une ligne de fin qui fait rejeter un fichier tronqué.
+# Écriture et lecture en flux dans un thread : mémoire bornée par le lot.
+def write_backup(path, progress):
+    next_ids, total, files = storage.export()
+    hidden_total, hidden = hidden_files.export()
+    progress[1] = total
+    dumps = functools.partial(json.dumps, ensure_ascii=False, separators=(',', ':'), default=FileRecord.to_dict)
+    tmp_path = path.with_name(path.name + ".tmp")
+    file_count = hidden_count = 0
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=BACKUP_COMPRESSION) as f:
+            f.write(dumps({"type": "header", "version": BACKUP_VERSION, "created": datetime.now().isoformat(),
+                           "files": total, "hidden": hidden_total, "next_ids": next_ids}) + "\n")
+            lines = []
+            for category, subcategory, file_data in files:
+                lines.append(dumps({"type": "file", "c": category, "s": subcategory, "file": file_data}))
+                file_count += 1
+                if len(lines) >= BACKUP_CHUNK:
+                    f.write("\n".join(lines) + "\n")
+                    progress[0] = file_count
+                    lines = []
+            for user_id, category, subcategory, file_keys in hidden:
+                file_keys = list(file_keys)
+                lines.append(dumps({"type": "hidden", "u": user_id, "c": category, "s": subcategory, "keys": file_keys}))
+                hidden_count += len(file_keys)
+            lines.append(dumps({"type": "end", "files": file_count, "hidden": hidden_count}))
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return file_count, hidden_count
+
+def read_backup(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def restore_backup(path, progress):
+    # Remplace catalogue et masquages ; rien n'est remplacé si la sauvegarde
+    # est illisible, tronquée ou incomplète
+    records = read_backup(path)
+    header = next(records, None)
+    if not header or header.get("type") != "header" or header.get("version") != BACKUP_VERSION:
+        raise ValueError("missing header or unsupported backup version")
+    progress[1] = header["files"]
+    hidden, hidden_count, end = {}, 0, None
+    with storage.restoring(header["next_ids"]) as load:
+        for record in records:
+            if record["type"] == "file":
+                load(record["c"], record["s"], record["file"])
+                progress[0] += 1
+            elif record["type"] == "hidden":
+                hidden[(record["u"], record["c"], record["s"])] = record["keys"]
+                hidden_count += len(record["keys"])
+            elif record["type"] == "end":
+                end = record
+                break
+        if end is None or (end["files"], end["hidden"]) != (progress[0], hidden_count):
+            raise ValueError("truncated or incomplete backup")
+    hidden_files.restore(hidden)
+    return progress[0], hidden_count
+
+def prune_backups():
+    for path in sorted(BACKUP_DIR.glob("konntek-*.jsonl.gz"))[:-BACKUP_KEEP]:
+        path.unlink(missing_ok=True)
+
+# Helpers
+def log_activity(user_id: int, action: str, details: str = None, category=None, subcategory=None,
+                 latency_ms=None, **fields):
+    rate = ACTIVITY_SAMPLING.get(action, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    event = {"user_id": user_id, "action": action}
+    if category is not None:
+        event["category"] = category
+        event["subcategory"] = subcategory
+    if details:
+        event["details"] = details
+    if latency_ms is not None:
+        event["latency_ms"] = round(latency_ms, 2)
+    event.update(fields)
+    if rate < 1.0:
+        # Pour extrapoler les volumes à partir de l'échantillon
+        event["sample_rate"] = rate
+    activity_logger.info(action, extra={"activity": event})
+
+def create_main_menu(user_id=None):
+    counts = catalog_stats.menu_counts(user_id)
+    return _main_menu(bool(user_id) and hidden_files.has_hidden(user_id), counts)
+
+# Menus avec compteurs : un clavier par jeu de compteurs (InlineKeyboardMarkup
+# est immuable), reconstruit seulement quand un compteur change
+@functools.lru_cache(maxsize=MENU_CACHE_SIZE)
+def _main_menu(show_hidden, counts):
+    keyboard = []
+    for cat, count in zip(MAIN_CATEGORIES, counts):
+        keyboard.append([InlineKeyboardButton(f"{cat} ({count})", callback_data=f"cat_{category_code(cat)}")])
+    keyboard.append([InlineKeyboardButton("🔥 Populaires", callback_data="popular")])
+    
+    # Ajouter le bouton pour les fichiers masqués
+    if show_hidden:
+        keyboard.append([InlineKeyboardButton("👁️‍🗨️ Fichiers masqués", callback_data="view_hidden")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+def create_subcategory_menu(category, user_id=None):
+    counts = catalog_stats.menu_counts(user_id, category)
+    return _subcategory_menu(category, counts, category == GEO_CATEGORY and user_id == ADMIN_ID)
+
+@functools.lru_cache(maxsize=MENU_CACHE_SIZE)
+def _subcategory_menu(category, counts, show_positions=False):
+    keyboard = []
+    for sub, count in zip(SUB_CATEGORIES, counts):
+        keyboard.append([InlineKeyboardButton(f"{sub} ({count})", callback_data=f"sub_{cell_code(category, sub)}")])
+    # Géolocalisation : positions partagées par les utilisateurs (admin)
+    if show_positions:
+        keyboard.append([InlineKeyboardButton("📍 Positions partagées", callback_data="geo")])
+    keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+# Les callbacks désignent une sous-catégorie par ses positions dans
+# MAIN_CATEGORIES/SUB_CATEGORIES pour rester sous la limite de 64 octets
+def category_code(category):
+    return str(MAIN_CATEGORIES.index(category))
+
+def cell_code(category, subcategory):
+    return f"{category_code(category)}.{SUB_CATEGORIES.index(subcategory)}"
+
+def _parse_index(code, names):
+    # ValueError pour tout code inconnu (ancien clavier, donnée forgée)
+    if not code.isdigit() or int(code) >= len(names):
+        raise ValueError(f"Unknown code in callback data: {code!r}")
+    return names[int(code)]
+
+def parse_category(code):
+    return _parse_index(code, MAIN_CATEGORIES)
+
+def parse_cell(code):
+    cat_idx, sep, sub_idx = code.partition(".")
+    if not sep:
+        raise ValueError(f"Unknown code in callback data: {code!r}")
+    return parse_category(cat_idx), _parse_index(sub_idx, SUB_CATEGORIES)
+
+# Formats de callback_data : actions sans argument, et nombre d'entiers qui
+# suivent le code de sous-catégorie
+CALLBACK_PLAIN = {"noop", "view_hidden", "confirm_delete", "popular", "geo", "back_to_main"}
+CALLBACK_CELL_ARGS = {"sub": 0, "dl": 0, "upload": 0, "pg": 1, "file": 1, "del": 1, "unhide": 1, "hide": 2}
+
+def valid_callback(data):
+    # Les claviers envoyés avant un changement de format (noms de catégories
+    # en clair par exemple) restent cliquables : vérifié avant tout traitement
+    try:
+        if data in CALLBACK_PLAIN:
+            return True
+        if data.startswith("back_to_sub_"):
+            parse_category(data[len("back_to_sub_"):])
+            return True
+        action, *args = data.split("_")
+        if action == "hpg":
+            return len(args) == 1 and args[0].isdigit()
+        if action == "cat":
+            expected, parse = 1, parse_category
+        else:
+            expected, parse = CALLBACK_CELL_ARGS.get(action, -2) + 1, parse_cell
+        if len(args) != expected:
+            return False
+        parse(args[0])
+        return all(arg.isdigit() for arg in args[1:])
+    except ValueError:
+        return False
+
+def clamp_page(page, total):
+    pages = max(1, math.ceil(total / FILE_PAGE_SIZE))
+    return min(max(page, 0), pages - 1), pages
+
+def pagination_rows(prefix, page, pages):
+    if pages <= 1:
+        return []
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}_{page-1}"))
+    nav.append(InlineKeyboardButton(f"{page+1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}_{page+1}"))
+    
+    # Accès direct : première et dernière page, et les pages voisines
+    jumps = sorted({0, pages - 1, *range(max(0, page - 2), min(pages, page + 3))} - {page})
+    jump_row = [InlineKeyboardButton(str(n + 1), callback_data=f"{prefix}_{n}") for n in jumps]
+    return [nav, jump_row]
+
+def render_file_menu(category, subcategory, user_id, page=0):
+    if user_id == ADMIN_ID:
+        owner = "admin"
+    elif hidden_files.has_hidden(user_id, category, subcategory):
+        owner = str(user_id)
+    else:
+        owner = None
+    return markup_cache.get_or_build(
+        (category, subcategory, page, owner),
+        lambda: (
+            file_menu_text(category, subcategory, user_id, page),
+            create_file_menu(category, subcategory, user_id, page)
+        )
+    )
+
+def file_menu_text(category, subcategory, user_id, page=0):
+    visible = len(visible_views.get(user_id, category, subcategory))
+    page, pages = clamp_page(page, visible)
+    msg = f"📂 {category} / {subcategory}\n\n"
+    msg += "Aucun fichier disponible." if not visible else f"{visible} fichier(s) disponible(s) :"
+    if pages > 1:
+        msg += f"\n📄 Page {page+1}/{pages}"
+    return msg
+
+def create_file_menu(category, subcategory, user_id, page=0):
+    view = visible_views.get(user_id, category, subcategory)
+    page, pages = clamp_page(page, len(view))
+    start = page * FILE_PAGE_SIZE
+    files = storage.get_files_by_keys(category, subcategory, view[start:start + FILE_PAGE_SIZE])
+    code = cell_code(category, subcategory)
+    keyboard = []
+    
+    for position, file in enumerate(files, start):
+        file_key = file["id"]
+        file_name = file.get('file_name', f'Fichier {position+1}')
+        btn_row = [
+            InlineKeyboardButton(f"⬇️ {file_name}", callback_data=f"file_{code}_{file_key}")
+        ]
+        
+        # Boutons d'action
+        if user_id == ADMIN_ID:
+            btn_row.append(InlineKeyboardButton("🗑️", callback_data=f"del_{code}_{file_key}"))
+        else:
+            btn_row.append(InlineKeyboardButton("👁️", callback_data=f"hide_{code}_{file_key}_{page}"))
+        
+        keyboard.append(btn_row)
+    
+    keyboard.extend(pagination_rows(f"pg_{code}", page, pages))
+    if len(view) > 1:
+        keyboard.append([InlineKeyboardButton(f"📦 Tout télécharger ({len(view)})", callback_data=f"dl_{code}")])
+    footer = [InlineKeyboardButton("🔙 Retour", callback_data=f"back_to_sub_{category_code(category)}")]
+    
+    # Bouton upload uniquement pour admin
+    if user_id == ADMIN_ID:
+        footer.append(InlineKeyboardButton("➕ Upload", callback_data=f"upload_{code}"))
+    
+    keyboard.append(footer)
+    return InlineKeyboardMarkup(keyboard)
+
+def create_popular_menu(user_id):
+    # Classement commun à tous, filtré des fichiers supprimés ou masqués
+    ranking, _ = download_stats.top(POPULAR_MENU_DAYS * 86400)
+    keyboard = []
+    for (category, subcategory, file_key), _, _ in ranking:
+        if hidden_files.is_hidden(user_id, category, subcategory, file_key):
+            continue
+        try:
+            file_name = storage.get_file(category, subcategory, file_key)["file_name"]
+        except KeyError:
+            continue
+        keyboard.append([InlineKeyboardButton(
+            f"⬇️ {file_name}", callback_data=f"file_{cell_code(category, subcategory)}_{file_key}"
+        )])
+        if len(keyboard) == POPULAR_MENU_SIZE:
+            break
+    keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard), len(keyboard) - 1
+
+def create_hidden_files_menu(user_id, page=0):
+    hidden_list = hidden_files.get_hidden_files(user_id)
+    page, pages = clamp_page(page, len(hidden_list))
+    start = page * FILE_PAGE_SIZE
+    keyboard = []
+    
+    for item in hidden_list[start:start + FILE_PAGE_SIZE]:
+        cat = item["category"]
+        sub = item["subcategory"]
+        file_key = item["file_key"]
+        
+        try:
+            file_data = storage.get_file(cat, sub, file_key)
+            file_name = file_data.get('file_name', f'Fichier {file_key+1}')
+            btn_text = f"{cat}/{sub} - {file_name}"
+            keyboard.append([
+                InlineKeyboardButton(btn_text, callback_data=f"unhide_{cell_code(cat, sub)}_{file_key}")
+            ])
+        except:
+            continue
+    
+    keyboard.extend(pagination_rows("hpg", page, pages))
+    keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+# Envoi des fichiers
+# Types regroupables dans un même album : Telegram mélange photos et vidéos,
+# mais documents et audios ne se groupent qu'entre eux. Les vocaux et types
+# inconnus partent un par un.
+MEDIA_GROUP_KINDS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo,
+               "document": InputMediaDocument, "audio": InputMediaAudio}
+
+async def send_file(bot, chat_id, file_data):
+    caption = f"📥 {file_data['file_name']}"
+    file_type = file_data.get("file_type")
+    if file_type == "photo":
+        await bot.send_photo(chat_id=chat_id, photo=file_data["file_id"], caption=caption)
+    elif file_type == "video":
+        await bot.send_video(chat_id=chat_id, video=file_data["file_id"], caption=caption)
+    elif file_type == "audio":
+        await bot.send_audio(chat_id=chat_id, audio=file_data["file_id"], caption=caption)
+    elif file_type == "voice":
+        await bot.send_voice(chat_id=chat_id, voice=file_data["file_id"], caption=caption)
+    else:
+        await bot.send_document(chat_id=chat_id, document=file_data["file_id"], caption=caption)
+
+async def send_media_batch(bot, chat_id, batch):
+    if len(batch) == 1:
+        await send_file(bot, chat_id, batch[0])
+        return
+    await bot.send_media_group(chat_id=chat_id, media=[
+        INPUT_MEDIA[f["file_type"]](f["file_id"], caption=f"📥 {f['file_name']}") for f in batch
+    ])
+
+async def send_subcategory(bot, chat_id, user_id, category, subcategory):
+    # Envoi progressif : chaque album part dès qu'il est complet, pendant que
+    # la suite de la vue est encore lue
+    view = visible_views.get(user_id, category, subcategory)
+    pending = {}
+    sent = 0
+    for start in range(0, len(view), MEDIA_GROUP_SIZE):
+        for file_data in storage.get_files_by_keys(category, subcategory, view[start:start + MEDIA_GROUP_SIZE]):
+            kind = MEDIA_GROUP_KINDS.get(file_data.get("file_type"))
+            if kind is None:
+                await send_file(bot, chat_id, file_data)
+                sent += 1
+                continue
+            batch = pending.setdefault(kind, [])
+            batch.append(file_data)
+            if len(batch) == MEDIA_GROUP_SIZE:
+                await send_media_batch(bot, chat_id, batch)
+                sent += len(batch)
+                pending[kind] = []
+    for batch in pending.values():
+        if batch:
+            await send_media_batch(bot, chat_id, batch)
+            sent += len(batch)
+    return sent
+
+async def download_all(context, chat_id, user_id, category, subcategory):
+    try:
+        started = time.perf_counter()
+        sent = await send_subcategory(context.bot, chat_id, user_id, category, subcategory)
+        log_activity(user_id, "DOWNLOAD_ALL", category=category, subcategory=subcategory,
+                     latency_ms=(time.perf_counter() - started) * 1000, files=sent)
+        await context.bot.send_message(chat_id=chat_id, text=f"✅ {sent} fichier(s) envoyé(s)")
+    except Exception as e:
+        logger.error(f"Bulk download error: {str(e)}")
+        await context.bot.send_message(chat_id=chat_id, text="❌ Erreur lors du téléchargement groupé")
+    finally:
+        context.user_data.pop('bulk_download', None)
+
+# Commandes
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    welcome_msg = (
+        "🌟 Bienvenue sur Konntek_Bot !\n\n"
+        "📂 Accédez à la médiathèque organisée par catégories.\n"
+        "📍 Envoyez /location pour partager votre position."
+    )
+    await update.message.reply_text(
+        welcome_msg, 
+        reply_markup=create_main_menu(user.id)
+    )
+    log_activity(user.id, "START", user.first_name)
+
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    
+    stats = markup_cache.stats()
+    static = _subcategory_menu.cache_info()
+    await update.message.reply_text(
+        "🧮 Cache des menus\n\n"
+        f"Entrées : {stats['entries']}/{stats['max_entries']}\n"
+        f"Hits : {stats['hits']} | Misses : {stats['misses']} ({stats['hit_ratio']:.1%})\n"
+        f"Évictions : {stats['evictions']}\n"
+        f"Menus de catégories : {static.hits} hits, {static.currsize} construits"
+    )
+    
+    limiter = context.bot.rate_limiter
+    if isinstance(limiter, OutboundRateLimiter):
+        sent = limiter.counters
+        await update.message.reply_text(
+            "📤 Envois API\n\n"
+            f"Requêtes : {sent['requests']} | Ralenties : {sent['throttled']}\n"
+            f"Réessais (flood) : {sent['retries']} | Éditions fusionnées : {sent['collapsed']}"
+        )
+
+STATS_TOP = 5
+STATS_DAYS = 7
+
+async def catalog_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    
+    # /stats : tout le catalogue ; /stats <catégorie> : détail par sous-catégorie
+    category = " ".join(context.args) if context.args else None
+    if category is not None and category not in MAIN_CATEGORIES:
+        await update.message.reply_text(f"❌ Catégorie inconnue. Catégories : {', '.join(MAIN_CATEGORIES)}")
+        return
+    # Rattrape un éventuel écart laissé par la construction (comptes exacts du stockage)
+    await asyncio.to_thread(catalog_stats.reconcile, storage)
+    summary = catalog_stats.summary(category)
+    if not summary["ready"]:
+        await update.message.reply_text("⏳ Statistiques en cours de calcul, réessayez dans un instant")
+        return
+    
+    lines = [f"📊 Statistiques{' : ' + category if category else ''}", ""]
+    lines.append(f"Fichiers : {summary['files']}")
+    if summary["bytes"]:
+        lines.append(f"Taille connue : {summary['bytes'] / 1e6:.1f} Mo")
+    lines.append(f"Masquages : {summary['hidden']}" + ("" if category else f" ({summary['hidden_users']} utilisateur(s))"))
+    
+    if category is None:
+        lines += ["", "Par catégorie :"]
+        lines += [f"• {cat} : {catalog_stats.count(cat)}" for cat in MAIN_CATEGORIES]
+    else:
+        lines += ["", "Par sous-catégorie :"]
+        lines += [f"• {sub} : {catalog_stats.count(category, sub)}" for sub in SUB_CATEGORIES]
+    if summary["type"]:
+        lines += ["", "Par type :"]
+        lines += [f"• {file_type} : {n}" for file_type, n in summary["type"].most_common()]
+    if summary["uploader"]:
+        lines += ["", "Principaux uploaders :"]
+        lines += [f"• {uploader} : {n}" for uploader, n in summary["uploader"].most_common(STATS_TOP)]
+    days = sorted((day for day in summary["day"] if day != "?"), reverse=True)[:STATS_DAYS]
+    if days:
+        lines += ["", "Derniers jours d'upload :"]
+        lines += [f"• {day} : {summary['day'][day]}" for day in days]
+    await update.message.reply_text("\n".join(lines))
+
+POPULAR_REPORT_SIZE = 20
+POPULAR_REPORT_MAX = 50
+
+async def popular_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    
+    # /top [jours] [nombre] : comptes approximatifs, ± l'erreur maximale
+    try:
+        days = int(context.args[0]) if context.args else POPULAR_MENU_DAYS
+        limit = int(context.args[1]) if len(context.args) > 1 else POPULAR_REPORT_SIZE
+    except ValueError:
+        await update.message.reply_text("❌ Usage : /top [jours] [nombre]")
+        return
+    days = min(max(days, 1), POPULAR_WINDOW_DAYS)
+    ranking, total = await asyncio.to_thread(download_stats.top, days * 86400, min(max(limit, 1), POPULAR_REPORT_MAX))
+    if not ranking:
+        await update.message.reply_text(f"📉 Aucun téléchargement sur {days} jour(s)")
+        return
+    
+    lines = [f"🔥 Top téléchargements ({days} jour(s), {total} au total)", ""]
+    for rank, ((category, subcategory, file_key), n, error) in enumerate(ranking, 1):
+        try:
+            name = storage.get_file(category, subcategory, file_key)["file_name"]
+        except KeyError:
+            name = f"#{file_key} (supprimé)"
+        lines.append(f"{rank}. {name} — {category} > {subcategory} : {n}" + (f" (±{error})" if error else ""))
+    await update.message.reply_text("\n".join(lines))
+
+def duplicate_groups():
+    # En mode "link" ou "allow", un même contenu peut légitimement figurer dans
+    # plusieurs sous-catégories : seuls les doublons d'une même sous-catégorie comptent
+    per_cell = DUPLICATE_POLICY != "reject"
+    groups = []
+    for locations in content_index.duplicates().values():
+        if per_cell:
+            by_cell = {}
+            for loc in locations:
+                by_cell.setdefault(loc[:2], []).append(loc)
+            groups.extend(locs for locs in by_cell.values() if len(locs) > 1)
+        else:
+            groups.append(locations)
+    return groups
+
+def merge_duplicates(groups, progress):
+    # On garde l'entrée la plus ancienne de chaque groupe. Les entrées
+    # supprimées entre-temps (autre fusion, autre instance) sont ignorées.
+    progress[1] = len(groups)
+    removed = 0
+    for locs in groups:
+        dated = []
+        for loc in locs:
+            try:
+                dated.append((storage.get_file(*loc).get("date") or "", loc))
+            except KeyError:
+                continue
+        dated.sort(key=lambda entry: entry[0])
+        for _, loc in dated[1:]:
+            removed += storage.remove_file(*loc)
+        progress[0] += 1
+    return removed
+
+async def duplicates_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    
+    if not content_index.ready():
+        await update.message.reply_text("⏳ Index des contenus en cours de construction, réessayez dans un instant")
+        return
+    groups = await asyncio.to_thread(duplicate_groups)
+    
+    if not groups:
+        await update.message.reply_text("✅ Aucun doublon dans le catalogue")
+        return
+    
+    merge = context.args and context.args[0].lower() == "fusionner"
+    extra = sum(len(locs) - 1 for locs in groups)
+    if merge:
+        # Tri et suppressions dans un thread, comme /stats et /top
+        status = await update.message.reply_text(f"🧹 Fusion de {len(groups)} groupe(s) de doublons…")
+        try:
+            removed = await run_with_progress(status, "🧹 Fusion", functools.partial(merge_duplicates, groups))
+        except Exception as e:
+            logger.error(f"Duplicate merge error: {str(e)}")
+            await status.edit_text("❌ Erreur lors de la fusion des doublons")
+            return
+        await persistence.durable()
+        log_activity(ADMIN_ID, "MERGE_DUPLICATES", removed=removed, groups=len(groups))
+        await status.edit_text(f"🧹 {removed} doublon(s) supprimé(s) dans {len(groups)} groupe(s)")
+        return
     
-    return InlineKeyboardMarkup(keyboard)
+    lines = [f"♻️ {len(groups)} groupe(s) de doublons, {extra} entrée(s) en trop\n"]
+    for locs in groups[:20]:
+        lines.append("• " + " | ".join(describe_location(loc) for loc in locs))
+    if len(groups) > 20:
+        lines.append(f"… et {len(groups) - 20} autre(s)")
+    lines.append("\n/doublons fusionner pour ne garder que l'original")
+    await update.message.reply_text("\n".join(lines))
 
-def create_subcategory_menu(category):
-    keyboard = []
-    for sub in SUB_CATEGORIES:
-        keyboard.append([InlineKeyboardButton(sub, callback_data=f"sub_{category}_{sub}")])
-    keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="back_to_main")])
-    return InlineKeyboardMarkup(keyboard)
+backup_lock = asyncio.Lock()
 
-def create_file_menu(category, subcategory, user_id):
-    files = storage.data.get(category, {}).get(subcategory, [])
-    keyboard = []
+async def run_with_progress(message, label, work):
+    # Travail long dans un thread ; l'avancement [fait, total] est affiché en
+    # éditant le message toutes les BACKUP_PROGRESS_INTERVAL secondes
+    progress = [0, 0]
+    task = asyncio.ensure_future(asyncio.to_thread(work, progress))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=BACKUP_PROGRESS_INTERVAL)
+        if done:
+            return task.result()
+        if progress[1]:
+            try:
+                await message.edit_text(f"{label} : {progress[0]}/{progress[1]} ({progress[0] / progress[1]:.0%})")
+            except Exception as e:
+                logger.warning(f"Progress update failed: {str(e)}")
+
+async def export_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    if backup_lock.locked():
+        await update.message.reply_text("⏳ Une sauvegarde ou restauration est déjà en cours")
+        return
     
-    for idx, file in enumerate(files):
-        # Vérifier si le fichier est masqué pour cet utilisateur
-        if hidden_files.is_hidden(user_id, category, subcategory, idx):
-            continue
-            
-        file_name = file.get('file_name', f'Fichier {idx+1}')
-        btn_row = [
-            InlineKeyboardButton(f"⬇️ {file_name}", callback_data=f"file_{category}_{subcategory}_{idx}")
-        ]
-        
-        # Boutons d'action
-        if user_id == ADMIN_ID:
-            btn_row.append(InlineKeyboardButton("🗑️", callback_data=f"del_{category}_{subcategory}_{idx}"))
-        else:
-            btn_row.append(InlineKeyboardButton("👁️", callback_data=f"hide_{category}_{subcategory}_{idx}"))
-        
-        keyboard.append(btn_row)
+    async with backup_lock:
+        started = time.perf_counter()
+        await persistence.durable()
+        status = await update.message.reply_text("💾 Sauvegarde en cours…")
+        BACKUP_DIR.mkdir(exist_ok=True)
+        path = BACKUP_DIR / f"konntek-{datetime.now():%Y%m%d-%H%M%S}.jsonl.gz"
+        try:
+            files, hidden = await run_with_progress(status, "💾 Sauvegarde", functools.partial(write_backup, path))
+        except Exception as e:
+            logger.error(f"Backup export error: {str(e)}")
+            await status.edit_text("❌ Erreur lors de la sauvegarde")
+            return
+        prune_backups()
     
-    footer = [InlineKeyboardButton("🔙 Retour", callback_data=f"back_to_sub_{category}")]
+    size = path.stat().st_size
+    log_activity(ADMIN_ID, "EXPORT", path.name, latency_ms=(time.perf_counter() - started) * 1000,
+                 files=files, hidden=hidden, bytes=size)
+    await status.edit_text(
+        f"✅ Sauvegarde terminée : {files} fichier(s), {hidden} masquage(s), {size / 1e6:.1f} Mo"
+    )
+    if size > TELEGRAM_UPLOAD_LIMIT:
+        await update.message.reply_text(
+            f"Fichier trop volumineux pour Telegram, conservé sur le serveur.\nRestauration : /import {path.name}"
+        )
+        return
+    with open(path, 'rb') as f:
+        await context.bot.send_document(
+            chat_id=update.message.chat_id, document=f, filename=path.name,
+            caption="Répondez /import à ce message pour restaurer cette sauvegarde"
+        )
+
+async def import_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
     
-    # Bouton upload uniquement pour admin
-    if user_id == ADMIN_ID:
-        footer.append(InlineKeyboardButton("➕ Upload", callback_data=f"upload_{category}_{subcategory}"))
+    # Sauvegarde du serveur (/import <nom>) ou document auquel la commande répond
+    replied = update.message.reply_to_message
+    document = replied.document if replied else None
+    downloaded = False
+    if context.args:
+        path = BACKUP_DIR / Path(context.args[0]).name
+        if not path.is_file():
+            await update.message.reply_text(f"❌ Sauvegarde introuvable : {path.name}")
+            return
+    elif document is not None and (document.file_name or "").endswith(".jsonl.gz"):
+        if document.file_size and document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+            await update.message.reply_text(
+                "❌ Document trop volumineux pour être téléchargé par le bot (20 Mo) : "
+                "déposez-le dans le dossier backups du serveur puis /import <nom>"
+            )
+            return
+        path, downloaded = BACKUP_DIR / f"import-{document.file_unique_id}.jsonl.gz", True
+    else:
+        available = sorted(p.name for p in BACKUP_DIR.glob("konntek-*.jsonl.gz"))[-BACKUP_KEEP:]
+        await update.message.reply_text(
+            "♻️ Restauration : répondez /import à un document de sauvegarde (.jsonl.gz) "
+            "ou indiquez une sauvegarde du serveur.\n\n"
+            + ("\n".join(f"/import {name}" for name in available) or "Aucune sauvegarde sur le serveur.")
+        )
+        return
+    if backup_lock.locked():
+        await update.message.reply_text("⏳ Une sauvegarde ou restauration est déjà en cours")
+        return
     
-    keyboard.append(footer)
-    return InlineKeyboardMarkup(keyboard)
+    async with backup_lock:
+        started = time.perf_counter()
+        status = await update.message.reply_text("♻️ Restauration en cours…")
+        try:
+            if downloaded:
+                BACKUP_DIR.mkdir(exist_ok=True)
+                await (await context.bot.get_file(document.file_id)).download_to_drive(path)
+            await persistence.durable()
+            files, hidden = await run_with_progress(status, "♻️ Restauration", functools.partial(restore_backup, path))
+        except (ValueError, KeyError, EOFError, OSError) as e:
+            logger.error(f"Backup import rejected: {str(e)}")
+            await status.edit_text("❌ Sauvegarde invalide ou incomplète : rien n'a été modifié")
+            return
+        except Exception as e:
+            logger.error(f"Backup import error: {str(e)}")
+            await status.edit_text("❌ Erreur lors de la restauration")
+            return
+        finally:
+            if downloaded:
+                path.unlink(missing_ok=True)
+    
+    log_activity(ADMIN_ID, "IMPORT", path.name, latency_ms=(time.perf_counter() - started) * 1000,
+                 files=files, hidden=hidden)
+    await status.edit_text(f"✅ Restauration terminée : {files} fichier(s), {hidden} masquage(s)")
 
-def create_hidden_files_menu(user_id):
-    hidden_list = hidden_files.get_hidden_files(user_id)
-    keyboard = []
+SEARCH_RESULTS = 10
+INLINE_RESULTS = 50
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("🔍 Usage : /search mots-clés (nom, auteur, type ou date AAAA-MM-JJ)")
+        return
     
-    for item in hidden_list:
-        cat = item["category"]
-        sub = item["subcategory"]
-        idx = item["index"]
-        
+    user_id = update.message.from_user.id
+    if not search_index.ready():
+        await update.message.reply_text("⏳ Index de recherche en cours de construction, réessayez dans un instant")
+        return
+    started = time.perf_counter()
+    # Recherche hors de la boucle : une expansion de préfixe peut parcourir
+    # de longues listes
+    results = await asyncio.to_thread(search_index.search, query, None if user_id == ADMIN_ID else user_id,
+                                      SEARCH_RESULTS)
+    log_activity(user_id, "SEARCH", query, latency_ms=(time.perf_counter() - started) * 1000,
+                 results=len(results))
+    if not results:
+        await update.message.reply_text(f"🔍 Aucun résultat pour « {query} »")
+        return
+    
+    keyboard = []
+    for category, subcategory, file_key in results:
         try:
-            file_data = storage.data[cat][sub][idx]
-            file_name = file_data.get('file_name', f'Fichier {idx+1}')
-            btn_text = f"{cat}/{sub} - {file_name}"
-            keyboard.append([
-                InlineKeyboardButton(btn_text, callback_data=f"unhide_{cat}_{sub}_{idx}")
-            ])
-        except:
+            file_data = storage.get_file(category, subcategory, file_key)
+        except KeyError:
             continue
-    
-    keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="back_to_main")])
-    return InlineKeyboardMarkup(keyboard)
-
-# Commandes
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    welcome_msg = (
-        "🌟 Bienvenue sur Konntek_Bot !\n\n"
-        "📂 Accédez à la médiathèque organisée par catégories.\n"
-        "📍 Envoyez /location pour partager votre position."
-    )
+        keyboard.append([InlineKeyboardButton(
+            f"⬇️ {file_data['file_name']} ({category}/{subcategory})",
+            callback_data=f"file_{cell_code(category, subcategory)}_{file_key}"
+        )])
     await update.message.reply_text(
-        welcome_msg, 
-        reply_markup=create_main_menu(user.id)
+        f"🔍 Résultats pour « {query} » :",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+def inline_result(category, subcategory, file_data):
+    result_id = f"{cell_code(category, subcategory)}_{file_data['id']}"
+    title = file_data["file_name"]
+    description = f"{category} / {subcategory}"
+    caption = f"📥 {title}"
+    file_type = file_data.get("file_type")
+    if file_type == "photo":
+        return InlineQueryResultCachedPhoto(result_id, file_data["file_id"], title=title,
+                                            description=description, caption=caption)
+    if file_type == "video":
+        return InlineQueryResultCachedVideo(result_id, file_data["file_id"], title,
+                                            description=description, caption=caption)
+    if file_type == "audio":
+        return InlineQueryResultCachedAudio(result_id, file_data["file_id"], caption=caption)
+    if file_type == "voice":
+        return InlineQueryResultCachedVoice(result_id, file_data["file_id"], title, caption=caption)
+    return InlineQueryResultCachedDocument(result_id, title, file_data["file_id"],
+                                           description=description, caption=caption)
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    offset = int(inline_query.offset or 0)
+    if not search_index.ready():
+        # Index en construction : réponse vide, non mise en cache
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return
+    
+    # Pagination de Telegram : offset = nombre de résultats déjà envoyés
+    results = (await asyncio.to_thread(search_index.search, inline_query.query,
+                                       None if user_id == ADMIN_ID else user_id, offset + INLINE_RESULTS))[offset:]
+    answers = []
+    for category, subcategory, file_key in results:
+        try:
+            answers.append(inline_result(category, subcategory, storage.get_file(category, subcategory, file_key)))
+        except KeyError:
+            continue
+    await inline_query.answer(
+        answers,
+        cache_time=10,
+        is_personal=True,
+        next_offset=str(offset + INLINE_RESULTS) if len(results) == INLINE_RESULTS else ""
     )
-    log_activity(user.id, "START", f"User: {user.first_name}")
 
 async def location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -292,76 +4389,175 @@ async def location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     )
 
+def position_line(user_id, ts, latitude, longitude, distance=None):
+    when = datetime.fromtimestamp(ts).strftime("%d/%m %H:%M")
+    prefix = f"{distance:.1f} km — " if distance is not None else ""
+    return f"• {prefix}{user_id} ({when}) https://maps.google.com/?q={latitude:.6f},{longitude:.6f}"
+
+def latest_positions_text(limit=LOCATION_REPORT_SIZE):
+    users, points = location_store.counts()
+    if not users:
+        return "📍 Aucune position partagée."
+    lines = [f"📍 Dernières positions ({users} utilisateur(s), {points} point(s)) :", ""]
+    lines += [position_line(*position) for position in location_store.latest_positions(limit)]
+    if users > limit:
+        lines.append(f"… et {users - limit} autre(s)")
+    return "\n".join(lines)
+
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     location = update.message.location
-    await update.message.reply_text(
+    location_store.record(user.id, location.latitude, location.longitude, update.message.date.timestamp())
+    text = (
         f"📍 Position reçue :\n\n"
         f"Latitude: {location.latitude:.6f}\n"
         f"Longitude: {location.longitude:.6f}\n\n"
-        f"https://maps.google.com/?q={location.latitude},{location.longitude}",
-        reply_markup=ReplyKeyboardRemove()
+        f"https://maps.google.com/?q={location.latitude},{location.longitude}"
     )
-    log_activity(user.id, "LOCATION", f"Lat: {location.latitude}, Lon: {location.longitude}")
+    if location.live_period:
+        text += "\n\n📡 Position en direct suivie"
+    if user.id == ADMIN_ID:
+        # L'admin partage un point : positions des utilisateurs autour
+        nearby = [n for n in location_store.within(location.latitude, location.longitude, LOCATION_NEARBY_KM)
+                  if n[1] != user.id]
+        text += f"\n\n👥 À moins de {LOCATION_NEARBY_KM:g} km : {len(nearby)}"
+        text += "".join("\n" + position_line(user_id, ts, lat, lon, distance)
+                        for distance, user_id, ts, lat, lon in nearby[:LOCATION_REPORT_SIZE])
+    await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+    log_activity(user.id, "LOCATION", latitude=location.latitude, longitude=location.longitude,
+                 live=bool(location.live_period))
+
+async def handle_live_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Position en direct : Telegram modifie le message à chaque déplacement.
+    # Pas de réponse, un ajout au fichier du jour au plus tous les LOCATION_MIN_INTERVAL
+    message = update.edited_message
+    location = message.location
+    when = (message.edit_date or message.date).timestamp()
+    if location_store.record(message.from_user.id, location.latitude, location.longitude, when):
+        log_activity(message.from_user.id, "LIVE_LOCATION", latitude=location.latitude, longitude=location.longitude)
+
+async def positions_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    
+    # /positions : dernière position par utilisateur ; /positions <id> : son historique
+    if not context.args:
+        await update.message.reply_text(latest_positions_text())
+        return
+    try:
+        user_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Usage : /positions [id utilisateur]")
+        return
+    points = location_store.history(user_id)
+    if not points:
+        await update.message.reply_text(f"📍 Aucune position pour {user_id}")
+        return
+    lines = [f"📍 {user_id} : {len(points)} point(s), les plus récents :", ""]
+    lines += [position_line(user_id, *point) for point in reversed(points[-LOCATION_REPORT_SIZE:])]
+    await update.message.reply_text("\n".join(lines))
+
+async def nearby_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    
+    # /autour <latitude> <longitude> [rayon km]
+    try:
+        latitude, longitude = float(context.args[0]), float(context.args[1])
+        radius = float(context.args[2]) if len(context.args) > 2 else LOCATION_NEARBY_KM
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and radius > 0):
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text("❌ Usage : /autour <latitude> <longitude> [rayon en km]")
+        return
+    nearby = location_store.within(latitude, longitude, radius)
+    if not nearby:
+        await update.message.reply_text(f"📍 Aucune position à moins de {radius:g} km")
+        return
+    lines = [f"📍 {len(nearby)} position(s) à moins de {radius:g} km :", ""]
+    lines += [position_line(user_id, ts, lat, lon, distance)
+              for distance, user_id, ts, lat, lon in nearby[:LOCATION_REPORT_SIZE]]
+    if len(nearby) > LOCATION_REPORT_SIZE:
+        lines.append(f"… et {len(nearby) - LOCATION_REPORT_SIZE} autre(s)")
+    await update.message.reply_text("\n".join(lines))
 
 # Callbacks
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
+    data = query.data or ""
     user_id = query.from_user.id
+    if not valid_callback(data):
+        await query.answer("⌛ Menu expiré")
+        try:
+            await query.edit_message_text("📂 Menu Principal :", reply_markup=create_main_menu(user_id))
+        except Exception as e:
+            logger.warning(f"Stale menu refresh failed: {str(e)}")
+        return
+    await query.answer()
 
     if data.startswith("cat_"):
-        category = data[4:]
+        category = parse_category(data[4:])
         await query.edit_message_text(
             f"📁 Catégorie: {category}\nSélectionnez une sous-catégorie:",
-            reply_markup=create_subcategory_menu(category)
+            reply_markup=create_subcategory_menu(category, user_id)
         )
     
     elif data.startswith("sub_"):
-        _, category, subcategory = data.split("_", 2)
-        files = storage.data.get(category, {}).get(subcategory, [])
-        msg = f"📂 {category} / {subcategory}\n\n"
-        
-        # Compter les fichiers visibles
-        visible_files = [
-            f for idx, f in enumerate(files) 
-            if not hidden_files.is_hidden(user_id, category, subcategory, idx)
-        ]
-        
-        msg += "Aucun fichier disponible." if not visible_files else f"{len(visible_files)} fichier(s) disponible(s) :"
-        
-        await query.edit_message_text(
-            msg,
-            reply_markup=create_file_menu(category, subcategory, user_id)
-        )
+        category, subcategory = parse_cell(data[4:])
+        text, markup = render_file_menu(category, subcategory, user_id)
+        await query.edit_message_text(text, reply_markup=markup)
+    
+    elif data.startswith("pg_"):  # Navigation entre les pages
+        _, code, page = data.split("_")
+        category, subcategory = parse_cell(code)
+        text, markup = render_file_menu(category, subcategory, user_id, int(page))
+        await query.edit_message_text(text, reply_markup=markup)
+    
+    elif data == "noop":
+        pass
     
     elif data.startswith("file_"):
-        _, category, subcategory, idx = data.split("_")
-        idx = int(idx)
+        _, code, file_key = data.split("_")
+        category, subcategory = parse_cell(code)
+        file_key = int(file_key)
         try:
-            file_data = storage.data[category][subcategory][idx]
+            file_data = storage.get_file(category, subcategory, file_key)
             
-            # Solution garantie pour l'envoi de fichiers
-            await context.bot.send_document(
-                chat_id=query.message.chat_id,
-                document=file_data["file_id"],
-                caption=f"📥 {file_data['file_name']}"
-            )
-            log_activity(user_id, "DOWNLOAD", f"{category}/{subcategory}/{file_data['file_name']}")
+            started = time.perf_counter()
+            await send_file(context.bot, query.message.chat_id, file_data)
+            download_stats.record(category, subcategory, file_key)
+            log_activity(user_id, "DOWNLOAD", file_data['file_name'], category, subcategory,
+                         latency_ms=(time.perf_counter() - started) * 1000, file_key=file_key)
         except Exception as e:
             logger.error(f"Download error: {str(e)}")
             await query.answer("❌ Erreur lors du téléchargement", show_alert=True)
     
+    elif data.startswith("dl_"):  # Téléchargement de toute la sous-catégorie
+        category, subcategory = parse_cell(data[3:])
+        if context.user_data.get('bulk_download'):
+            await context.bot.send_message(chat_id=query.message.chat_id, text="⏳ Un envoi groupé est déjà en cours")
+            return
+        context.user_data['bulk_download'] = True
+        # Tâche de fond : l'utilisateur peut continuer à naviguer pendant l'envoi
+        context.application.create_task(
+            download_all(context, query.message.chat_id, user_id, category, subcategory),
+            update=update
+        )
+    
     elif data.startswith("upload_"):
         if user_id != ADMIN_ID:
             await query.answer("❌ Action réservée à l'admin", show_alert=True)
             return
         
-        _, category, subcategory = data.split("_", 2)
+        category, subcategory = parse_cell(data[7:])
         context.user_data['upload_category'] = category
         context.user_data['upload_subcategory'] = subcategory
-        await query.edit_message_text("⬆️ Envoyez le fichier à uploader (tout format accepté) :")
+        await query.edit_message_text(
+            "⬆️ Envoyez le fichier à uploader (tout format accepté) :\n"
+            "📦 Plusieurs fichiers : /batch, envoyez-les, puis /fin"
+        )
         # Pas de changement d'état, on attend le fichier dans le handler principal
     
     elif data.startswith("del_"):  # Suppression admin (globale)
@@ -369,17 +4565,18 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ Action réservée à l'admin", show_alert=True)
             return
         
-        _, category, subcategory, idx = data.split("_", 3)
-        idx = int(idx)
+        _, code, file_key = data.split("_")
+        category, subcategory = parse_cell(code)
+        file_key = int(file_key)
         try:
-            file_name = storage.data[category][subcategory][idx]["file_name"]
-            context.user_data['del_index'] = idx
+            file_name = storage.get_file(category, subcategory, file_key)["file_name"]
+            context.user_data['del_key'] = file_key
             context.user_data['del_category'] = category
             context.user_data['del_subcategory'] = subcategory
             
             keyboard = [
                 [InlineKeyboardButton("✅ Confirmer", callback_data="confirm_delete")],
-                [InlineKeyboardButton("❌ Annuler", callback_data=f"sub_{category}_{subcategory}")]
+                [InlineKeyboardButton("❌ Annuler", callback_data=f"sub_{code}")]
             ]
             
             await query.edit_message_text(
@@ -394,56 +4591,35 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ Fichier introuvable", show_alert=True)
     
     elif data.startswith("hide_"):  # Masquage utilisateur (local)
-        _, category, subcategory, idx = data.split("_", 3)
-        idx = int(idx)
+        _, code, file_key, page = data.split("_")
+        category, subcategory = parse_cell(code)
+        file_key, page = int(file_key), int(page)
         
-        if hidden_files.hide_file(user_id, category, subcategory, idx):
+        if hidden_files.hide_file(user_id, category, subcategory, file_key):
             await query.answer("👁️ Fichier masqué pour vous", show_alert=True)
             
             # Mettre à jour le menu
-            files = storage.data.get(category, {}).get(subcategory, [])
-            visible_files = [
-                f for i, f in enumerate(files) 
-                if not hidden_files.is_hidden(user_id, category, subcategory, i)
-            ]
-            
-            msg = f"📂 {category} / {subcategory}\n\n"
-            msg += "Aucun fichier disponible." if not visible_files else f"{len(visible_files)} fichier(s) disponible(s) :"
-            
-            await query.edit_message_text(
-                msg,
-                reply_markup=create_file_menu(category, subcategory, user_id)
-            )
+            text, markup = render_file_menu(category, subcategory, user_id, page)
+            await query.edit_message_text(text, reply_markup=markup)
         else:
             await query.answer("❌ Erreur lors du masquage", show_alert=True)
     
     elif data.startswith("unhide_"):  # Rendre visible
-        _, category, subcategory, idx = data.split("_", 3)
-        idx = int(idx)
+        _, code, file_key = data.split("_")
+        category, subcategory = parse_cell(code)
+        file_key = int(file_key)
         
-        if hidden_files.unhide_file(user_id, category, subcategory, idx):
+        if hidden_files.unhide_file(user_id, category, subcategory, file_key):
             await query.answer("✅ Fichier à nouveau visible", show_alert=True)
             
             # Mettre à jour le menu
-            files = storage.data.get(category, {}).get(subcategory, [])
-            visible_files = [
-                f for i, f in enumerate(files) 
-                if not hidden_files.is_hidden(user_id, category, subcategory, i)
-            ]
-            
-            msg = f"📂 {category} / {subcategory}\n\n"
-            msg += "Aucun fichier disponible." if not visible_files else f"{len(visible_files)} fichier(s) disponible(s) :"
-            
-            await query.edit_message_text(
-                msg,
-                reply_markup=create_file_menu(category, subcategory, user_id)
-            )
+            text, markup = render_file_menu(category, subcategory, user_id)
+            await query.edit_message_text(text, reply_markup=markup)
         else:
             await query.answer("❌ Erreur lors de l'affichage", show_alert=True)
     
     elif data == "view_hidden":  # Voir les fichiers masqués
-        hidden_list = hidden_files.get_hidden_files(user_id)
-        if not hidden_list:
+        if not hidden_files.has_hidden(user_id):
             await query.answer("Vous n'avez aucun fichier masqué", show_alert=True)
             return
         
@@ -453,19 +4629,27 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return VIEWING_HIDDEN
     
+    elif data.startswith("hpg_"):  # Pages des fichiers masqués
+        page = int(data[4:])
+        await query.edit_message_text(
+            "📁 Vos fichiers masqués :\n\nCliquez sur un fichier pour le rendre à nouveau visible",
+            reply_markup=create_hidden_files_menu(user_id, page)
+        )
+    
     elif data == "confirm_delete":
         try:
             category = context.user_data['del_category']
             subcategory = context.user_data['del_subcategory']
-            idx = context.user_data['del_index']
-            file_data = storage.data[category][subcategory][idx]
+            file_key = context.user_data['del_key']
+            file_data = storage.get_file(category, subcategory, file_key)
             
-            if storage.remove_file(category, subcategory, idx):
+            if await mutate_storage(storage.remove_file, category, subcategory, file_key):
+                await persistence.durable()
                 await query.edit_message_text(
                     "🗑️ Fichier supprimé avec succès pour tous les utilisateurs !",
                     reply_markup=create_subcategory_menu(category)
                 )
-                log_activity(user_id, "DELETE", f"{category}/{subcategory}/{file_data['file_name']}")
+                log_activity(user_id, "DELETE", file_data['file_name'], category, subcategory)
             else:
                 await query.edit_message_text("❌ Erreur lors de la suppression")
         except Exception as e:
@@ -474,6 +4658,25 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         return ConversationHandler.END
     
+    elif data == "geo":  # Positions partagées (admin)
+        if user_id != ADMIN_ID:
+            await query.answer("❌ Action réservée à l'admin", show_alert=True)
+            return
+        await query.edit_message_text(
+            latest_positions_text(),
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Retour", callback_data=f"back_to_sub_{category_code(GEO_CATEGORY)}")
+            ]]),
+            disable_web_page_preview=True
+        )
+    
+    elif data == "popular":
+        # Fusion des tranches (quelques dizaines de ms sans cache) hors de la boucle
+        markup, shown = await asyncio.to_thread(create_popular_menu, user_id)
+        text = (f"🔥 Les plus téléchargés ({POPULAR_MENU_DAYS} derniers jours) :" if shown
+                else "🔥 Aucun téléchargement récent.")
+        await query.edit_message_text(text, reply_markup=markup)
+    
     elif data == "back_to_main":
         await query.edit_message_text(
             "📂 Menu Principal :", 
@@ -481,13 +4684,154 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data.startswith("back_to_sub_"):
-        category = data.split("_")[-1]
+        category = parse_category(data[len("back_to_sub_"):])
         await query.edit_message_text(
             f"📁 Catégorie: {category}\nSélectionnez une sous-catégorie:",
-            reply_markup=create_subcategory_menu(category)
+            reply_markup=create_subcategory_menu(category, user_id)
         )
 
 # Gestion des fichiers
+def extract_file_data(file_msg, uploader):
+    # Détection de tout type de fichier
+    file_name = f"file_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    
+    # Vérifier tous les types possibles
+    if file_msg.document:
+        attachment = file_msg.document
+        file_name = file_msg.document.file_name or file_name
+        file_type = "document"
+    elif file_msg.photo:
+        attachment = file_msg.photo[-1]
+        file_name = f"photo_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
+        file_type = "photo"
+    elif file_msg.video:
+        attachment = file_msg.video
+        file_name = file_msg.video.file_name or file_name
+        file_type = "video"
+    elif file_msg.audio:
+        attachment = file_msg.audio
+        file_name = file_msg.audio.file_name or file_name
+        file_type = "audio"
+    elif file_msg.voice:
+        attachment = file_msg.voice
+        file_name = f"voice_{datetime.now().strftime('%Y%m%d%H%M%S')}.ogg"
+        file_type = "voice"
+    else:
+        # Fallback pour tout autre type
+        attachment = file_msg.effective_attachment
+        file_type = "unknown"
+    
+    # Création de l'entrée
+    file_data = {
+        "file_id": attachment.file_id,
+        "file_unique_id": attachment.file_unique_id,
+        "file_name": file_name,
+        "file_type": file_type,
+        "date": datetime.now().isoformat(),
+        "uploader": uploader
+    }
+    # Taille connue de Telegram : alimente les statistiques
+    if getattr(attachment, "file_size", None):
+        file_data["file_size"] = attachment.file_size
+    return file_data
+
+def check_duplicate(category, subcategory, file_data):
+    # Renvoie (entrée à enregistrer ou None si refusée, emplacement existant).
+    # L'appelant attend d'abord content_index.wait_ready()
+    if DUPLICATE_POLICY == "allow":
+        return file_data, None
+    existing = content_index.find(file_data)
+    if not existing:
+        return file_data, None
+    same_cell = [loc for loc in existing if loc[:2] == (category, subcategory)]
+    if DUPLICATE_POLICY == "link" and not same_cell:
+        origin = existing[0]
+        original = storage.get_file(*origin)
+        # Même contenu, même file_id : seule l'entrée de catalogue est ajoutée
+        return {**file_data, "file_id": original["file_id"], "link_of": list(origin)}, origin
+    return None, (same_cell or existing)[0]
+
+def describe_location(location):
+    category, subcategory, file_key = location
+    try:
+        return f"{category} > {subcategory} ({storage.get_file(*location)['file_name']})"
+    except KeyError:
+        return f"{category} > {subcategory} (#{file_key})"
+
+# Upload par lots : un album (media_group_id) ou une session /batch ... /fin
+# est enregistré en une seule écriture, avec un seul message récapitulatif.
+async def commit_upload_batch(context, chat_id, user, category, subcategory, files):
+    started = time.perf_counter()
+    accepted, skipped, seen = [], 0, set()
+    await content_index.wait_ready()
+    for file_data in files:
+        file_data, _ = check_duplicate(category, subcategory, file_data)
+        # Doublons à l'intérieur du lot lui-même
+        if file_data is None or (DUPLICATE_POLICY != "allow" and ContentIndex.content_key(file_data) in seen):
+            skipped += 1
+            continue
+        seen.add(ContentIndex.content_key(file_data))
+        accepted.append(file_data)
+    files = accepted
+    await mutate_storage(storage.add_files, category, subcategory, files)
+    await persistence.durable()
+    
+    counts = Counter(f["file_type"] for f in files)
+    details = "\n".join(f"• {file_type} : {n}" for file_type, n in counts.most_common())
+    if skipped:
+        details += f"\n♻️ Doublons ignorés : {skipped}"
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"✅ {len(files)} fichier(s) uploadé(s) dans :\n{category} > {subcategory}\n\n{details}",
+        reply_markup=create_subcategory_menu(category)
+    )
+    log_activity(user.id, "UPLOAD_BATCH", category=category, subcategory=subcategory,
+                 latency_ms=(time.perf_counter() - started) * 1000, files=len(files), duplicates=skipped)
+
+async def flush_album(context, chat_id, user, group_id):
+    # Telegram livre un album message par message : on attend un silence de
+    # ALBUM_WINDOW secondes avant d'enregistrer le lot
+    albums = context.user_data.setdefault('albums', {})
+    loop = asyncio.get_running_loop()
+    while loop.time() < albums[group_id]["deadline"]:
+        await asyncio.sleep(albums[group_id]["deadline"] - loop.time())
+    album = albums.pop(group_id)
+    try:
+        await commit_upload_batch(context, chat_id, user, album["category"], album["subcategory"], album["files"])
+    except Exception as e:
+        logger.error(f"Album upload error: {str(e)}")
+        await context.bot.send_message(chat_id=chat_id, text="❌ Erreur lors de l'upload de l'album")
+
+async def batch_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    if 'upload_category' not in context.user_data:
+        await update.message.reply_text("Choisissez d'abord une sous-catégorie avec ➕ Upload")
+        return
+    
+    context.user_data['upload_batch'] = []
+    await update.message.reply_text(
+        "📦 Envoi groupé ouvert : envoyez ou transférez vos fichiers, puis /fin pour enregistrer."
+    )
+
+async def batch_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    if user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Commande réservée à l'admin")
+        return
+    files = context.user_data.pop('upload_batch', None)
+    if files is None:
+        await update.message.reply_text("Aucun envoi groupé en cours.")
+        return
+    
+    category = context.user_data.pop('upload_category')
+    subcategory = context.user_data.pop('upload_subcategory')
+    if not files:
+        await update.message.reply_text("Envoi groupé fermé : aucun fichier reçu.")
+        return
+    await commit_upload_batch(context, update.message.chat_id, user, category, subcategory, files)
+
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     
@@ -499,58 +4843,57 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if 'upload_category' in context.user_data:
         category = context.user_data['upload_category']
         subcategory = context.user_data['upload_subcategory']
-        file_msg = update.message
+        file_data = extract_file_data(update.message, user.first_name)
         
-        # Détection de tout type de fichier
-        file_id = None
-        file_name = f"file_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        file_type = "document"
+        # Session /batch en cours : on accumule jusqu'à /fin
+        if 'upload_batch' in context.user_data:
+            context.user_data['upload_batch'].append(file_data)
+            return
         
-        # Vérifier tous les types possibles
-        if file_msg.document:
-            file_id = file_msg.document.file_id
-            file_name = file_msg.document.file_name or file_name
-            file_type = "document"
-        elif file_msg.photo:
-            file_id = file_msg.photo[-1].file_id
-            file_name = f"photo_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
-            file_type = "photo"
-        elif file_msg.video:
-            file_id = file_msg.video.file_id
-            file_name = file_msg.video.file_name or file_name
-            file_type = "video"
-        elif file_msg.audio:
-            file_id = file_msg.audio.file_id
-            file_name = file_msg.audio.file_name or file_name
-            file_type = "audio"
-        elif file_msg.voice:
-            file_id = file_msg.voice.file_id
-            file_name = f"voice_{datetime.now().strftime('%Y%m%d%H%M%S')}.ogg"
-            file_type = "voice"
-        else:
-            # Fallback pour tout autre type
-            file_id = file_msg.effective_attachment.file_id
-            file_type = "unknown"
-        
-        # Création de l'entrée
-        file_data = {
-            "file_id": file_id,
-            "file_name": file_name,
-            "file_type": file_type,
-            "date": datetime.now().isoformat(),
-            "uploader": user.first_name
-        }
+        group_id = update.message.media_group_id
+        if group_id:
+            albums = context.user_data.setdefault('albums', {})
+            deadline = asyncio.get_running_loop().time() + ALBUM_WINDOW
+            if group_id in albums:
+                albums[group_id]["files"].append(file_data)
+                albums[group_id]["deadline"] = deadline
+                return
+            albums[group_id] = {"category": category, "subcategory": subcategory,
+                                "files": [file_data], "deadline": deadline}
+            context.application.create_task(
+                flush_album(context, update.message.chat_id, user, group_id), update=update
+            )
+            # L'album entier va dans la sous-catégorie choisie
+            del context.user_data['upload_category']
+            del context.user_data['upload_subcategory']
+            return
+        
+        await content_index.wait_ready()
+        file_data, existing = check_duplicate(category, subcategory, file_data)
+        if file_data is None:
+            await update.message.reply_text(f"♻️ Fichier déjà présent :\n{describe_location(existing)}")
+            return
         
-        storage.add_file(category, subcategory, file_data)
+        started = time.perf_counter()
+        await mutate_storage(storage.add_file, category, subcategory, file_data)
+        await persistence.durable()
+        latency_ms = (time.perf_counter() - started) * 1000
+        linked = f"\n🔗 Lié à : {describe_location(existing)}" if existing else ""
         await update.message.reply_text(
-            f"✅ Fichier uploadé avec succès dans :\n{category} > {subcategory}",
+            f"✅ Fichier uploadé avec succès dans :\n{category} > {subcategory}{linked}",
             reply_markup=create_subcategory_menu(category)
         )
-        log_activity(user.id, "UPLOAD", f"{category}/{subcategory}/{file_name}")
+        log_activity(user.id, "UPLOAD", file_data['file_name'], category, subcategory,
+                     latency_ms=latency_ms, file_type=file_data['file_type'])
         
         # Réinitialiser l'état d'upload
         del context.user_data['upload_category']
         del context.user_data['upload_subcategory']
+    elif update.message.media_group_id in context.user_data.get('albums', {}):
+        # Suite d'un album dont le premier message a fixé la destination
+        album = context.user_data['albums'][update.message.media_group_id]
+        album["files"].append(extract_file_data(update.message, user.first_name))
+        album["deadline"] = asyncio.get_running_loop().time() + ALBUM_WINDOW
     else:
         # Commencer le processus d'upload
         context.user_data['current_file'] = update.message
@@ -563,48 +4906,445 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Opération annulée.")
     return ConversationHandler.END
 
-def main():
-    # Vérification des variables d'environnement
-    if not TOKEN:
-        logger.critical("TELEGRAM_BOT_TOKEN manquant!")
-        return
-    if not ADMIN_ID:
-        logger.critical("ADMIN_ID manquant!")
-        return
+async def on_shutdown(application: Application):
+    # Les écritures en attente sont vidées avant l'arrêt du processus
+    await asyncio.to_thread(shutdown_storage)
+    logger.info("Storage flushed on shutdown")
+    log_listener.stop()
 
-    logger.info("Initialisation du bot...")
+# Instrumentation des handlers
+# Branche de handle_callback d'après le début de callback_data
+CALLBACK_BRANCHES = {
+    "cat": "cat_", "sub": "sub_", "pg": "pg_", "noop": "noop", "file": "file_", "upload": "upload_",
+    "dl": "dl_", "del": "del_", "hide": "hide_", "unhide": "unhide_", "view": "view_hidden",
+    "hpg": "hpg_", "confirm": "confirm_delete", "popular": "popular", "geo": "geo",
+}
+
+def callback_branch(update):
+    data = update.callback_query.data or ""
+    head = data.partition("_")[0]
+    if head == "back":
+        return "back_to_sub_" if data.startswith("back_to_sub_") else "back_to_main"
+    return CALLBACK_BRANCHES.get(head, "other")
+
+def instrument(name, callback, branch_of=None):
+    if not METRICS_ENABLED:
+        return callback
     
-    # Créer les fichiers de stockage si inexistants
-    if not STORAGE_PATH.exists():
-        with open(STORAGE_PATH, 'w') as f:
-            json.dump({}, f)
-        logger.info("Fichier de stockage créé")
+    series = {}
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        branch = branch_of(update) if branch_of else ""
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(handler=name, branch=branch)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            histogram = series.get(branch)
+            if histogram is None:
+                histogram = series[branch] = handler_seconds.labels(handler=name, branch=branch)
+            histogram.observe(elapsed)
+    return wrapper
+
+# Traitement concurrent des mises à jour
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Au plus max_concurrent_updates traitements simultanés (limite de la
+    # classe de base), mais les mises à jour d'un même utilisateur passent une
+    # par une, dans l'ordre d'arrivée, grâce à un verrou par utilisateur.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}
+    
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            await coroutine
+            return
+        
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
     
-    if not HIDDEN_PATH.exists():
-        with open(HIDDEN_PATH, 'w') as f:
-            json.dump({}, f)
-        logger.info("Fichier de masquage créé")
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# Limitation du débit sortant
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+    
+    def paused_for(self):
+        return max(0.0, self.stamp - time.monotonic())
+    
+    def delay(self):
+        # Temps d'attente avant qu'un jeton soit disponible
+        self._refill()
+        return max((1 - self.tokens) / self.rate, self.paused_for())
+    
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+    
+    def reserve(self):
+        # Réserve un jeton quitte à passer en négatif : les appels concurrents
+        # reçoivent des délais croissants sans verrou
+        delay = self.delay()
+        self.take()
+        return delay
+    
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+    
+    def pause(self, seconds):
+        # Pas de remplissage avant l'échéance imposée par Telegram
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+        self.stamp = max(self.stamp, time.monotonic() + seconds)
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # Devant tous les appels à l'API Bot : les réponses aux callbacks passent
+    # en premier (elles ne sont pas des messages et ne consomment pas de
+    # jeton), puis les éditions, puis les envois. Seau global pour éditions et
+    # envois, seau par chat pour les envois, respect de retry_after (pause du
+    # chat visé pour toutes les priorités, sinon pause globale), et une
+    # édition encore en attente est abandonnée si une plus récente vise le
+    # même message.
+    PRIORITIES = {"answerCallbackQuery": 0, "answerInlineQuery": 0}
+    EDIT_ENDPOINTS = ("editMessageText", "editMessageReplyMarkup", "editMessageCaption")
+    MAX_CHAT_BUCKETS = 10000
+    
+    def __init__(self, rate=None, per_chat=None, chat_burst=None, max_retries=None):
+        self.global_bucket = TokenBucket(rate or API_RATE_GLOBAL, 1)
+        self.per_chat = per_chat or API_RATE_PER_CHAT
+        self.chat_burst = chat_burst or API_CHAT_BURST
+        self.max_retries = API_MAX_RETRIES if max_retries is None else max_retries
+        self._chats = OrderedDict()
+        self._waiting = []
+        self._order = itertools.count()
+        self._dispatcher = None
+        self._edits = {}
+        self.counters = {"requests": 0, "throttled": 0, "retries": 0, "collapsed": 0}
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+    
+    def _priority(self, endpoint):
+        if endpoint in self.PRIORITIES:
+            return self.PRIORITIES[endpoint]
+        return 1 if endpoint in self.EDIT_ENDPOINTS else 2
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat, self.chat_burst)
+            if len(self._chats) > self.MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+    
+    def _enqueue(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._order), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        return future
+    
+    async def _dispatch(self):
+        while self._waiting:
+            priority = self._waiting[0][0]
+            delay = self.global_bucket.delay() if priority else self.global_bucket.paused_for()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                if priority:
+                    self.global_bucket.take()
+                future.set_result(None)
+    
+    def _superseded(self, edit_key, generation):
+        if edit_key is None:
+            return False
+        current = self._edits.get(edit_key)
+        return current is None or current[0] != generation
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        queued = time.perf_counter()
+        self.counters["requests"] += 1
+        priority = self._priority(endpoint)
+        chat_id = data.get("chat_id")
+        
+        edit_key = generation = None
+        if endpoint in self.EDIT_ENDPOINTS and "message_id" in data:
+            edit_key = (endpoint, chat_id, data["message_id"])
+            generation = next(self._order)
+            previous = self._edits.get(edit_key)
+            if previous and previous[1] and not previous[1].done():
+                # L'édition précédente sort de la file sans consommer de jeton
+                previous[1].set_result(None)
+            self._edits[edit_key] = [generation, None]
+        
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+        attempt = 0
+        try:
+            while True:
+                if chat_id is not None and priority == 2:
+                    bucket = self._chat_bucket(chat_id)
+                    delay = bucket.reserve()
+                    if delay > 0:
+                        self.counters["throttled"] += 1
+                        await asyncio.sleep(delay)
+                    if self._superseded(edit_key, generation):
+                        bucket.refund()
+                        self.counters["collapsed"] += 1
+                        return True
+                elif chat_id in self._chats:
+                    # Éditions et réponses ne consomment pas de jeton du chat
+                    # mais respectent le retry_after qui lui a été imposé
+                    delay = self._chats[chat_id].paused_for()
+                    if delay > 0:
+                        self.counters["throttled"] += 1
+                        await asyncio.sleep(delay)
+                        if self._superseded(edit_key, generation):
+                            self.counters["collapsed"] += 1
+                            return True
+                
+                future = self._enqueue(priority)
+                if edit_key is not None:
+                    self._edits[edit_key][1] = future
+                await future
+                if self._superseded(edit_key, generation):
+                    self.counters["collapsed"] += 1
+                    return True
+                
+                started = time.perf_counter()
+                api_wait_seconds.observe(started - queued, method=endpoint)
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    api_errors.inc(method=endpoint, error="RetryAfter")
+                    retry_after = getattr(e.retry_after, "total_seconds", lambda: e.retry_after)()
+                    if chat_id is not None:
+                        self._chat_bucket(chat_id).pause(retry_after)
+                    else:
+                        self.global_bucket.pause(retry_after)
+                    attempt += 1
+                    if attempt > max_retries:
+                        raise
+                    self.counters["retries"] += 1
+                    logger.warning(f"Flood limit on {endpoint}, retrying in {retry_after}s")
+                except Exception as e:
+                    api_errors.inc(method=endpoint, error=type(e).__name__)
+                    raise
+                finally:
+                    api_seconds.observe(time.perf_counter() - started, method=endpoint)
+        finally:
+            if edit_key is not None and not self._superseded(edit_key, generation):
+                del self._edits[edit_key]
+
+# Serveur webhook
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app):
+        self.bot_app = bot_app
+    
+    async def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {str(e)}")
+            self.set_status(400)
+            return
+        # Réponse immédiate à Telegram, le traitement se fait dans l'Application
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
 
-    app = Application.builder().token(TOKEN).build()
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("OK")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+def make_web_app(app, webhook=True):
+    routes = [(r"/", HealthHandler), (r"/metrics", MetricsHandler)]
+    if webhook:
+        routes.append((rf"/{WEBHOOK_PATH}", TelegramWebhookHandler, {"bot_app": app}))
+    return tornado.web.Application(routes)
+
+async def serve_metrics(application: Application):
+    # En polling, le service web Render attend tout de même un port ouvert :
+    # on y sert /metrics et la santé
+    tornado.httpserver.HTTPServer(make_web_app(application, webhook=False)).listen(PORT)
+    logger.info(f"Metrics listening on port {PORT}")
+
+async def run_webhook(app, stop_event=None):
+    # Équivalent de run_polling : cycle de vie complet de l'Application
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    server = tornado.httpserver.HTTPServer(make_web_app(app), xheaders=True)
+    server.listen(PORT)
+    try:
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            # Telegram refuse setWebhook au-delà de 100 connexions
+            max_connections=min(max(MAX_CONCURRENT_UPDATES, 1), 100)
+        )
+        logger.info(f"Webhook listening on port {PORT}")
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+def build_application():
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(OutboundRateLimiter())
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    app = builder.build()
+    
+    limiter = app.bot.rate_limiter
+    metrics.gauge("konntek_rate_limiter", "Compteurs du limiteur de débit sortant", lambda: {
+        (("stat", stat),): value for stat, value in limiter.counters.items()
+    })
     
     # Commandes de base
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("location", location))
-    app.add_handler(MessageHandler(filters.LOCATION, handle_location))
+    app.add_handler(CommandHandler("start", instrument("start", start)))
+    app.add_handler(CommandHandler("location", instrument("location", location)))
+    app.add_handler(CommandHandler("cache", instrument("cache", cache_stats)))
+    app.add_handler(CommandHandler("stats", instrument("stats", catalog_report)))
+    app.add_handler(CommandHandler(["top", "populaires"], instrument("top", popular_report)))
+    app.add_handler(CommandHandler("batch", instrument("batch", batch_start)))
+    app.add_handler(CommandHandler("fin", instrument("fin", batch_finish)))
+    app.add_handler(CommandHandler("doublons", instrument("doublons", duplicates_report)))
+    app.add_handler(CommandHandler(["export", "sauvegarde"], instrument("export", export_backup)))
+    app.add_handler(CommandHandler(["import", "restaurer"], instrument("import", import_backup)))
+    app.add_handler(CommandHandler(["search", "recherche"], instrument("search", search)))
+    app.add_handler(InlineQueryHandler(instrument("inline_query", handle_inline_query)))
+    app.add_handler(CommandHandler("positions", instrument("positions", positions_report)))
+    app.add_handler(CommandHandler(["autour", "nearby"], instrument("autour", nearby_report)))
+    app.add_handler(MessageHandler(
+        filters.LOCATION & filters.UpdateType.MESSAGE, instrument("handle_location", handle_location)
+    ))
+    # Positions en direct : chaque déplacement arrive comme une modification du message
+    app.add_handler(MessageHandler(
+        filters.LOCATION & filters.UpdateType.EDITED_MESSAGE, instrument("live_location", handle_live_location)
+    ))
     
     # Gestion des fichiers
     app.add_handler(MessageHandler(
         filters.Document.ALL | filters.AUDIO | filters.VIDEO | 
         filters.PHOTO | filters.VOICE,
-        handle_file
+        instrument("handle_file", handle_file)
     ))
     
     # Callbacks généraux
-    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(CallbackQueryHandler(instrument("callback", handle_callback, callback_branch)))
+    return app
+
+def main():
+    # Vérification des variables d'environnement
+    if not TOKEN:
+        logger.critical("TELEGRAM_BOT_TOKEN manquant!")
+        return
+    if not ADMIN_ID:
+        logger.critical("ADMIN_ID manquant!")
+        return
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.critical("WEBHOOK_URL manquant pour le mode webhook!")
+        return
+    if SHARED_STORAGE and (STORAGE_BACKEND == "sqlite" or not STORAGE_JOURNAL):
+        logger.critical("SHARED_STORAGE demande le moteur json avec journal (STORAGE_JOURNAL=1)!")
+        return
+    if SHARED_STORAGE and BOT_MODE != "webhook":
+        # getUpdates n'accepte qu'un seul consommateur par bot
+        logger.warning("SHARED_STORAGE sans webhook : une seule instance peut recevoir les mises à jour")
+
+    logger.info("Initialisation du bot...")
+    
+    # Créer les fichiers de stockage si inexistants
+    if STORAGE_BACKEND != "sqlite":
+        if not (STORAGE_PATH.exists() or storage.snapshot_path.exists()):
+            storage.save_data()
+            logger.info("Fichier de stockage créé")
+        
+        if not hidden_files.bitmap_dir.exists():
+            hidden_files.save_data()
+            logger.info("Fichier de masquage créé")
+
+    app = build_application()
     
     # Lancement du bot
-    logger.info("Lancement du bot...")
-    app.run_polling()
+    logger.info(f"Lancement du bot ({BOT_MODE})...")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        if METRICS_ENABLED:
+            app.post_init = serve_metrics
+        app.run_polling()
 
 if __name__ == "__main__":
     main()